@@ -5,6 +5,27 @@ Automatically creates backups of the current map in a given
 interval and also removes older saves. Saving will be skipped
 if nobody was on the server during the interval.
 
+Only taking the map data holds up the server (about 50 ms for a
+big map). Writing the file happens in the background, into a
+temporary file that is renamed when it is complete, so there are
+never half written saves. The log shows how long every save took
+and how long it held up the server.
+
+Most saves only hold the map columns that changed since the save
+before (mapname.date.delta). Every full_save_every saves the whole
+map is saved again (mapname.date.vxl), and the delta saves up to the
+next full save build on it. A delta save can be turned into a map
+with tools/restoresave.py. Old saves are only removed together with
+all saves they belong to, once the newest of them is old enough.
+
+With the chunks storage, every save is a list of the chunks of the
+map (mapname.date.manifest) instead, a chunk being 4 rows of map
+columns. The chunks are stored compressed in the chunks folder next
+to the saves, each chunk only once, named by its hash. Usually a
+save only adds the few chunks that were built on, and every save
+can be restored on its own. Chunks no save refers to anymore are
+removed when old saves are removed.
+
 Config Options:
 
     [autosave]
@@ -23,18 +44,31 @@ Config Options:
     # Date format for the map filename.
     date_format = "%Y%m%d-%H%M"
 
+    # Save the whole map after this many delta saves, zero to always save the whole map.
+    full_save_every = 12
+
+    # Where the saves are stored: "files" for full and delta saves, or "chunks".
+    storage = "files"
+
 Commands:
 
     Command /autosave toggles the feature.
-    Command /save will save the map manually.
+    Command /save will save the map manually and report how long it took.
     Command /recentsaves shows the last 5 saves.
 """
 
 import os
 import fnmatch
+import hashlib
+import struct
+import zlib
+from array import array
 from time import time, strftime, localtime
+from timeit import default_timer
+from twisted.internet import threads
 from twisted.internet.task import LoopingCall
 from twisted.internet.reactor import callLater
+from twisted.logger import Logger
 from piqueserver.commands import command
 from piqueserver.config import config, cast_duration
 
@@ -44,6 +78,19 @@ SAVE_TO_FOLDER = AUTOSAVE_CONFIG.option("save_to_folder", default=True, cast=boo
 MAP_FOLDER_SUFFIX = AUTOSAVE_CONFIG.option("map_folder_suffix", default="_BAK")
 DELETE_AFTER = AUTOSAVE_CONFIG.option("delete_after", default="30days", cast=cast_duration)
 DATE_FORMAT = AUTOSAVE_CONFIG.option("date_format", default="%Y%m%d-%H%M")
+FULL_SAVE_EVERY = AUTOSAVE_CONFIG.option("full_save_every", default=12, cast=int)
+STORAGE = AUTOSAVE_CONFIG.option("storage", default="files")
+
+MAP_COLUMNS = 512 * 512
+DELTA_EXTENSION = ".delta"
+DELTA_MAGIC = b"VXLDELTA"
+DELTA_HEADER = struct.Struct("<8sIH")  # magic, number in the chain, length of the base name
+MANIFEST_EXTENSION = ".manifest"
+MANIFEST_MAGIC = "VXLCHUNKS"
+CHUNK_FOLDER = "chunks"
+CHUNK_COLUMNS = 4 * 512  # four rows of the map
+
+log = Logger()
 
 
 @command(admin_only=True)
@@ -66,14 +113,212 @@ def save(connection):
     Manually save the map
     /save
     """
-    connection.protocol.write_map_file()
-    return "Map saved."
+    deferred = connection.protocol.write_map_file()
+    if deferred is None:
+        return "The map is being saved already."
+
+    def report(message):
+        if not connection.disconnected:
+            connection.send_chat(message)
+    deferred.addCallback(report)
+    return "Saving map..."
 
 
 def get_map_dir():
     return os.path.join(config.config_dir, "maps")
 
 
+def write_file(path, data):
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def split_columns(data):
+    """Returns the offsets of the map columns in VXL data, followed by its length."""
+    offsets = array("I", [0])
+    unpack = struct.unpack_from
+    pos = 0
+    for _ in range(MAP_COLUMNS):
+        length, start, end = unpack("<BBB", data, pos)
+        while length:
+            pos += length * 4
+            length, start, end = unpack("<BBB", data, pos)
+        pos += (end - start + 2) * 4
+        offsets.append(pos)
+    return offsets
+
+
+def pack_delta(base, number, data, offsets, old_data, old_offsets):
+    """
+    Returns a delta save holding the columns of data that differ from old_data,
+    and the number of these columns.
+    """
+    body = []
+    for i in range(MAP_COLUMNS):
+        column = data[offsets[i]:offsets[i + 1]]
+        if column != old_data[old_offsets[i]:old_offsets[i + 1]]:
+            body.append(struct.pack("<II", i, len(column)))
+            body.append(column)
+    count = len(body) // 2
+    name = base.encode("utf-8")
+    return (DELTA_HEADER.pack(DELTA_MAGIC, number, len(name)) + name +
+            zlib.compress(struct.pack("<I", count) + b"".join(body)), count)
+
+
+def read_delta_header(path):
+    """Returns the name of the full save a delta save builds on and its number in the chain."""
+    with open(path, "rb") as f:
+        magic, number, name_length = DELTA_HEADER.unpack(f.read(DELTA_HEADER.size))
+        if magic != DELTA_MAGIC:
+            raise ValueError("{0} is not a delta save".format(path))
+        return f.read(name_length).decode("utf-8"), number
+
+
+def read_delta(path):
+    """Returns the changed columns of a delta save by their index."""
+    with open(path, "rb") as f:
+        magic, number, name_length = DELTA_HEADER.unpack(f.read(DELTA_HEADER.size))
+        body = zlib.decompress(f.read()[name_length:])
+    columns = {}
+    pos = 4
+    for _ in range(struct.unpack_from("<I", body)[0]):
+        i, length = struct.unpack_from("<II", body, pos)
+        pos += 8
+        columns[i] = body[pos:pos + length]
+        pos += length
+    return columns
+
+
+def restore_save(path):
+    """
+    Returns the VXL data of a save. A delta save is rebuilt from its full save
+    and the delta saves up to it, which have to be in the same folder.
+    """
+    if path.endswith(MANIFEST_EXTENSION):
+        return read_chunk_save(path)
+    if not path.endswith(DELTA_EXTENSION):
+        with open(path, "rb") as f:
+            return f.read()
+    folder = os.path.dirname(path)
+    base, number = read_delta_header(path)
+    chain = {}
+    for f in fnmatch.filter(os.listdir(folder), "*" + DELTA_EXTENSION):
+        delta_path = os.path.join(folder, f)
+        delta_base, delta_number = read_delta_header(delta_path)
+        if delta_base == base and delta_number <= number:
+            chain[delta_number] = delta_path
+    missing = [str(n) for n in range(1, number + 1) if n not in chain]
+    if missing:
+        raise ValueError("delta saves {0} of {1} are missing".format(", ".join(missing), base))
+    with open(os.path.join(folder, base), "rb") as f:
+        data = f.read()
+    offsets = split_columns(data)
+    columns = [data[offsets[i]:offsets[i + 1]] for i in range(MAP_COLUMNS)]
+    for n in range(1, number + 1):
+        for i, column in read_delta(chain[n]).items():
+            columns[i] = column
+    return b"".join(columns)
+
+
+def write_save(path, data, chain):
+    """
+    Writes data as a full save, or as the next delta save of chain. Returns the
+    column offsets of data and the number of columns written.
+    """
+    offsets = split_columns(data)
+    if chain is None:
+        write_file(path, data)
+        return offsets, MAP_COLUMNS
+    delta, count = pack_delta(chain.base, chain.number + 1, data, offsets,
+                              chain.data, chain.offsets)
+    write_file(path, delta)
+    return offsets, count
+
+
+def get_chunk_path(folder, key):
+    return os.path.join(folder, CHUNK_FOLDER, key[:2], key)
+
+
+def read_manifest(path):
+    """Returns the hashes of the chunks of a chunk save."""
+    with open(path, "rb") as f:
+        lines = f.read().decode("ascii").split()
+    if not lines or lines[0] != MANIFEST_MAGIC:
+        raise ValueError("{0} is not a chunk save".format(path))
+    return lines[1:]
+
+
+def write_chunk_save(path, data):
+    """
+    Writes data as a chunk save, storing the chunks that are not stored yet.
+    Returns the number of chunks stored.
+    """
+    folder = os.path.dirname(path)
+    offsets = split_columns(data)
+    keys = []
+    count = 0
+    for i in range(0, MAP_COLUMNS, CHUNK_COLUMNS):
+        chunk = data[offsets[i]:offsets[i + CHUNK_COLUMNS]]
+        key = hashlib.sha1(chunk).hexdigest()
+        chunk_path = get_chunk_path(folder, key)
+        if not os.path.isfile(chunk_path):
+            if not os.path.isdir(os.path.dirname(chunk_path)):
+                os.makedirs(os.path.dirname(chunk_path))
+            write_file(chunk_path, zlib.compress(chunk))
+            count += 1
+        keys.append(key)
+    write_file(path, "\n".join([MANIFEST_MAGIC] + keys + [""]).encode("ascii"))
+    return count
+
+
+def read_chunk_save(path):
+    chunks = []
+    for key in read_manifest(path):
+        with open(get_chunk_path(os.path.dirname(path), key), "rb") as f:
+            chunk = zlib.decompress(f.read())
+        if hashlib.sha1(chunk).hexdigest() != key:
+            raise ValueError("chunk {0} of {1} is damaged".format(key, path))
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def remove_unused_chunks(folder):
+    """Removes the chunks no chunk save in folder refers to. Returns how many were removed."""
+    used = set()
+    for f in fnmatch.filter(os.listdir(folder), "*" + MANIFEST_EXTENSION):
+        used.update(read_manifest(os.path.join(folder, f)))
+    count = 0
+    chunk_folder = os.path.join(folder, CHUNK_FOLDER)
+    if not os.path.isdir(chunk_folder):
+        return count
+    for prefix in os.listdir(chunk_folder):
+        for key in os.listdir(os.path.join(chunk_folder, prefix)):
+            if key not in used:
+                os.remove(os.path.join(chunk_folder, prefix, key))
+                count += 1
+    return count
+
+
+class SaveChain:
+    """The last save of a map, with the full save the following delta saves build on."""
+
+    def __init__(self, map_name, base, data, offsets):
+        self.map_name = map_name
+        self.base = base
+        self.number = 0
+        self.data = data
+        self.offsets = offsets
+
+
 @command(admin_only=True)
 def recentsaves(connection):
     """
@@ -98,6 +343,8 @@ def apply_script(protocol, connection, config):
     class AutoMapSaveProtocol(protocol):
         autosave = True
         activity = False
+        saving = False
+        save_chain = None
 
         def __init__(self, *arg, **kwargs):
             protocol.__init__(self, *arg, **kwargs)
@@ -120,21 +367,113 @@ def apply_script(protocol, connection, config):
             return joined
 
         def write_map_file(self):
-            newfile = "{0}.{1}.vxl".format(self.map_info.rot_info.name,
-                                           strftime(DATE_FORMAT.get(), localtime()))
-            open(os.path.join(self.get_map_path(), newfile), "wb").write(self.map.generate())
+            if self.saving:
+                return None
+            self.saving = True
+            map_name = self.map_info.rot_info.name
+            chain = self.save_chain
+            if chain is not None and (chain.map_name != map_name or
+                                      chain.number >= FULL_SAVE_EVERY.get()):
+                chain = None
+            if STORAGE.get() == "chunks":
+                chain = None
+                newfile = self.get_save_name(MANIFEST_EXTENSION)
+            else:
+                newfile = self.get_save_name(".vxl" if chain is None else DELTA_EXTENSION)
+            start = default_timer()
+            data = self.map.generate()
+            stall = default_timer() - start
+            path = os.path.join(self.get_map_path(), newfile)
+            if newfile.endswith(MANIFEST_EXTENSION):
+                deferred = threads.deferToThread(write_chunk_save, path, data)
+            elif FULL_SAVE_EVERY.get() > 0:
+                deferred = threads.deferToThread(write_save, path, data, chain)
+            else:
+                deferred = threads.deferToThread(write_file, path, data)
+            deferred.addCallbacks(self.on_map_file_written, self.on_map_file_failed,
+                                  callbackArgs=(newfile, start, stall, map_name, chain, data),
+                                  errbackArgs=(newfile,))
+            return deferred
+
+        def get_save_name(self, extension):
+            name = "{0}.{1}".format(self.map_info.rot_info.name,
+                                    strftime(DATE_FORMAT.get(), localtime()))
+            newfile = name + extension
+            n = 1
+            # delta saves refer to the saves before them, never replace one
+            while os.path.exists(os.path.join(self.get_map_path(), newfile)):
+                newfile = "{0}-{1}{2}".format(name, n, extension)
+                n += 1
+            return newfile
+
+        def on_map_file_written(self, result, newfile, start, stall, map_name, chain, data):
+            self.saving = False
+            message = "Map saved to {0} (took {1:.0f} ms, server held up {2:.0f} ms).".format(
+                newfile, (default_timer() - start) * 1000, stall * 1000)
+            if newfile.endswith(MANIFEST_EXTENSION):
+                message += " {0} new chunks stored.".format(result)
+            elif result is not None:
+                offsets, count = result
+                if chain is None:
+                    self.save_chain = SaveChain(map_name, newfile, data, offsets)
+                else:
+                    chain.number += 1
+                    chain.data = data
+                    chain.offsets = offsets
+                    message += " {0} columns changed.".format(count)
+            log.info(message)
             if DELETE_AFTER.get() > 0:
                 self.delete_old_maps()
+            return message
+
+        def on_map_file_failed(self, failure, newfile):
+            self.saving = False
+            log.failure("Saving map to {newfile} failed", failure, newfile=newfile)
+            return "Saving map to {0} failed: {1}".format(newfile, failure.getErrorMessage())
 
         def get_maps_list(self):
-            return fnmatch.filter(os.listdir(self.get_map_path()),
-                                  self.map_info.rot_info.name + ".*.vxl")
+            files = os.listdir(self.get_map_path())
+            name = self.map_info.rot_info.name
+            return (fnmatch.filter(files, name + ".*.vxl") +
+                    fnmatch.filter(files, name + ".*" + DELTA_EXTENSION) +
+                    fnmatch.filter(files, name + ".*" + MANIFEST_EXTENSION))
 
         def delete_old_maps(self):
+            # a full save and its delta saves are removed together
+            chains = {}
+            removed = []
             for f in self.get_maps_list():
                 pf = os.path.join(self.get_map_path(), f)
-                if os.path.isfile(pf) and os.stat(pf).st_mtime < time() - (DELETE_AFTER.get()):
-                    os.remove(pf)
+                if not os.path.isfile(pf):
+                    continue
+                base = f
+                if f.endswith(DELTA_EXTENSION):
+                    try:
+                        base = read_delta_header(pf)[0]
+                    except (IOError, ValueError, struct.error):
+                        pass
+                chains.setdefault(base, []).append(pf)
+            for files in chains.values():
+                if all(os.stat(pf).st_mtime < time() - (DELETE_AFTER.get()) for pf in files):
+                    for pf in files:
+                        os.remove(pf)
+                    removed.extend(files)
+            if fnmatch.filter(removed, "*" + MANIFEST_EXTENSION):
+                self.collect_chunks()
+
+        def collect_chunks(self):
+            # no save may store chunks while the unused ones are removed
+            self.saving = True
+            deferred = threads.deferToThread(remove_unused_chunks, self.get_map_path())
+            deferred.addCallbacks(self.on_chunks_collected, self.on_chunks_failed)
+
+        def on_chunks_collected(self, count):
+            self.saving = False
+            log.info("{count} unused chunks removed.", count=count)
+
+        def on_chunks_failed(self, failure):
+            self.saving = False
+            log.failure("Removing unused chunks failed", failure)
 
     class AutoMapSaveConnection(connection):
         def on_team_join(self, team):
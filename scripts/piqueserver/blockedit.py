@@ -0,0 +1,106 @@
+"""
+blockedit.py by IAmYourFriend https://github.com/1AmYF
+
+blockedit.py holds BlockEdit, the batched block changes shared by botstc,
+survive, multibuild and buildersapper. It is not a script of its own, put it
+into the scripts folder, the scripts that use it load it from there.
+
+A BlockEdit collects block changes and applies them at once. Every block is
+changed at most once (the last change wins), the map is updated in one pass,
+builds are sent with one SetColor per color and the entities are updated once
+per commit. Floating blocks are checked once for the whole region after all
+removals, instead of once for every removed block.
+"""
+
+from pyspades.contained import BlockAction, SetColor
+from pyspades.common import make_color
+from pyspades.constants import *
+
+NEIGHBORS = ((0, 0, -1), (0, -1, 0), (0, 1, 0), (-1, 0, 0), (1, 0, 0), (0, 0, 1))
+
+
+class BlockEdit:
+    """
+    Collects block changes and applies them at once. Building on a solid block
+    removes it and builds it again in the new color.
+    """
+
+    def __init__(self, protocol, player_id=32):
+        self.protocol = protocol
+        self.player_id = player_id
+        self.builds = {}
+        self.removals = {}
+
+    def build(self, x, y, z, color):
+        self.removals.pop((x, y, z), None)
+        self.builds[(x, y, z)] = tuple(color)
+
+    def remove(self, x, y, z):
+        self.builds.pop((x, y, z), None)
+        self.removals[(x, y, z)] = True
+
+    def commit(self):
+        """Applies the changes, returns the removed and the built blocks."""
+        protocol = self.protocol
+        map = protocol.map
+        block_action = BlockAction()
+        block_action.player_id = self.player_id
+        removed = []
+        built = []
+        block_action.value = DESTROY_BLOCK
+        for x, y, z in self.removals:
+            if not map.get_solid(x, y, z):
+                continue
+            map.remove_point(x, y, z)
+            block_action.x = x
+            block_action.y = y
+            block_action.z = z
+            protocol.broadcast_contained(block_action, save=True)
+            removed.append((x, y, z))
+        for x, y, z in get_region_border(removed):
+            if map.get_solid(x, y, z):
+                map.check_node(x, y, z, True)
+        colors = {}
+        for point, color in self.builds.items():
+            if map.get_solid(*point) is not None:
+                colors.setdefault(color, []).append(point)
+        set_color = SetColor()
+        set_color.player_id = self.player_id
+        for color, points in colors.items():
+            set_color.value = make_color(*color)
+            protocol.broadcast_contained(set_color, save=True)
+            for x, y, z in points:
+                block_action.x = x
+                block_action.y = y
+                block_action.z = z
+                if map.get_solid(x, y, z):
+                    # clients only take the new color of a block built again
+                    block_action.value = DESTROY_BLOCK
+                    protocol.broadcast_contained(block_action, save=True)
+                map.set_point(x, y, z, color)
+                block_action.value = BUILD_BLOCK
+                protocol.broadcast_contained(block_action, save=True)
+                built.append((x, y, z))
+        self.builds.clear()
+        self.removals.clear()
+        if removed or built:
+            protocol.update_entities()
+        return removed, built
+
+
+def get_region_border(points):
+    """
+    Returns the blocks next to the given blocks that can fall down once the
+    given blocks are removed, each once.
+    """
+    points = set(points)
+    border = set()
+    for x, y, z in points:
+        if z >= 62:
+            continue
+        for dx, dy, dz in NEIGHBORS:
+            node = (x + dx, y + dy, z + dz)
+            if (node not in points and 0 <= node[0] < 512 and 0 <= node[1] < 512 and
+                    0 <= node[2] < 62):
+                border.add(node)
+    return border
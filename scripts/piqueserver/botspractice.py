@@ -7,6 +7,9 @@ ammo. The bot creation code is derived from basicbot.py by hompy.
 
 Setup:
 
+    Put botengine.py, the engine shared by the bot gamemodes, into the scripts folder
+    (it is not added to the script list, the gamemode loads it).
+
     Set game_mode in your server config to "botspractice" (in the serverlist, the
     name of the gamemode will be shown as "bots").
     The bot spawn area and size can be defined individually for maps using map
@@ -25,15 +28,19 @@ Commands:
         Toggle the activity of the bots.
 """
 
-from math import cos, sin
-from enet import Address
-from pyspades.contained import InputData, SetTool, WeaponInput
 from pyspades.server import Territory
-from pyspades.common import Vertex3
-from pyspades.collision import vector_collision
 from pyspades.constants import *
-from piqueserver.commands import command, get_team
+from piqueserver.commands import command
+from piqueserver.config import config
+from piqueserver.extensions import load_scripts
 from random import uniform, randint, choice
+import os.path
+
+# botengine.py, the engine shared by the bot gamemodes, is loaded from the scripts folder
+botengine = load_scripts(["botengine"], os.path.join(config.config_dir, "scripts"), "script")[0]
+INPUT_CROUCH = botengine.INPUT_CROUCH
+INPUT_JUMP = botengine.INPUT_JUMP
+INPUT_UP = botengine.INPUT_UP
 
 BOT_NAME = "Target"
 BOT_AMOUNT = 16
@@ -45,58 +52,15 @@ PUBLIC_MODE_NAME = "bots"
 ORIENTATIONS = [(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0)]
 
 
-@command(admin_only=True)
-def addbot(connection, amount=None, team=None):
-    """
-    Manually add bots
-    /addbot <amount> <team>
-    """
-    protocol = connection.protocol
-    if team:
-        bot_team = get_team(connection, team)
-    blue, green = protocol.blue_team, protocol.green_team
-    amount = int(amount or 1)
-    for i in range(amount):
-        if not team:
-            bot_team = blue if blue.count() < green.count() else green
-        bot = protocol.add_bot(bot_team)
-        if not bot:
-            return "Added %s bot(s)" % i
-    return "Added %s bot(s)" % amount
-
-
-@command(admin_only=True)
-def toggleai(connection):
-    """
-    Toggle the activity of the bots
-    /toggleai
-    """
-    protocol = connection.protocol
-    protocol.ai_enabled = not protocol.ai_enabled
-    if not protocol.ai_enabled:
-        for bot in protocol.bots:
-            bot.flush_input()
-    state = "enabled" if protocol.ai_enabled else "disabled"
-    protocol.broadcast_chat("AI %s!" % state)
-    protocol.irc_say("* %s %s AI" % (connection.name, state))
-
-
-class LocalPeer:
-    address = Address(str.encode("localhost"), 0)
-    roundTripTime = 0.0
-
-    def send(self, *arg, **kw):
-        pass
-
-    def reset(self):
-        pass
+for bot_command in (botengine.addbot, botengine.toggleai):
+    command(admin_only=True)(bot_command)
 
 
 def apply_script(protocol, connection, config):
+    protocol, connection = botengine.apply_script(protocol, connection, config)
+
     class PracticeProtocol(protocol):
         game_mode = TC_MODE
-        bots = None
-        ai_enabled = True
 
         has_humans = False
         orientation_chooser = 0
@@ -104,14 +68,6 @@ def apply_script(protocol, connection, config):
         bots_spawn_range = 0
         fixed_area = [0, 0, 0, 0]
 
-        def add_bot(self, team):
-            if len(self.connections) + len(self.bots) >= 32:
-                return None
-            bot = self.connection_class(self, None)
-            bot.join_game(team)
-            self.bots.append(bot)
-            return bot
-
         def on_world_update(self):
             if self.bots and self.ai_enabled:
                 for bot in self.bots:
@@ -169,9 +125,7 @@ def apply_script(protocol, connection, config):
             return
 
     class PracticeConnection(connection):
-        aim = None
         aim_at = None
-        input = None
         acquire_targets = True
         activity_counter = 0
         max_count = 100
@@ -179,41 +133,17 @@ def apply_script(protocol, connection, config):
         prev_position_x = 0
         prev_position_y = 0
 
-        _turn_speed = None
-        _turn_vector = None
-
-        def _get_turn_speed(self):
-            return self._turn_speed
-
-        def _set_turn_speed(self, value):
-            self._turn_speed = value
-            self._turn_vector = Vertex3(cos(value), sin(value), 0.0)
-
-        turn_speed = property(_get_turn_speed, _set_turn_speed)
-
-        def __init__(self, protocol, peer):
-            if peer is not None:
-                return connection.__init__(self, protocol, peer)
-            self.local = True
-            self.rapid_hack_detect = False
-            self.speedhack_detect = False
-            connection.__init__(self, protocol, LocalPeer())
-            self.on_connect()
-            self._send_connection_data()
-            self.send_map()
-
-            self.aim = Vertex3()
-            self.target_orientation = Vertex3()
-            self.turn_speed = 0.15  # rads per tick
-            self.input = set()
-
-        def join_game(self, team):
-            self.name = BOT_NAME + str(self.player_id)
-            self.team = team
-            self.set_weapon(randint(0, 2), True)
-            self.protocol.players[(self.player_id)] = self
-            self.on_login(self.name)
-            self.spawn()
+        def get_bot_name(self):
+            return BOT_NAME + str(self.player_id)
+
+        def get_bot_weapon(self):
+            return randint(0, 2)
+
+        def filter_input(self, input):
+            z_vel = self.world_object.velocity.z
+            if input & INPUT_JUMP and not (z_vel >= 0.0 and z_vel < 0.017):
+                input &= ~INPUT_JUMP
+            return input
 
         def on_spawn_location(self, pos):
             if self.team is self.protocol.blue_team:
@@ -230,20 +160,6 @@ def apply_script(protocol, connection, config):
                 return x, y, self.protocol.map.get_z(x, y) - 3
             return connection.on_spawn_location(self, pos)
 
-        def on_fall(self, damage):
-            if self.local:
-                return False
-            connection.on_fall(self, damage)
-
-        def disconnect(self, data=0):
-            if not self.local:
-                return connection.disconnect(self)
-            if self.disconnected:
-                return
-            self.protocol.bots.remove(self)
-            self.disconnected = True
-            self.on_disconnect()
-
         def update(self):
             obj = self.world_object
             pos = obj.position
@@ -259,11 +175,11 @@ def apply_script(protocol, connection, config):
                     else:
                         self.stuck_counter = 0
                 if self.stuck_counter == 4:
-                    self.input.add("jump")
+                    self.state.input |= INPUT_JUMP
                 elif self.stuck_counter == 8:
                     obj.set_orientation(ori.x * -1, ori.y * -1, 0)
-                    self.input.add("up")
-                    self.input.discard("crouch")
+                    self.state.input |= INPUT_UP
+                    self.state.input &= ~INPUT_CROUCH
                     turned = True
                     self.stuck_counter += 1
                 elif self.stuck_counter == 30:
@@ -273,10 +189,10 @@ def apply_script(protocol, connection, config):
                 else:
                     return
                 if not turned:
-                    randact = choice(["up", "up", "up", "up", "crouch", None])
-                    self.input.add(randact)
+                    randact = choice([INPUT_UP, INPUT_UP, INPUT_UP, INPUT_UP, INPUT_CROUCH, 0])
+                    self.state.input |= randact
                     if (randint(0, 6) == 3):
-                        self.input.add("jump")
+                        self.state.input |= INPUT_JUMP
 
                 if (not turned and obj.position.x < self.protocol.fixed_area[0] and
                         ori.x != 1 or obj.position.y < self.protocol.fixed_area[1] and
@@ -284,83 +200,13 @@ def apply_script(protocol, connection, config):
                         ori.x != -1 or obj.position.y > self.protocol.fixed_area[3] and
                         ori.y != -1):
                     obj.set_orientation(ori.x * -1, ori.y * -1, 0)
-                    self.input.add("up")
-                    self.input.discard("crouch")
+                    self.state.input |= INPUT_UP
+                    self.state.input &= ~INPUT_CROUCH
                 self.prev_position_x = obj.position.x
                 self.prev_position_y = obj.position.y
 
             self.flush_input()
 
-        def flush_input(self):
-            input = self.input
-            world_object = self.world_object
-            z_vel = world_object.velocity.z
-            if "jump" in input and not (z_vel >= 0.0 and z_vel < 0.017):
-                input.discard("jump")
-            input_changed = not (
-                ("up" in input) == world_object.up and
-                ("down" in input) == world_object.down and
-                ("left" in input) == world_object.left and
-                ("right" in input) == world_object.right and
-                ("jump" in input) == world_object.jump and
-                ("crouch" in input) == world_object.crouch and
-                ("sneak" in input) == world_object.sneak and
-                ("sprint" in input) == world_object.sprint)
-            if input_changed:
-                if not self.freeze_animation:
-                    world_object.set_walk("up" in input, "down" in input,
-                                          "left" in input, "right" in input)
-                    world_object.set_animation("jump" in input, "crouch" in input,
-                                               "sneak" in input, "sprint" in input)
-                if (not self.filter_visibility_data and
-                        not self.filter_animation_data):
-                    input_data = InputData()
-                    input_data.player_id = self.player_id
-                    input_data.up = world_object.up
-                    input_data.down = world_object.down
-                    input_data.left = world_object.left
-                    input_data.right = world_object.right
-                    input_data.jump = world_object.jump
-                    input_data.crouch = world_object.crouch
-                    input_data.sneak = world_object.sneak
-                    input_data.sprint = world_object.sprint
-                    self.protocol.broadcast_contained(input_data)
-            primary = "primary_fire" in input
-            secondary = "secondary_fire" in input
-            shoot_changed = not (
-                primary == world_object.primary_fire and
-                secondary == world_object.secondary_fire)
-            if shoot_changed:
-                if primary != world_object.primary_fire:
-                    if self.tool == WEAPON_TOOL:
-                        self.weapon_object.set_shoot(primary)
-                    if self.tool == WEAPON_TOOL or self.tool == SPADE_TOOL:
-                        self.on_shoot_set(primary)
-                world_object.primary_fire = primary
-                world_object.secondary_fire = secondary
-                if not self.filter_visibility_data:
-                    weapon_input = WeaponInput()
-                    weapon_input.player_id = self.player_id
-                    weapon_input.primary = primary
-                    weapon_input.secondary = secondary
-                    self.protocol.broadcast_contained(weapon_input)
-            input.clear()
-
-        def set_tool(self, tool):
-            if self.on_tool_set_attempt(tool) is False:
-                return
-            self.tool = tool
-            if self.tool == WEAPON_TOOL:
-                self.on_shoot_set(self.world_object.primary_fire)
-                self.weapon_object.set_shoot(self.world_object.primary_fire)
-            self.on_tool_changed(self.tool)
-            if self.filter_visibility_data:
-                return
-            set_tool = SetTool()
-            set_tool.player_id = self.player_id
-            set_tool.value = self.tool
-            self.protocol.broadcast_contained(set_tool)
-
         def on_team_join(self, team):
             if not self.local:
                 self.protocol.has_humans = True
@@ -370,7 +216,7 @@ def apply_script(protocol, connection, config):
             if not self.local:
                 missing_bots = BOT_AMOUNT - len(self.protocol.bots)
                 if missing_bots > 0:
-                    addbot(self, missing_bots, "green")
+                    botengine.addbot(self, missing_bots, "green")
             if not self.local:
                 return connection.on_spawn(self, pos)
             if self.protocol.orientation_chooser >= len(ORIENTATIONS):
@@ -392,27 +238,4 @@ def apply_script(protocol, connection, config):
                 self.protocol.has_humans = False
             connection.on_disconnect(self)
 
-        def _send_connection_data(self):
-            if self.local:
-                if self.player_id is None:
-                    self.player_id = self.protocol.player_ids.pop()
-                return
-            connection._send_connection_data(self)
-
-        def send_map(self, data=None):
-            if self.local:
-                self.on_join()
-                return
-            connection.send_map(self, data)
-
-        def timer_received(self, value):
-            if self.local:
-                return
-            connection.timer_received(self, value)
-
-        def send_loader(self, loader, ack=False, byte=0):
-            if self.local:
-                return
-            return connection.send_loader(self, loader, ack, byte)
-
     return PracticeProtocol, PracticeConnection
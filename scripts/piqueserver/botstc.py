@@ -14,6 +14,10 @@ Parts of the code are derived from the survive gamemode.
 
 Setup:
 
+    Put botengine.py, the engine shared by the bot gamemodes, and blockedit.py into
+    the scripts folder (they are not added to the script list, the gamemode loads
+    them).
+
     Set game_mode in your server config to "botstc" (in the serverlist, the name
     of the gamemode will be shown as "bots") and add maps that were made for this
     mode to the rotation.
@@ -28,12 +32,40 @@ Setup:
                                 (195, 356), (404, 195), (200, 183), (359, 331)]
         }
 
+    Bots do not target humans standing in the safe zone around blue_spawn. By
+    default this is a square of 10x10 blocks, maps can define their own zones
+    with 'safe_zones', a list of rectangles (x1, y1, x2, y2) and polygons
+    [(x, y), (x, y), (x, y), ...]. Example:
+
+            'safe_zones' : [(85, 405, 105, 425),
+                            [(105, 410), (120, 395), (130, 405), (115, 420)]]
+
+    Bots only think (pick a target, check the line of sight, find their way) once
+    every few world updates, spread evenly over the bots, while turning and moving
+    still happens on every update. Set bot_think_rate in your server config to the
+    number of world updates between two thinks of a bot (default 3, use 1 to let
+    every bot think on every update).
+
+    If the bots take too long on the world updates, the amount of bots is reduced
+    and the bots respawn slower until the server has headroom again, admins are
+    notified of every change. Set bot_tick_budget in your server config to the
+    milliseconds the bots may take per world update (default 8, the 95th
+    percentile over 5 seconds is compared), use 0 to disable this.
+
 Commands:
 
     /addbot <amount> <team>
         Manually add bots.
     /toggleai
         Toggle the activity of the bots.
+    /loscache
+        Show the hit rate and the time saved by the line of sight cache.
+    /batchai
+        Switch the bots between the per-bot brain and the NumPy batch brain, which
+        handles all bots at once (requires numpy).
+    /aiperf <on|off>
+        Start profiling the bots. While profiling, show the time spent in each step
+        of the bots and the most expensive bots. Use "off" to stop profiling.
     /difficulty <index>
         Force a new difficulty (using the index number of the difficulties list).
     /easy
@@ -44,21 +76,31 @@ Commands:
         Vote for hard difficulty (if voting is enabled).
 """
 
-from pyspades.contained import InputData, SetTool, WeaponInput, BlockAction
 from pyspades.server import Territory
-from pyspades.common import Vertex3
-from pyspades.collision import vector_collision
 from pyspades.constants import *
-from piqueserver.commands import command, get_team
+from piqueserver.commands import command
 from piqueserver.config import config
-from enet import Address
+from piqueserver.extensions import load_scripts
 from twisted.internet.task import LoopingCall
-from math import cos, sin, floor, isnan
+from math import floor, ceil
 from collections import Counter
+from timeit import default_timer
 import os.path
 import random
 import time
 
+# botengine.py, the engine shared by the bot gamemodes, is loaded from the scripts folder
+botengine = load_scripts(["botengine"], os.path.join(config.config_dir, "scripts"), "script")[0]
+INPUT_JUMP = botengine.INPUT_JUMP
+INPUT_PRIMARY_FIRE = botengine.INPUT_PRIMARY_FIRE
+INPUT_SPRINT = botengine.INPUT_SPRINT
+INPUT_UP = botengine.INPUT_UP
+MELEE_DISTANCE = botengine.MELEE_DISTANCE
+# blockedit.py, the batched block changes shared with other scripts, is loaded from the
+# scripts folder
+blockedit = load_scripts(["blockedit"], os.path.join(config.config_dir, "scripts"), "script")[0]
+BlockEdit = blockedit.BlockEdit
+
 BOT_NAME = "Bot"
 BOT_ATTACK_DAMAGE = 50
 BLUE_SPAWN_RADIUS = 5
@@ -81,41 +123,9 @@ BOTS_DIFFICULTIES = [
     ("Suicide", 32, 8, 1, 100)
 ]
 
-
-@command(admin_only=True)
-def addbot(connection, amount=None, team=None):
-    """
-    Manually add bots
-    /addbot <amount> <team>
-    """
-    protocol = connection.protocol
-    if team:
-        bot_team = get_team(connection, team)
-    blue, green = protocol.blue_team, protocol.green_team
-    amount = int(amount or 1)
-    for i in range(amount):
-        if not team:
-            bot_team = blue if blue.count() < green.count() else green
-        bot = protocol.add_bot(bot_team)
-        if not bot:
-            return "Added %s bot(s)" % i
-    return "Added %s bot(s)" % amount
-
-
-@command(admin_only=True)
-def toggleai(connection):
-    """
-    Toggle the activity of the bots
-    /toggleai
-    """
-    protocol = connection.protocol
-    protocol.ai_enabled = not protocol.ai_enabled
-    if not protocol.ai_enabled:
-        for bot in protocol.bots:
-            bot.flush_input()
-    state = "enabled" if protocol.ai_enabled else "disabled"
-    protocol.broadcast_chat("AI %s!" % state)
-    protocol.irc_say("* %s %s AI" % (connection.name, state))
+for bot_command in (botengine.addbot, botengine.toggleai, botengine.loscache,
+                    botengine.batchai, botengine.aiperf):
+    command(admin_only=True)(bot_command)
 
 
 @command(admin_only=True)
@@ -257,26 +267,65 @@ def check_for_difficulty_change(protocol, ignore_player_id=None):
     return False
 
 
-class LocalPeer:
-    address = Address(str.encode("localhost"), 0)
-    roundTripTime = 0.0
-
-    def send(self, *arg, **kw):
-        pass
+class SafeZone:
+    """
+    Area where humans are safe from the bots, either a rectangle given as
+    (x1, y1, x2, y2) or a polygon given as a list of (x, y) points.
+    """
 
-    def reset(self):
-        pass
+    def __init__(self, shape):
+        if len(shape) == 4 and not isinstance(shape[0], (tuple, list)):
+            x1, y1, x2, y2 = shape
+            self.points = None
+            self.x1, self.x2 = min(x1, x2), max(x1, x2)
+            self.y1, self.y2 = min(y1, y2), max(y1, y2)
+        else:
+            self.points = [(float(x), float(y)) for x, y in shape]
+            self.x1 = min(x for x, y in self.points)
+            self.x2 = max(x for x, y in self.points)
+            self.y1 = min(y for x, y in self.points)
+            self.y2 = max(y for x, y in self.points)
+
+    def contains(self, x, y):
+        if x < self.x1 or x >= self.x2 or y < self.y1 or y >= self.y2:
+            return False
+        if self.points is None:
+            return True
+        inside = False
+        x0, y0 = self.points[-1]
+        for x1, y1 in self.points:
+            if (y1 > y) != (y0 > y) and x < x1 + (y - y1) * (x0 - x1) / (y0 - y1):
+                inside = not inside
+            x0, y0 = x1, y1
+        return inside
+
+    def get_columns(self):
+        for x in range(int(self.x1), int(ceil(self.x2))):
+            for y in range(int(self.y1), int(ceil(self.y2))):
+                if self.contains(x + 0.5, y + 0.5):
+                    yield x, y
+
+
+def get_safe_zones(extensions, blue_spawn):
+    shapes = extensions.get("safe_zones", None)
+    if not shapes:
+        sx, sy = blue_spawn
+        shapes = [(sx - BLUE_SPAWN_RADIUS, sy - BLUE_SPAWN_RADIUS,
+                   sx + BLUE_SPAWN_RADIUS, sy + BLUE_SPAWN_RADIUS)]
+    return [SafeZone(shape) for shape in shapes]
 
 
 def apply_script(protocol, connection, config):
+    protocol, connection = botengine.apply_script(protocol, connection, config)
+
     class BotsTcProtocol(protocol):
         game_mode = TC_MODE
-        bots = None
-        ai_enabled = True
         placeof = 3
 
         bots_difficulty = BOTS_DIFFICULTIES[int(config.get("bots_difficulty", 2))]
         blue_spawn = None
+        safe_zones = None
+        humans_at_spawn = None
         spawn_center = None
         bots_spawn = None
         bots_spawn_range = 0
@@ -284,14 +333,8 @@ def apply_script(protocol, connection, config):
         maploadtimestamp = None
         capturingplayers = []
         last_vote_success_secs = None
-
-        def add_bot(self, team):
-            if len(self.connections) + len(self.bots) >= 32:
-                return None
-            bot = self.connection_class(self, None)
-            bot.join_game(team)
-            self.bots.append(bot)
-            return bot
+        bot_think_rate = max(1, int(config.get("bot_think_rate", 3)))
+        bot_tick_budget = float(config.get("bot_tick_budget", 8))
 
         def on_world_update(self):
             if self.loop_count % 7200 == 0:
@@ -299,27 +342,100 @@ def apply_script(protocol, connection, config):
                     self.placeof = 0
                 else:
                     self.placeof += 1
+            # builds the height field after a map change, then the flow fields
+            self.navigator.update(self.loop_count)
+            if (not self.spawn_index.is_started() and
+                    self.navigator.heightfield.is_complete()):
+                self.spawn_index.start(self.get_spawn_anchors())
+            self.spawn_index.update()
+            bot_time = 0.0
             if self.bots and self.ai_enabled:
-                for bot in self.bots:
-                    bot.update()
+                # the governor only weighs the bots, not the map work like the
+                # spawn index and flow fields built after a map change
+                start = default_timer()
+                self.update_snapshot()
+                think_rate = self.bot_think_rate
+                if self.batch_brain is not None:
+                    self.batch_brain.think(self.snapshot, [
+                        bot for i, bot in enumerate(self.bots)
+                        if (self.loop_count + i) % think_rate == 0])
+                    self.batch_brain.update(self.bots)
+                else:
+                    self.update_target_grids()
+                    self.update_bots()
+                bot_time = default_timer() - start
             protocol.on_world_update(self)
+            if self.bots is not None:
+                self.update_governor(bot_time)
+
+        def get_bot_amount(self):
+            """Bots wanted for the current players, before the governor limit."""
+            min_bots = self.bots_difficulty[1]
+            add_bots_per_player = self.bots_difficulty[2]
+            bot_amount = int(min_bots + (self.blue_team.count() *
+                             add_bots_per_player) - add_bots_per_player)
+            if bot_amount > BOTS_MAX:
+                bot_amount = BOTS_MAX
+            elif bot_amount < min_bots:
+                bot_amount = min_bots
+            return bot_amount
+
+        def fit_bot_amount(self):
+            bot_amount = self.governor.limit(self.get_bot_amount())
+            def is_alive(bot):
+                return bot.world_object is not None and not bot.world_object.dead
+            # remove dead bots first, nobody notices them leaving
+            for bot in sorted(self.bots, key=is_alive):
+                if len(self.bots) <= bot_amount:
+                    break
+                bot.disconnect()
+            if self.blue_team.count() > 0 and not self.gameisfinished:
+                for i in range(bot_amount - len(self.bots)):
+                    if not self.add_bot(self.green_team):
+                        break
+
+        def get_profiled_methods(self):
+            targets = protocol.get_profiled_methods(self)
+            targets.append((botengine.FlowFieldNavigator, "update", "flow fields", False))
+            targets.append((botengine.SpawnIndex, "update", "spawn index", False))
+            targets.append((botengine.BatchBrain, "think", "batch think", False))
+            targets.append((botengine.BatchBrain, "update", "batch update", False))
+            return targets
+
+        def get_spawn_anchors(self):
+            anchors = [self.spawn_center, self.blue_spawn]
+            for spot in self.bots_spawn or []:
+                anchors.append(spot[:2])
+            for entity in self.entities or []:
+                anchors.append((entity.x, entity.y))
+            return anchors
+
+        def update_snapshot(self):
+            snapshot = self.snapshot
+            snapshot.clear()
+            at_spawn = self.humans_at_spawn
+            at_spawn.clear()
+            for player in self.players.values():
+                if player.world_object is not None and player.team is not None:
+                    if self.is_at_spawn(player):
+                        at_spawn.add(player)
+                    snapshot.add(player, player in at_spawn)
+            self.crowd.build(snapshot)
+
+        def is_at_spawn(self, player):
+            if player is not None and player.team == self.blue_team:
+                px, py, pz = player.world_object.position.get()
+                for zone in self.safe_zones:
+                    if zone.contains(px, py):
+                        return True
+            return False
 
         def mark_spawn_ground(self):
-            x_offset = self.blue_spawn[0] - BLUE_SPAWN_RADIUS
-            y_offset = self.blue_spawn[1] - BLUE_SPAWN_RADIUS
-            for x in range(x_offset, x_offset + (BLUE_SPAWN_RADIUS * 2)):
-                for y in range(y_offset, y_offset + (BLUE_SPAWN_RADIUS * 2)):
-                    z = self.map.get_z(x, y)
-                    self.map.set_point(x, y, z, SPAWN_ZONE_COLOR)
-                    block_action = BlockAction()
-                    block_action.x = x
-                    block_action.y = y
-                    block_action.z = z
-                    block_action.player_id = 32
-                    block_action.value = DESTROY_BLOCK
-                    self.broadcast_contained(block_action, save=True)
-                    block_action.value = BUILD_BLOCK
-                    self.broadcast_contained(block_action, save=True)
+            edit = BlockEdit(self)
+            for zone in self.safe_zones:
+                for x, y in zone.get_columns():
+                    edit.build(x, y, self.map.get_z(x, y), SPAWN_ZONE_COLOR)
+            edit.commit()
 
         def reset_game(self, player=None, territory=None):
             self.gameisfinished = True
@@ -349,10 +465,22 @@ def apply_script(protocol, connection, config):
             self.building = False
             self.gameisfinished = False
             self.blue_spawn = self.map_info.extensions.get("blue_spawn", (128, 384))
+            self.safe_zones = get_safe_zones(self.map_info.extensions, self.blue_spawn)
+            self.humans_at_spawn = set()
             self.spawn_center = self.map_info.extensions.get("spawn_center", (255, 255))
             self.bots_spawn = self.map_info.extensions.get("bots_spawn", None)
             self.bots_spawn_range = self.map_info.extensions.get("bots_spawn_range", 150)
             self.bots = []
+            self.snapshot = botengine.WorldSnapshot()
+            self.crowd = botengine.CrowdMap()
+            self.los_cache = botengine.LineOfSightCache()
+            self.navigator = botengine.FlowFieldNavigator(map)
+            self.spawn_index = botengine.SpawnIndex(self.navigator.heightfield)
+            if self.governor is None:
+                self.governor = botengine.PopulationGovernor(self.bot_tick_budget)
+            self.governor.times.clear()
+            self.target_grids = {self.blue_team.id: botengine.TargetGrid(),
+                                 self.green_team.id: botengine.TargetGrid()}
             self.mark_spawn_ground()
             self.maploadtimestamp = get_now_in_secs()
             self.capturingplayers = []
@@ -388,56 +516,17 @@ def apply_script(protocol, connection, config):
             return entities
 
     class BotsTcConnection(connection):
-        aim = None
-        last_aim = None
-        aim_at = None
-        input = None
         grenade_call = None
-        ticks_stumped = 0
-        ticks_stumped2 = 0
-        ticks_stumped3 = 0
-        last_pos = None
-        distance_to_aim = None
-        jump_count = 0
-        spade_count = 0
-        sec = 15
-        sec2 = 15
         nature = None
-        discar = 0
         knock = 4
+        melee_damage = BOT_ATTACK_DAMAGE
 
         spawn_time = 0
         voted_difficulty = None
         last_vote_time_secs = None
 
-        _turn_speed = None
-        _turn_vector = None
-
-        def _get_turn_speed(self):
-            return self._turn_speed
-
-        def _set_turn_speed(self, value):
-            self._turn_speed = value
-            self._turn_vector = Vertex3(cos(value), sin(value), 0.0)
-
-        turn_speed = property(_get_turn_speed, _set_turn_speed)
-
-        def __init__(self, protocol, peer):
-            if peer is not None:
-                return connection.__init__(self, protocol, peer)
-            self.local = True
-            self.rapid_hack_detect = False
-            self.speedhack_detect = False
-            connection.__init__(self, protocol, LocalPeer())
-            self.on_connect()
-            self._send_connection_data()
-            self.send_map()
-
-            self.aim = Vertex3()
-            self.target_orientation = Vertex3()
-            self.last_pos = Vertex3()
-            self.turn_speed = 0.15  # rads per tick
-            self.input = set()
+        def get_bot_name(self):
+            return BOT_NAME + str(self.player_id)
 
         def on_connect(self):
             if not self.local and len(self.protocol.connections) <= 1:
@@ -445,14 +534,6 @@ def apply_script(protocol, connection, config):
                 self.protocol.bots_difficulty = BOTS_DIFFICULTIES[2]
             connection.on_connect(self)
 
-        def join_game(self, team):
-            self.name = BOT_NAME + str(self.player_id)
-            self.team = team
-            self.set_weapon(RIFLE_WEAPON, True)
-            self.protocol.players[(self.player_id)] = self
-            self.on_login(self.name)
-            self.spawn()
-
         def on_login(self, name):
             # prevent players from picking reserved bot name
             if (not self.local and len(name) > len(BOT_NAME) and
@@ -462,287 +543,68 @@ def apply_script(protocol, connection, config):
                 self.disconnect()
             return connection.on_login(self, name)
 
-        def disconnect(self, data=0):
-            if not self.local:
-                return connection.disconnect(self)
-            if self.disconnected:
-                return
-            self.protocol.bots.remove(self)
-            self.disconnected = True
-            self.on_disconnect()
-
-        def is_at_spawn(self, player):
-            if player is not None and player.team == player.protocol.blue_team:
-                sx = player.protocol.blue_spawn[0]
-                sy = player.protocol.blue_spawn[1]
-                px, py, pz = player.world_object.position.get()
-                if (px < sx + BLUE_SPAWN_RADIUS and px > sx - BLUE_SPAWN_RADIUS and
-                        py < sy + BLUE_SPAWN_RADIUS and py > sy - BLUE_SPAWN_RADIUS):
-                    return True
-            return False
-
         def relocate_stuck_bot(self, bot):
             me_x = bot.world_object.position.x - 0.5
             me_y = bot.world_object.position.y - 0.5
             bot.set_location_safe((me_x, me_y, self.protocol.map.get_z(me_x, me_y) - 10))
 
-        def update(self):
-            obj = self.world_object
-            ori = obj.orientation
-            pos = obj.position
+        def can_think(self):
+            return not (self.world_object.dead or
+                        self.spawn_time + ACTIVITY_DELAY_SECS >= get_now_in_secs())
 
-            if (self.world_object.dead or
-                    self.spawn_time + ACTIVITY_DELAY_SECS >= get_now_in_secs()):
+        def think(self):
+            self.state.held_input = None
+            if not self.can_think():
                 return
-
-            for i in self.team.other.get_players():
-                if ((i.world_object) and (not i.world_object.dead) and
-                        (not i.god) and (not self.is_at_spawn(i))):
-                    some = Vertex3()
-                    some.set_vector(i.world_object.position)
-                    some -= pos
-                    distance_to_new_aim = some.normalize()
-                    if (self.distance_to_aim is not None and
-                            distance_to_new_aim < self.distance_to_aim):
-                        self.aim_at = i
-                        self.last_aim = None
-
-            if self.aim_at and self.aim_at.world_object:
-                real_aim_at_pos = self.aim_at.world_object.position
-                if obj.can_see(self.aim_at.world_object.position.x,
-                               self.aim_at.world_object.position.y,
-                               self.aim_at.world_object.position.z):
-                    aim_at_pos = self.aim_at.world_object.position
-                    self.last_aim = Vertex3()
-                    self.last_aim.set_vector(aim_at_pos)
-                else:
-                    if self.last_aim is None:
-                        aim_at_pos = self.aim_at.world_object.position
-                    else:
-                        aim_at_pos = self.last_aim
-                self.aim.set_vector(aim_at_pos)
-                self.aim -= pos
-                self.distance_to_aim = self.aim.normalize()
-                self.input.add("up")
-                self.input.add("sprint")
-                self.last_pos -= pos
-                moved = Vertex3()
-                moved.set_vector(self.last_pos)
-                distance_moved = self.last_pos.length_sqr()
-                self.last_pos.set_vector(pos)
-
-                if self.distance_to_aim <= 2.0:
-                    self.target_orientation.set_vector(self.aim)
-                    self.input.discard("sprint")
-                    self.input.add("primary_fire")
-                    self.left_spade()
-                else:
-                    some = Vertex3()
-                    some.x, some.y, some.z = self.aim.x, self.aim.y, 0
-                    self.target_orientation.set_vector(some)
-
-                if ((self.world_object.velocity.z != 0 and
-                        abs(floor(aim_at_pos.x) - floor(pos.x)) <= 10 and
-                        abs(floor(aim_at_pos.y) - floor(pos.y)) <= 10) or
-                        (abs(floor(aim_at_pos.x) - floor(pos.x)) <= 1 and
-                         abs(floor(aim_at_pos.y) - floor(pos.y)) <= 1)):
-                    try:
-                        if aim_at_pos == self.aim_at.world_object.position:
-                            if pos.z > aim_at_pos.z:
-                                self.input.add("jump")
-                                self.ticks_stumped3 += 1
-                                self.sec = 15
-                                self.ticks_stumped = 0
-                                self.ticks_stumped2 = 0
-                                if self.ticks_stumped3 >= self.sec2:
-                                    self.sec2 += 15
-                                    self.relocate_stuck_bot(self)
-                            elif (pos.z < aim_at_pos.z and
-                                  abs(floor(aim_at_pos.x) - floor(pos.x) <= 1) and
-                                  abs(floor(aim_at_pos.y) - floor(pos.y)) <= 1):
-                                self.ticks_stumped3 += 1
-                                if self.ticks_stumped3 >= self.sec2:
-                                    self.sec2 += 15
-                        else:
-                            self.last_aim = None
-                    except AttributeError:
-                        self.last_aim = None
-                else:
-                    self.sec2 = 15
-                    self.ticks_stumped3 = 0
-                    if (moved.x == 0) or (moved.y == 0):
-                        self.input.discard("sprint")
-                        self.ticks_stumped += 1
-                        self.input.add("jump")
-                        # prevent them from getting stuck in blocks:
-                        if self.ticks_stumped > 600:
-                            self.relocate_stuck_bot(self)
-                        if (self.ticks_stumped >= self.sec):
-                            if self.sec % 30 == 0:
-                                i = 1
-                            else:
-                                if floor(aim_at_pos.z) < floor(pos.z):  # up
-                                    i = 0
-                                elif floor(aim_at_pos.z) > floor(pos.z):  # down
-                                    i = 2
-                                elif floor(aim_at_pos.z) == floor(pos.z):
-                                    i = 1
-                            self.sec += 15
-                            self.relocate_stuck_bot(self)
-                    else:
-                        self.sec = 15
-                        self.ticks_stumped = 0
-                        self.ticks_stumped2 = 0
+            self.choose_target()
+            aim = self.get_aim_point()
+            if aim is not None:
+                aim_x, aim_y, aim_z, aim_is_target = aim
+                self.state.aim.set(aim_x, aim_y, aim_z)
+                self.state.aim -= self.world_object.position
+                self.distance_to_aim = self.state.aim.normalize()
+                self.act(aim_x, aim_y, aim_z, aim_is_target,
+                         self.distance_to_aim <= MELEE_DISTANCE)
             else:
                 self.last_aim = None
                 self.distance_to_aim = float("inf")
-
-            # orientate towards target
-            diff = ori - self.target_orientation
-            diff.z = 0.0
-            diff = diff.length_sqr()
-            if diff > 0.001:
-                p_dot = ori.perp_dot(self.target_orientation)
-                if p_dot > 0.0:
-                    ori.rotate(self._turn_vector)
-                else:
-                    ori.unrotate(self._turn_vector)
-                new_p_dot = ori.perp_dot(self.target_orientation)
-                if new_p_dot * p_dot < 0.0:
-                    ori.set_vector(self.target_orientation)
-            else:
-                ori.set_vector(self.target_orientation)
-
-            obj.set_orientation(*ori.get())
-            self.flush_input()
-
-        def flush_input(self):
-            input = self.input
-            world_object = self.world_object
-            pos = world_object.position
-            if not self.world_object.dead:
-                if self.local:
-                    for i in self.team.get_players():
-                        if (i.world_object) and (not i.world_object.dead) and (not i == self):
-                            pos2 = i.world_object.position
-                            if floor(pos2.x) == floor(pos.x) and floor(pos2.y) == floor(pos.y):
-                                if self.protocol.loop_count % 30 == 0:
-                                    self.discar = random.randint(-3, 10)
-                                elif self.discar == 3 or self.discar == 4 or self.discar == 5:
-                                    input.add("left")
-                                elif self.discar == 6 or self.discar == 7 or self.discar == 8:
-                                    input.add("right")
-                                elif self.discar == 9:
-                                    input.add("right")
-                                    input.discard("up")
-                                elif self.discar == 10:
-                                    input.add("left")
-                                    input.discard("up")
-                                break
-                    if self.protocol.loop_count - self.jump_count < 30:
-                        input.discard("jump")
-                    else:
-                        self.jump_count = self.protocol.loop_count
-
-                input_changed = not (
-                    ("up" in input) == world_object.up and
-                    ("down" in input) == world_object.down and
-                    ("left" in input) == world_object.left and
-                    ("right" in input) == world_object.right and
-                    ("jump" in input) == world_object.jump and
-                    ("crouch" in input) == world_object.crouch and
-                    ("sneak" in input) == world_object.sneak and
-                    ("sprint" in input) == world_object.sprint)
-                if input_changed:
-                    if not self.freeze_animation:
-                        if ("sprint" in input) and ("jump" not in input):
-                            m_x = self.aim.x + pos.x
-                            m_y = self.aim.y + pos.y
-                            m_z = pos.z
-                            if not isnan(m_x) and not isnan(m_y) and not isnan(m_z):
-                                if not self.protocol.map.get_solid(m_x, m_y, m_z):
-                                    self.set_location((m_x, m_y, m_z))
-
-                        world_object.set_walk("up" in input, "down" in input,
-                                              "left" in input, "right" in input)
-                        world_object.set_animation("jump" in input, "crouch" in input,
-                                                   "sneak" in input, "sprint" in input)
-                    if (not self.filter_visibility_data and
-                            not self.filter_animation_data):
-                        input_data = InputData()
-                        input_data.player_id = self.player_id
-                        input_data.up = world_object.up
-                        input_data.down = world_object.down
-                        input_data.left = world_object.left
-                        input_data.right = world_object.right
-                        input_data.jump = world_object.jump
-                        input_data.crouch = world_object.crouch
-                        input_data.sneak = world_object.sneak
-                        input_data.sprint = world_object.sprint
-                        self.protocol.broadcast_contained(input_data)
-                primary = "primary_fire" in input
-                secondary = "secondary_fire" in input
-                shoot_changed = not (primary == world_object.primary_fire and
-                                     secondary == world_object.secondary_fire)
-                if shoot_changed:
-                    if primary != world_object.primary_fire:
-                        if self.tool == WEAPON_TOOL:
-                            self.weapon_object.set_shoot(primary)
-                        if self.tool == WEAPON_TOOL or self.tool == SPADE_TOOL:
-                            self.on_shoot_set(primary)
-                    world_object.primary_fire = primary
-                    world_object.secondary_fire = secondary
-                    if not self.filter_visibility_data:
-                        weapon_input = WeaponInput()
-                        weapon_input.player_id = self.player_id
-                        weapon_input.primary = primary
-                        weapon_input.secondary = secondary
-                        self.protocol.broadcast_contained(weapon_input)
-                input.clear()
-
-        def set_tool(self, tool):
-            if self.on_tool_set_attempt(tool) is False:
-                return
-            self.tool = tool
-            if self.tool == WEAPON_TOOL:
-                self.on_shoot_set(self.world_object.fire)
-                self.weapon_object.set_shoot(self.world_object.fire)
-            self.on_tool_changed(self.tool)
-            if self.filter_visibility_data:
-                return
-            set_tool = SetTool()
-            set_tool.player_id = self.player_id
-            set_tool.value = self.tool
-            self.protocol.broadcast_contained(set_tool)
-
-        def left_spade(self):
-            obj = self.world_object
-            pos = obj.position
-            ori = obj.orientation
-            if self.world_object.dead:
-                return
-            if self.protocol.loop_count - self.spade_count < 24:
-                return
+            self.state.held_input = self.state.input
+
+        def act(self, aim_x, aim_y, aim_z, aim_is_target, in_reach):
+            pos = self.world_object.position
+            self.state.input |= INPUT_UP
+            self.state.input |= INPUT_SPRINT
+
+            if in_reach:
+                self.state.target_orientation.set_vector(self.state.aim)
+                self.state.input &= ~INPUT_SPRINT
+                self.state.input |= INPUT_PRIMARY_FIRE
+                self.left_spade()
             else:
-                self.spade_count = self.protocol.loop_count
-            for player in self.team.other.get_players():
-                if (player.world_object) and (not player.world_object.dead):
-                    if ((vector_collision(pos, player.world_object.position, 3)) and
-                            (obj.validate_hit(player.world_object, MELEE, 5, 5))):
-                        hit_amount = BOT_ATTACK_DAMAGE
-                        type = MELEE_KILL
-                        self.on_hit(hit_amount, player, type, None)
-                        player.hit(hit_amount, self, type)
-                        # knockback
-                        if not player.local:
-                            player.input = set()
-                            player.input.add("jump")
-                            player.flush_input()
+                self.steer(aim_x, aim_y)
+
+            if ((self.world_object.velocity.z != 0 and
+                    abs(floor(aim_x) - floor(pos.x)) <= 10 and
+                    abs(floor(aim_y) - floor(pos.y)) <= 10) or
+                    (abs(floor(aim_x) - floor(pos.x)) <= 1 and
+                     abs(floor(aim_y) - floor(pos.y)) <= 1)):
+                if aim_is_target:
+                    if pos.z > aim_z:
+                        self.state.input |= INPUT_JUMP
+                else:
+                    self.last_aim = None
+            # prevent them from getting stuck in blocks:
+            if self.protocol.map.get_solid(pos.x, pos.y, pos.z):
+                self.relocate_stuck_bot(self)
+
+        def filter_input(self, input):
+            return connection.filter_input(self, self.avoid_crowd(input))
 
         def on_spawn(self, pos):
             if self.local:
                 self.spawn_time = get_now_in_secs()
-                self.respawn_time = self.protocol.bots_difficulty[3]
+                self.respawn_time = (self.protocol.bots_difficulty[3] +
+                                     self.protocol.governor.respawn_delay)
                 if self.protocol.bots_difficulty[4] != 100:
                     self.set_hp(self.protocol.bots_difficulty[4])
             elif not self.protocol.gameisfinished:
@@ -751,17 +613,10 @@ def apply_script(protocol, connection, config):
 
             # add bots depending on amount of human players
             if not self.protocol.gameisfinished:
-                min_bots = self.protocol.bots_difficulty[1]
-                add_bots_per_player = self.protocol.bots_difficulty[2]
-                bot_amount = int(min_bots + (self.protocol.blue_team.count() *
-                                 add_bots_per_player) - add_bots_per_player)
-                if bot_amount > BOTS_MAX:
-                    bot_amount = BOTS_MAX
-                elif bot_amount < min_bots:
-                    bot_amount = min_bots
+                bot_amount = self.protocol.governor.limit(self.protocol.get_bot_amount())
                 missing_bots = bot_amount - len(self.protocol.bots)
                 if not self.local and missing_bots > 0:
-                        addbot(self, missing_bots, self.protocol.green_team.name)
+                        botengine.addbot(self, missing_bots, self.protocol.green_team.name)
                 if self.local and missing_bots < 0:
                         self.disconnect()
                         return
@@ -771,13 +626,9 @@ def apply_script(protocol, connection, config):
             self.world_object.set_orientation(1.0, 0.0, 0.0)
             self.set_tool(SPADE_TOOL)
             self.aim_at = None
-            self.spade_count = 0
-            self.jump_count = 0
-            self.sec = 15
-            self.sec2 = 15
-            self.ticks_stumped = 0
-            self.ticks_stumped2 = 0
-            self.ticks_stumped3 = 0
+            self.state.held_input = None
+            self.state.spade_count = 0
+            self.state.jump_count = 0
             self.last_pos.set(*pos)
             connection.on_spawn(self, pos)
 
@@ -796,12 +647,14 @@ def apply_script(protocol, connection, config):
                         x, y = spot
                     else:
                         x, y, z = spot
-                x += random.randint(-self.protocol.bots_spawn_range,
-                                    self.protocol.bots_spawn_range)
-                y += random.randint(-self.protocol.bots_spawn_range,
-                                    self.protocol.bots_spawn_range)
+                spawn_range = self.protocol.bots_spawn_range
                 if z < 0:
+                    x, y = self.protocol.get_spawn_point(x - spawn_range, y - spawn_range,
+                                                         x + spawn_range, y + spawn_range)
                     z = self.protocol.map.get_z(x, y) - 3
+                else:
+                    x += random.randint(-spawn_range, spawn_range)
+                    y += random.randint(-spawn_range, spawn_range)
                 return x, y, z
             return connection.on_spawn_location(self, pos)
 
@@ -828,11 +681,6 @@ def apply_script(protocol, connection, config):
                         bot.aim_at = None
             connection.on_kill(self, killer, type, grenade)
 
-        def on_fall(self, damage):
-            if self.local:
-                return False
-            connection.on_fall(self, damage)
-
         def on_flag_take(self):
             if not self.team == self.protocol.blue_team:
                 return False
@@ -843,27 +691,23 @@ def apply_script(protocol, connection, config):
                 return False
             return connection.on_block_destroy(self, x, y, z, mode)
 
-        def _send_connection_data(self):
-            if self.local:
-                if self.player_id is None:
-                    self.player_id = self.protocol.player_ids.pop()
-                return
-            connection._send_connection_data(self)
-
-        def send_map(self, data=None):
-            if self.local:
-                self.on_join()
-                return
-            connection.send_map(self, data)
-
-        def timer_received(self, value):
-            if self.local:
-                return
-            connection.timer_received(self, value)
-
-        def send_loader(self, loader, acyk=False, byte=0):
-            if self.local:
-                return
-            return connection.send_loader(self, loader, ack, byte)
+        def on_block_build(self, x, y, z):
+            self.protocol.los_cache.invalidate(x, y, z)
+            self.protocol.navigator.on_block_changed(x, y)
+            self.protocol.spawn_index.on_block_changed(x, y)
+            return connection.on_block_build(self, x, y, z)
+
+        def on_line_build(self, points):
+            for x, y, z in points:
+                self.protocol.los_cache.invalidate(x, y, z)
+                self.protocol.navigator.on_block_changed(x, y)
+                self.protocol.spawn_index.on_block_changed(x, y)
+            return connection.on_line_build(self, points)
+
+        def on_block_removed(self, x, y, z):
+            self.protocol.los_cache.invalidate(x, y, z)
+            self.protocol.navigator.on_block_changed(x, y)
+            self.protocol.spawn_index.on_block_changed(x, y)
+            return connection.on_block_removed(self, x, y, z)
 
     return BotsTcProtocol, BotsTcConnection
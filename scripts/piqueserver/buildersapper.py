@@ -10,6 +10,11 @@ On first join a random mode is assigned. Modes can be switched with commands.
 Use server settings to change how many refills a player can have.
 Originally written to use with build-focused gamemodes like Babel or Push.
 
+Setup:
+
+    Put blockedit.py into the scripts folder (it is not added to the script
+    list, buildersapper loads it).
+
 Config Options:
 
     [buildersapper]
@@ -30,11 +35,17 @@ Commands:
 """
 
 from pyspades.constants import *
-from pyspades.common import make_color
 from pyspades import contained as loaders
 from piqueserver.commands import command
 from piqueserver.config import config
+from piqueserver.extensions import load_scripts
 from random import choice
+import os.path
+
+# blockedit.py, the batched block changes shared with other scripts, is loaded from the
+# scripts folder
+blockedit = load_scripts(["blockedit"], os.path.join(config.config_dir, "scripts"), "script")[0]
+BlockEdit = blockedit.BlockEdit
 
 BUILDER_HEAL_RATE = 5
 SAPPER_HIT_AMOUNT = 0.6
@@ -87,23 +98,6 @@ def is_invalid_coord(x, y, z):
     return x < 0 or y < 0 or z < 0 or x > 511 or y > 511 or z > 61
 
 
-def build_block(connection, x, y, z, color):
-    if is_invalid_coord(x, y, z):
-        return
-    set_color = loaders.SetColor()
-    set_color.value = make_color(*color)
-    set_color.player_id = 32
-    connection.protocol.broadcast_contained(set_color)
-    block_action = loaders.BlockAction()
-    block_action.player_id = 32
-    block_action.x = x
-    block_action.y = y
-    block_action.z = z
-    block_action.value = BUILD_BLOCK
-    connection.protocol.map.set_point(x, y, z, color)
-    connection.protocol.broadcast_contained(block_action, save=True)
-
-
 def build_grenade_structure(connection, position):
     x = int(position.x)
     y = int(position.y)
@@ -113,9 +107,13 @@ def build_grenade_structure(connection, position):
                  (x, y - 1, z - 1), (x, y, z - 2), (x + 1, y, z - 2), (x - 1, y, z - 2),
                  (x, y + 1, z - 2), (x, y - 1, z - 2), (x, y, z - 3), (x + 1, y, z - 3),
                  (x - 1, y, z - 3), (x, y + 1, z - 3), (x, y - 1, z - 3)]
+    edit = BlockEdit(connection.protocol)
     for pos in structure:
+        if is_invalid_coord(*pos):
+            continue
         if connection.on_block_build_attempt(pos[0], pos[1], pos[2]) is not False:
-            build_block(connection, pos[0], pos[1], pos[2], connection.color)
+            edit.build(pos[0], pos[1], pos[2], connection.color)
+    edit.commit()
 
 
 def apply_script(protocol, connection, config):
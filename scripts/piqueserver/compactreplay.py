@@ -0,0 +1,170 @@
+"""
+compactreplay.py by IAmYourFriend https://github.com/1AmYF
+
+While a player downloads the map, everything other scripts send with save=True
+(block changes, colors, tools, joins) is kept for that player and replayed when
+the download is finished. On busy servers and maps with moving parts this piles
+up to thousands of packets per joining player.
+
+This script regularly compacts that history, and once more right before it is
+replayed. Block builds and removals are replaced by the current state of every
+block they touched (one packet per block, builds grouped by color) and colors
+that were changed again before they were used are dropped. Spade and grenade
+destroys, line builds and all other packets are kept in their order.
+
+Config Options:
+
+    [compactreplay]
+    # Interval to compact the history of players who download the map.
+    compact_interval = "5sec"
+
+    # Only compact histories with at least this many packets.
+    min_packets = 64
+
+Commands:
+
+    /replaystats
+        Show how much the histories were compacted.
+"""
+
+import struct
+from twisted.internet.task import LoopingCall
+from pyspades.constants import *
+from piqueserver.commands import command
+from piqueserver.config import config, cast_duration
+
+COMPACT_CONFIG = config.section("compactreplay")
+COMPACT_INTERVAL = COMPACT_CONFIG.option("compact_interval", default="5sec", cast=cast_duration)
+MIN_PACKETS = COMPACT_CONFIG.option("min_packets", default=64, cast=int)
+
+SET_COLOR_ID = 8
+EXISTING_PLAYER_ID = 9
+CREATE_PLAYER_ID = 12
+BLOCK_ACTION_ID = 13
+BLOCK_LINE_ID = 14
+PLAYER_LEFT_ID = 20
+SERVER_PLAYER_ID = 32  # used by scripts to build blocks in any color
+BLOCK_ACTION = struct.Struct("<BBBIII")
+SET_COLOR = struct.Struct("<BBBBB")
+
+
+@command(admin_only=True)
+def replaystats(connection):
+    """
+    Show how much the histories were compacted
+    /replaystats
+    """
+    return connection.protocol.replay_stats.get_report()
+
+
+class ReplayStats:
+    def __init__(self):
+        self.compactions = 0
+        self.packets_before = 0
+        self.packets_after = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def add(self, before, after):
+        self.compactions += 1
+        self.packets_before += len(before)
+        self.packets_after += len(after)
+        self.bytes_before += sum(len(data) for data in before)
+        self.bytes_after += sum(len(data) for data in after)
+
+    def get_report(self):
+        if not self.compactions:
+            return "No history compacted yet."
+        return ("Compacted %s times: %s to %s packets, %.1f to %.1f kB" % (
+            self.compactions, self.packets_before, self.packets_after,
+            self.bytes_before / 1024.0, self.bytes_after / 1024.0))
+
+
+def get_packet_id(data):
+    return ord(data[0:1])
+
+
+def get_player_id(data):
+    return ord(data[1:2])
+
+
+def compact_history(map, history):
+    """
+    Returns a shorter list of packets that leaves a player in the same state as
+    the given history, with the blocks as they are on the map now.
+    """
+    touched = {}
+    # colors of the server player are only used for the blocks built here
+    colors_set_later = set([SERVER_PLAYER_ID])
+    kept = []
+    for data in reversed(history):
+        packet_id = get_packet_id(data)
+        if packet_id == BLOCK_ACTION_ID:
+            block_id, player_id, value, x, y, z = BLOCK_ACTION.unpack(data)
+            if value in (BUILD_BLOCK, DESTROY_BLOCK):
+                touched[(x, y, z)] = touched.get((x, y, z), False) or value == DESTROY_BLOCK
+                continue
+        elif packet_id == SET_COLOR_ID:
+            player_id = get_player_id(data)
+            if player_id in colors_set_later:
+                continue
+            colors_set_later.add(player_id)
+        elif packet_id in (BLOCK_LINE_ID, EXISTING_PLAYER_ID, CREATE_PLAYER_ID,
+                           PLAYER_LEFT_ID):
+            colors_set_later.discard(get_player_id(data))
+        kept.append(data)
+    kept.reverse()
+
+    colors = {}
+    removed = []
+    for (x, y, z), destroyed in touched.items():
+        color = map.get_color(x, y, z)
+        if color is None:
+            removed.append((x, y, z))
+        else:
+            colors.setdefault(color, []).append((x, y, z, destroyed))
+    for color, blocks in colors.items():
+        r, g, b = color[:3]
+        kept.append(SET_COLOR.pack(SET_COLOR_ID, SERVER_PLAYER_ID, b, g, r))
+        for x, y, z, destroyed in blocks:
+            if destroyed:
+                # clients only take the new color of a block built again
+                kept.append(BLOCK_ACTION.pack(BLOCK_ACTION_ID, SERVER_PLAYER_ID,
+                                              DESTROY_BLOCK, x, y, z))
+            kept.append(BLOCK_ACTION.pack(BLOCK_ACTION_ID, SERVER_PLAYER_ID,
+                                          BUILD_BLOCK, x, y, z))
+    for x, y, z in removed:
+        kept.append(BLOCK_ACTION.pack(BLOCK_ACTION_ID, SERVER_PLAYER_ID,
+                                      DESTROY_BLOCK, x, y, z))
+    return kept
+
+
+def apply_script(protocol, connection, config):
+    class CompactReplayProtocol(protocol):
+        def __init__(self, *arg, **kwargs):
+            protocol.__init__(self, *arg, **kwargs)
+            self.replay_stats = ReplayStats()
+            self.compact_loop = LoopingCall(self.compact_histories)
+            self.compact_loop.start(COMPACT_INTERVAL.get(), now=False)
+
+        def compact_histories(self):
+            for player in list(self.connections.values()):
+                player.compact_history()
+
+    class CompactReplayConnection(connection):
+        def compact_history(self, min_packets=None):
+            history = self.saved_loaders
+            if min_packets is None:
+                min_packets = MIN_PACKETS.get()
+            if history is None or len(history) < min_packets or self.protocol.map is None:
+                return
+            compacted = compact_history(self.protocol.map, history)
+            self.protocol.replay_stats.add(history, compacted)
+            self.saved_loaders = compacted
+
+        def send_map(self, data=None):
+            if data is None and self.map_data is not None and not self.map_data.data_left():
+                self.compact_history(min_packets=2)
+            return connection.send_map(self, data)
+
+    return CompactReplayProtocol, CompactReplayConnection
@@ -6,6 +6,10 @@ gamemode, then revised and extended by IAmYourFriend https://github.com/1AmYF
 
 Setup:
 
+    Put botengine.py, the engine shared by the bot gamemodes, and blockedit.py into
+    the scripts folder (they are not added to the script list, the gamemode loads
+    them).
+
     Set game_mode in your server config to "survive". Set friendly_fire to "on_grief"
     to allow teamkilling of griefers.
     It is recommended to use maps that are open, mostly flat and not too high, to
@@ -24,26 +28,67 @@ Setup:
     When you add daycycle.py to your script list, zombies will become stronger at night
     (stronger at destructing blocks).
 
+    Stuck zombies dig a tunnel along the cheapest way through the blocks towards
+    their target, planned once for all zombies after the same area. Until the plan
+    is ready, they dig around themselves at random.
+
+    Bots only think (pick a target, check the line of sight, find their way) once
+    every few world updates, spread evenly over the bots, while turning and moving
+    still happens on every update. Set bot_think_rate in your server config to the
+    number of world updates between two thinks of a bot (default 3, use 1 to let
+    every bot think on every update).
+
+    If the bots take too long on the world updates, the amount of bots is reduced
+    and the bots respawn slower until the server has headroom again, admins are
+    notified of every change. Set bot_tick_budget in your server config to the
+    milliseconds the bots may take per world update (default 8, the 95th
+    percentile over 5 seconds is compared), use 0 to disable this.
+
 Commands:
 
     /addbot <amount> <team>
         Manually add bots.
     /toggleai
         Toggle the activity of the bots.
+    /loscache
+        Show the hit rate and the time saved by the line of sight cache.
+    /batchai
+        Switch the bots between the per-bot brain and the NumPy batch brain, which
+        handles all bots at once (requires numpy).
+    /aiperf <on|off>
+        Start profiling the bots. While profiling, show the time spent in each step
+        of the bots and the most expensive bots. Use "off" to stop profiling.
     /war
         Enable an alternative spawn setup where humans and zombies spawn from opposite
         corners of the map.
 """
 
-from pyspades.contained import InputData, SetTool, WeaponInput, BlockAction
 from pyspades.server import Territory
-from pyspades.common import Vertex3
-from pyspades.collision import vector_collision
 from pyspades.constants import *
-from piqueserver.commands import command, get_team
-from enet import Address
-from math import cos, sin, floor, isnan
+from piqueserver.commands import command
+from piqueserver.config import config
+from piqueserver.extensions import load_scripts
+from math import floor
+from array import array
+from heapq import heappush, heappop
+from timeit import default_timer
 import random
+import os.path
+
+# botengine.py, the engine shared by the bot gamemodes, is loaded from the scripts folder
+botengine = load_scripts(["botengine"], os.path.join(config.config_dir, "scripts"), "script")[0]
+INPUT_JUMP = botengine.INPUT_JUMP
+INPUT_PRIMARY_FIRE = botengine.INPUT_PRIMARY_FIRE
+INPUT_SPRINT = botengine.INPUT_SPRINT
+INPUT_UP = botengine.INPUT_UP
+MAP_SIZE = botengine.MAP_SIZE
+MELEE_DISTANCE = botengine.MELEE_DISTANCE
+NAV_CLUSTER_SIZE = botengine.NAV_CLUSTER_SIZE
+# blockedit.py, the batched block changes shared with other scripts, is loaded from the
+# scripts folder
+blockedit = load_scripts(["blockedit"], os.path.join(config.config_dir, "scripts"), "script")[0]
+BlockEdit = blockedit.BlockEdit
+NEIGHBORS = blockedit.NEIGHBORS
 
 BOT_DEFAULT_NAME = "Zombie"
 BOT_RESPAWN_TIME = 11
@@ -56,46 +101,25 @@ BOT_HIT_SHOTGUN = 0.23
 BOT_HIT_SPADE = 0.16
 BOT_BLOCK_BREAK_CHANCE = 80
 BOT_BLOCK_BREAK_CHANCE_STRONG = 20
+BOT_TUNNEL_RATE = 0.5  # blocks dug per dig along a planned tunnel
+BOT_TUNNEL_RATE_STRONG = 1.5
 BOTS_MIN = 5
 BOTS_MAX = 16
 BOTS_PER_PLAYER = 1
 HUMAN_SPAWN_RANGE = 128
+BOT_DIG_INTERVAL = 15  # world updates between digs of a stuck zombie
+BOT_STUCK_DISTANCE = 0.0001  # squared distance moved between two thinks
+TUNNEL_BAND = 8  # targets in the same 8x8x8 blocks share a tunnel plan
+TUNNEL_RADIUS = 12  # blocks searched around a target area
+TUNNEL_SOLID_COST = 4  # extra cost of every solid block a zombie digs through
+TUNNEL_BUDGET = 256  # cells expanded per world update
+TUNNEL_TTL = 300  # world updates an unused tunnel plan is kept
+TUNNEL_MAX_Z = 60  # a zombie is three blocks high and can't dig below z 61
+TUNNEL_UNREACHED = 0xFFFF
 
-
-@command(admin_only=True)
-def addbot(connection, amount=None, team=None):
-    """
-    Manually add bots
-    /addbot <amount> <team>
-    """
-    protocol = connection.protocol
-    if team:
-        bot_team = get_team(connection, team)
-    blue, green = protocol.blue_team, protocol.green_team
-    amount = int(amount or 1)
-    for i in range(amount):
-        if not team:
-            bot_team = blue if blue.count() < green.count() else green
-        bot = protocol.add_bot(bot_team)
-        if not bot:
-            return "Added %s bot(s)" % i
-    return "Added %s bot(s)" % amount
-
-
-@command(admin_only=True)
-def toggleai(connection):
-    """
-    Toggle the activity of the bots
-    /toggleai
-    """
-    protocol = connection.protocol
-    protocol.ai_enabled = not protocol.ai_enabled
-    if not protocol.ai_enabled:
-        for bot in protocol.bots:
-            bot.flush_input()
-    state = "enabled" if protocol.ai_enabled else "disabled"
-    protocol.broadcast_chat("AI %s!" % state)
-    protocol.irc_say("* %s %s AI" % (connection.name, state))
+for bot_command in (botengine.addbot, botengine.toggleai, botengine.loscache,
+                    botengine.batchai, botengine.aiperf):
+    command(admin_only=True)(bot_command)
 
 
 @command(admin_only=True)
@@ -112,48 +136,165 @@ def war(connection):
     protocol.broadcast_chat("War %s!" % state)
 
 
-def destroy_block(protocol, x, y, z):
-    if protocol.map.get_solid(x, y, z) is None:
-        return False
-    block_action = BlockAction()
-    block_action.value = DESTROY_BLOCK
-    block_action.player_id = 32
-    block_action.x = x
-    block_action.y = y
-    block_action.z = z
-    protocol.broadcast_contained(block_action, save=True)
-    protocol.update_entities()
-    return True
-
-
-class LocalPeer:
-    address = Address(str.encode("localhost"), 0)
-    roundTripTime = 0.0
+class TunnelPlan:
+    """
+    Cheapest way through the blocks towards one target area, as the cost to
+    reach the area from every cell in a box around it. A cell is where a zombie
+    stands (three blocks from its head down), entering it costs one plus
+    TUNNEL_SOLID_COST for every solid block in it. Like the flow fields, the
+    search is spread over several world updates and bots keep following the
+    last complete search until a new one is done.
+    """
 
-    def send(self, *arg, **kw):
-        pass
+    def __init__(self, map, area_x, area_y, area_z, radius=TUNNEL_RADIUS):
+        self.map = map
+        self.seed_x1 = area_x * NAV_CLUSTER_SIZE
+        self.seed_y1 = area_y * NAV_CLUSTER_SIZE
+        self.seed_z1 = area_z * TUNNEL_BAND
+        self.x1 = max(0, self.seed_x1 - radius)
+        self.y1 = max(0, self.seed_y1 - radius)
+        self.z1 = max(0, self.seed_z1 - radius)
+        self.x2 = min(MAP_SIZE, self.seed_x1 + NAV_CLUSTER_SIZE + radius)
+        self.y2 = min(MAP_SIZE, self.seed_y1 + NAV_CLUSTER_SIZE + radius)
+        self.z2 = min(TUNNEL_MAX_Z, self.seed_z1 + TUNNEL_BAND + radius)
+        self.width = self.x2 - self.x1
+        self.layer = self.width * (self.y2 - self.y1)
+        self.last_used = 0
+        self.ready = None
+        self.reset()
 
     def reset(self):
-        pass
+        self.costs = array('H', [TUNNEL_UNREACHED]) * (self.layer * (self.z2 - self.z1))
+        self.frontier = []
+        for z in range(self.seed_z1, min(self.z2, self.seed_z1 + TUNNEL_BAND)):
+            for y in range(self.seed_y1, self.seed_y1 + NAV_CLUSTER_SIZE):
+                for x in range(self.seed_x1, self.seed_x1 + NAV_CLUSTER_SIZE):
+                    index = self.get_index(x, y, z)
+                    self.costs[index] = 0
+                    self.frontier.append((0, index))
+
+    def contains(self, x, y, z):
+        return (self.x1 <= x < self.x2 and self.y1 <= y < self.y2 and
+                self.z1 <= z < self.z2)
+
+    def is_complete(self):
+        return not self.frontier
+
+    def get_index(self, x, y, z):
+        return (x - self.x1) + (y - self.y1) * self.width + (z - self.z1) * self.layer
+
+    def get_cell(self, index):
+        z, rest = divmod(index, self.layer)
+        y, x = divmod(rest, self.width)
+        return x + self.x1, y + self.y1, z + self.z1
+
+    def get_enter_cost(self, x, y, z):
+        get_solid = self.map.get_solid
+        solid = 0
+        for block_z in range(z, z + 3):
+            if get_solid(x, y, block_z):
+                solid += 1
+        return 1 + solid * TUNNEL_SOLID_COST
+
+    def expand(self, budget):
+        costs = self.costs
+        frontier = self.frontier
+        expanded = 0
+        while frontier and expanded < budget:
+            cost, index = heappop(frontier)
+            if cost > costs[index]:
+                continue  # reached cheaper in the meantime
+            expanded += 1
+            x, y, z = self.get_cell(index)
+            # the search runs backwards, a zombie next to this cell enters it
+            cost += self.get_enter_cost(x, y, z)
+            for dx, dy, dz in NEIGHBORS:
+                nx, ny, nz = x + dx, y + dy, z + dz
+                if not self.contains(nx, ny, nz):
+                    continue
+                next_index = self.get_index(nx, ny, nz)
+                if cost < costs[next_index]:
+                    costs[next_index] = cost
+                    heappush(frontier, (cost, next_index))
+        if not frontier:
+            self.ready = costs
+        return expanded
+
+    def get_step(self, x, y, z):
+        """
+        Returns the neighbouring cell that is cheapest to reach the target area
+        from, or None when the cell has not been reached by the search.
+        """
+        costs = self.ready
+        if costs is None or not self.contains(x, y, z):
+            return None
+        best = costs[self.get_index(x, y, z)]
+        if best == TUNNEL_UNREACHED or best == 0:
+            return None
+        step = None
+        for dx, dy, dz in NEIGHBORS:
+            nx, ny, nz = x + dx, y + dy, z + dz
+            if not self.contains(nx, ny, nz):
+                continue
+            cost = costs[self.get_index(nx, ny, nz)]
+            if cost < best:
+                best = cost
+                step = (nx, ny, nz)
+        return step
+
+
+class TunnelPlanner:
+    """
+    Keeps one tunnel plan per target area, shared by all zombies after it, and
+    shares the search budget between the plans. Plans are only made for zombies
+    that are stuck. Removed blocks only make a tunnel cheaper, so only built
+    blocks start the search over.
+    """
+
+    def __init__(self, map):
+        self.map = map
+        self.plans = {}
+
+    def get_plan(self, x, y, z, loop_count):
+        key = (int(x) // NAV_CLUSTER_SIZE, int(y) // NAV_CLUSTER_SIZE,
+               int(z) // TUNNEL_BAND)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = self.plans[key] = TunnelPlan(self.map, key[0], key[1], key[2])
+        plan.last_used = loop_count
+        return plan
+
+    def get_step(self, x, y, z, target_x, target_y, target_z, loop_count):
+        plan = self.get_plan(target_x, target_y, target_z, loop_count)
+        return plan.get_step(int(floor(x)), int(floor(y)), int(floor(z)))
+
+    def update(self, loop_count):
+        budget = TUNNEL_BUDGET
+        for key, plan in list(self.plans.items()):
+            if loop_count - plan.last_used > TUNNEL_TTL:
+                del self.plans[key]
+            elif budget > 0 and not plan.is_complete():
+                budget -= plan.expand(budget)
+
+    def on_block_built(self, x, y, z):
+        for plan in self.plans.values():
+            # a cell holds the blocks from its z down to z + 2
+            if plan.contains(x, y, z) or plan.contains(x, y, z - 2):
+                plan.reset()
 
 
 def apply_script(protocol, connection, config):
+    protocol, connection = botengine.apply_script(protocol, connection, config)
+
     class SurviveProtocol(protocol):
         game_mode = TC_MODE
-        bots = None
-        ai_enabled = True
         placeof = 3
         war = False
         strong = False
         bot_name = None
-
-        def add_bot(self, team):
-            if len(self.connections) + len(self.bots) >= 32:
-                return None
-            bot = self.connection_class(self, None)
-            bot.join_game(team)
-            self.bots.append(bot)
-            return bot
+        bot_think_rate = max(1, int(config.get("bot_think_rate", 3)))
+        bot_tick_budget = float(config.get("bot_tick_budget", 8))
+        tunnels = None
 
         def on_world_update(self):
             if self.loop_count % 7200 == 0:
@@ -161,10 +302,76 @@ def apply_script(protocol, connection, config):
                     self.placeof = 0
                 else:
                     self.placeof += 1
+            # builds the height field after a map change, then the flow fields
+            self.navigator.update(self.loop_count)
+            if (not self.spawn_index.is_started() and
+                    self.navigator.heightfield.is_complete()):
+                self.spawn_index.start(self.get_spawn_anchors())
+            self.spawn_index.update()
+            bot_time = 0.0
             if self.bots and self.ai_enabled:
-                for bot in self.bots:
-                    bot.update()
+                # the governor only weighs the bots and their tunnels, not the
+                # map work like the spawn index and flow fields built after a
+                # map change
+                start = default_timer()
+                self.tunnels.update(self.loop_count)
+                self.update_snapshot()
+                think_rate = self.bot_think_rate
+                if self.batch_brain is not None:
+                    self.batch_brain.think(self.snapshot, [
+                        bot for i, bot in enumerate(self.bots)
+                        if (self.loop_count + i) % think_rate == 0])
+                    self.batch_brain.update(self.bots)
+                else:
+                    self.update_target_grids()
+                    self.update_bots()
+                bot_time = default_timer() - start
             protocol.on_world_update(self)
+            if self.bots is not None:
+                self.update_governor(bot_time)
+
+        def get_bot_amount(self):
+            """Bots wanted for the current players, before the governor limit."""
+            blue_players = self.blue_team.count()
+            plus_bots = BOTS_PER_PLAYER
+            if blue_players <= 7 and BOTS_PER_PLAYER == 1 and BOTS_MAX == 16:
+                plus_bots = BOTS_PER_PLAYER + 1
+            bot_amount = blue_players + plus_bots
+            if bot_amount > BOTS_MAX:
+                bot_amount = BOTS_MAX
+            elif bot_amount < BOTS_MIN:
+                bot_amount = BOTS_MIN
+            return bot_amount
+
+        def fit_bot_amount(self):
+            bot_amount = self.governor.limit(self.get_bot_amount())
+            def is_alive(bot):
+                return bot.world_object is not None and not bot.world_object.dead
+            # remove dead bots first, nobody notices them leaving
+            for bot in sorted(self.bots, key=is_alive):
+                if len(self.bots) <= bot_amount:
+                    break
+                bot.disconnect()
+            if self.blue_team.count() > 0:
+                for i in range(bot_amount - len(self.bots)):
+                    if not self.add_bot(self.green_team):
+                        break
+
+        def get_profiled_methods(self):
+            targets = protocol.get_profiled_methods(self)
+            targets.append((self.connection_class, "dig", "dig", False))
+            targets.append((botengine.FlowFieldNavigator, "update", "flow fields", False))
+            targets.append((TunnelPlanner, "update", "tunnel plans", False))
+            targets.append((botengine.SpawnIndex, "update", "spawn index", False))
+            targets.append((botengine.BatchBrain, "think", "batch think", False))
+            targets.append((botengine.BatchBrain, "update", "batch update", False))
+            return targets
+
+        def get_spawn_anchors(self):
+            anchors = [(MAP_SIZE // 2, MAP_SIZE // 2)]
+            for entity in self.entities or []:
+                anchors.append((entity.x, entity.y))
+            return anchors
 
         def on_map_change(self, map):
             if self.max_players == 32:
@@ -173,6 +380,17 @@ def apply_script(protocol, connection, config):
             self.balanced_teams = 0
             self.respawn_waves = False
             self.bots = []
+            self.snapshot = botengine.WorldSnapshot()
+            self.crowd = botengine.CrowdMap()
+            self.los_cache = botengine.LineOfSightCache()
+            self.navigator = botengine.FlowFieldNavigator(map)
+            self.tunnels = TunnelPlanner(map)
+            self.spawn_index = botengine.SpawnIndex(self.navigator.heightfield)
+            if self.governor is None:
+                self.governor = botengine.PopulationGovernor(self.bot_tick_budget)
+            self.governor.times.clear()
+            self.target_grids = {self.blue_team.id: botengine.TargetGrid(),
+                                 self.green_team.id: botengine.TargetGrid()}
             self.bot_name = self.map_info.extensions.get("bot_name", BOT_DEFAULT_NAME)
             protocol.on_map_change(self, map)
 
@@ -216,58 +434,14 @@ def apply_script(protocol, connection, config):
             protocol.update_day_color(self)
 
     class SurviveConnection(connection):
-        aim = None
-        last_aim = None
-        aim_at = None
-        input = None
-        ticks_stumped = 0
-        ticks_stumped2 = 0
-        ticks_stumped3 = 0
-        last_pos = None
-        distance_to_aim = None
-        jump_count = 0
-        spade_count = 0
-        sec = 15
-        sec2 = 15
-        discar = 0
+        dig_count = 0
+        dig_progress = 0.0
+        moved_count = 0
         knock = 4
+        melee_damage = BOT_ATTACK_DAMAGE
 
-        _turn_speed = None
-        _turn_vector = None
-
-        def _get_turn_speed(self):
-            return self._turn_speed
-
-        def _set_turn_speed(self, value):
-            self._turn_speed = value
-            self._turn_vector = Vertex3(cos(value), sin(value), 0.0)
-
-        turn_speed = property(_get_turn_speed, _set_turn_speed)
-
-        def __init__(self, protocol, peer):
-            if peer is not None:
-                return connection.__init__(self, protocol, peer)
-            self.local = True
-            self.rapid_hack_detect = False
-            self.speedhack_detect = False
-            connection.__init__(self, protocol, LocalPeer())
-            self.on_connect()
-            self._send_connection_data()
-            self.send_map()
-
-            self.aim = Vertex3()
-            self.target_orientation = Vertex3()
-            self.last_pos = Vertex3()
-            self.turn_speed = 0.15  # rads per tick
-            self.input = set()
-
-        def join_game(self, team):
-            self.name = self.protocol.bot_name + str(self.player_id)
-            self.team = team
-            self.set_weapon(RIFLE_WEAPON, True)
-            self.protocol.players[(self.player_id)] = self
-            self.on_login(self.name)
-            self.spawn()
+        def get_bot_name(self):
+            return self.protocol.bot_name + str(self.player_id)
 
         def on_login(self, name):
             # prevent players from picking reserved bot name
@@ -279,267 +453,117 @@ def apply_script(protocol, connection, config):
                 self.disconnect()
             return connection.on_login(self, name)
 
-        def disconnect(self, data=0):
-            if not self.local:
-                return connection.disconnect(self)
-            if self.disconnected:
-                return
-            self.protocol.bots.remove(self)
-            self.disconnected = True
-            self.on_disconnect()
-
-        def update(self):
-            obj = self.world_object
-            ori = obj.orientation
-            pos = obj.position
+        def can_think(self):
+            return not self.world_object.dead
 
-            if self.world_object.dead:
+        def think(self):
+            self.state.held_input = None
+            if not self.can_think():
                 return
-
-            for i in self.team.other.get_players():
-                if (i.world_object) and (not i.world_object.dead) and (not i.god):
-                    some = Vertex3()
-                    some.set_vector(i.world_object.position)
-                    some -= pos
-                    distance_to_new_aim = some.normalize()
-                    if (self.distance_to_aim is not None and
-                            distance_to_new_aim < self.distance_to_aim):
-                        self.aim_at = i
-                        self.last_aim = None
-
-            if self.aim_at and self.aim_at.world_object:
-                real_aim_at_pos = self.aim_at.world_object.position
-                if obj.can_see(self.aim_at.world_object.position.x,
-                               self.aim_at.world_object.position.y,
-                               self.aim_at.world_object.position.z):
-                    aim_at_pos = self.aim_at.world_object.position
-                    self.last_aim = Vertex3()
-                    self.last_aim.set_vector(aim_at_pos)
-                else:
-                    if self.last_aim is None:
-                        aim_at_pos = self.aim_at.world_object.position
-                    else:
-                        aim_at_pos = self.last_aim
-                self.aim.set_vector(aim_at_pos)
-                self.aim -= pos
-                self.distance_to_aim = self.aim.normalize()
-                self.input.add("up")
-                self.input.add("sprint")
-                self.last_pos -= pos
-                moved = Vertex3()
-                moved.set_vector(self.last_pos)
-                distance_moved = self.last_pos.length_sqr()
-                self.last_pos.set_vector(pos)
-
-                if self.distance_to_aim <= 2.0:
-                    self.target_orientation.set_vector(self.aim)
-                    self.input.discard("sprint")
-                    self.input.add("primary_fire")
-                    self.left_spade()
-                else:
-                    some = Vertex3()
-                    some.x, some.y, some.z = self.aim.x, self.aim.y, 0
-                    self.target_orientation.set_vector(some)
-
-                if (self.world_object.velocity.z != 0 and
-                        abs(floor(aim_at_pos.x) - floor(pos.x)) <= 10 and
-                        abs(floor(aim_at_pos.y) - floor(pos.y)) <= 10) or (
-                        abs(floor(aim_at_pos.x) - floor(pos.x)) <= 1 and
-                        abs(floor(aim_at_pos.y) - floor(pos.y)) <= 1):
-                    try:
-                        if aim_at_pos == self.aim_at.world_object.position:
-                            if pos.z > aim_at_pos.z:
-                                self.input.add("jump")
-                                self.ticks_stumped3 += 1
-                                self.sec = 15
-                                self.ticks_stumped = 0
-                                self.ticks_stumped2 = 0
-                                if self.ticks_stumped3 >= self.sec2:
-                                    self.sec2 += 15
-                                    self.input.add("primary_fire")
-                                    self.dig(0)
-                            elif (pos.z < aim_at_pos.z and
-                                  abs(floor(aim_at_pos.x) - floor(pos.x) <= 1) and
-                                  abs(floor(aim_at_pos.y) - floor(pos.y)) <= 1):
-                                self.ticks_stumped3 += 1
-                                if self.ticks_stumped3 >= self.sec2:
-                                    self.input.add("primary_fire")
-                                    self.sec2 += 15
-                                    self.dig(2)
-                        else:
-                            self.last_aim = None
-                    except AttributeError:
-                        self.last_aim = None
-                else:
-                    self.sec2 = 15
-                    self.ticks_stumped3 = 0
-                    if (moved.x == 0) or (moved.y == 0):
-                        self.input.discard("sprint")
-                        self.ticks_stumped += 1
-                        self.input.add("jump")
-                        if (self.ticks_stumped >= self.sec):
-                            self.input.add("primary_fire")
-                            if self.sec % 30 == 0:
-                                i = 1
-                            else:
-                                if floor(aim_at_pos.z) < floor(pos.z):  # up
-                                    i = 0
-                                elif floor(aim_at_pos.z) > floor(pos.z):  # down
-                                    i = 2
-                                elif floor(aim_at_pos.z) == floor(pos.z):
-                                    i = 1
-                            self.sec += 15
-                            self.input.add("primary_fire")
-                            self.dig(i)
-                    else:
-                        self.sec = 15
-                        self.ticks_stumped = 0
-                        self.ticks_stumped2 = 0
+            self.choose_target()
+            aim = self.get_aim_point()
+            if aim is not None:
+                aim_x, aim_y, aim_z, aim_is_target = aim
+                self.state.aim.set(aim_x, aim_y, aim_z)
+                self.state.aim -= self.world_object.position
+                self.distance_to_aim = self.state.aim.normalize()
+                self.act(aim_x, aim_y, aim_z, aim_is_target,
+                         self.distance_to_aim <= MELEE_DISTANCE)
             else:
                 self.last_aim = None
                 self.distance_to_aim = float("inf")
+            self.state.held_input = self.state.input
 
-            # orientate towards target
-            diff = ori - self.target_orientation
-            diff.z = 0.0
-            diff = diff.length_sqr()
-            if diff > 0.001:
-                p_dot = ori.perp_dot(self.target_orientation)
-                if p_dot > 0.0:
-                    ori.rotate(self._turn_vector)
-                else:
-                    ori.unrotate(self._turn_vector)
-                new_p_dot = ori.perp_dot(self.target_orientation)
-                if new_p_dot * p_dot < 0.0:
-                    ori.set_vector(self.target_orientation)
+        def act(self, aim_x, aim_y, aim_z, aim_is_target, in_reach):
+            pos = self.world_object.position
+            self.state.input |= INPUT_UP
+            self.state.input |= INPUT_SPRINT
+            self.last_pos -= pos
+            distance_moved = self.last_pos.length_sqr()
+            self.last_pos.set_vector(pos)
+            if distance_moved >= BOT_STUCK_DISTANCE:
+                self.moved_count = self.protocol.loop_count
+            is_stuck = self.protocol.loop_count - self.moved_count >= BOT_DIG_INTERVAL
+
+            if in_reach:
+                self.state.target_orientation.set_vector(self.state.aim)
+                self.state.input &= ~INPUT_SPRINT
+                self.state.input |= INPUT_PRIMARY_FIRE
+                self.left_spade()
             else:
-                ori.set_vector(self.target_orientation)
-
-            obj.set_orientation(*ori.get())
-            self.flush_input()
-
-        def flush_input(self):
-            input = self.input
-            world_object = self.world_object
-            pos = world_object.position
-            if not self.world_object.dead:
-                if self.local:
-                    for i in self.team.get_players():
-                        if (i.world_object) and (not i.world_object.dead) and (not i == self):
-                            pos2 = i.world_object.position
-                            if floor(pos2.x) == floor(pos.x) and floor(pos2.y) == floor(pos.y):
-                                if self.protocol.loop_count % 30 == 0:
-                                    self.discar = random.randint(-3, 10)
-                                elif self.discar == 3 or self.discar == 4 or self.discar == 5:
-                                    input.add("left")
-                                elif self.discar == 6 or self.discar == 7 or self.discar == 8:
-                                    input.add("right")
-                                elif self.discar == 9:
-                                    input.add("right")
-                                    input.discard("up")
-                                elif self.discar == 10:
-                                    input.add("left")
-                                    input.discard("up")
-                                break
-                    if self.protocol.loop_count - self.jump_count < 30:
-                        input.discard("jump")
+                self.steer(aim_x, aim_y)
+                if is_stuck:
+                    # the way is blocked, dig through
+                    if floor(aim_z) < floor(pos.z):  # up
+                        self.dig_when_stuck(0, aim_x, aim_y, aim_z)
+                    elif floor(aim_z) > floor(pos.z):  # down
+                        self.dig_when_stuck(2, aim_x, aim_y, aim_z)
                     else:
-                        self.jump_count = self.protocol.loop_count
-
-                input_changed = not (
-                    ("up" in input) == world_object.up and
-                    ("down" in input) == world_object.down and
-                    ("left" in input) == world_object.left and
-                    ("right" in input) == world_object.right and
-                    ("jump" in input) == world_object.jump and
-                    ("crouch" in input) == world_object.crouch and
-                    ("sneak" in input) == world_object.sneak and
-                    ("sprint" in input) == world_object.sprint)
-                if input_changed:
-                    if not self.freeze_animation:
-                        if ("sprint" in input) and ("jump" not in input):
-                            m_x = self.aim.x + pos.x
-                            m_y = self.aim.y + pos.y
-                            m_z = pos.z
-                            if not isnan(m_x) and not isnan(m_y) and not isnan(m_z):
-                                if not self.protocol.map.get_solid(m_x, m_y, m_z):
-                                    self.set_location((m_x, m_y, m_z))
-
-                        world_object.set_walk("up" in input, "down" in input,
-                                              "left" in input, "right" in input)
-                        world_object.set_animation("jump" in input, "crouch" in input,
-                                                   "sneak" in input, "sprint" in input)
-                    if (not self.filter_visibility_data and
-                            not self.filter_animation_data):
-                        input_data = InputData()
-                        input_data.player_id = self.player_id
-                        input_data.up = world_object.up
-                        input_data.down = world_object.down
-                        input_data.left = world_object.left
-                        input_data.right = world_object.right
-                        input_data.jump = world_object.jump
-                        input_data.crouch = world_object.crouch
-                        input_data.sneak = world_object.sneak
-                        input_data.sprint = world_object.sprint
-                        self.protocol.broadcast_contained(input_data)
-                primary = "primary_fire" in input
-                secondary = "secondary_fire" in input
-                shoot_changed = not (primary == world_object.primary_fire and
-                                     secondary == world_object.secondary_fire)
-                if shoot_changed:
-                    if primary != world_object.primary_fire:
-                        if self.tool == WEAPON_TOOL:
-                            self.weapon_object.set_shoot(primary)
-                        if self.tool == WEAPON_TOOL or self.tool == SPADE_TOOL:
-                            self.on_shoot_set(primary)
-                    world_object.primary_fire = primary
-                    world_object.secondary_fire = secondary
-                    if not self.filter_visibility_data:
-                        weapon_input = WeaponInput()
-                        weapon_input.player_id = self.player_id
-                        weapon_input.primary = primary
-                        weapon_input.secondary = secondary
-                        self.protocol.broadcast_contained(weapon_input)
-                input.clear()
-
-        def set_tool(self, tool):
-            if self.on_tool_set_attempt(tool) is False:
-                return
-            self.tool = tool
-            if self.tool == WEAPON_TOOL:
-                self.on_shoot_set(self.world_object.fire)
-                self.weapon_object.set_shoot(self.world_object.fire)
-            self.on_tool_changed(self.tool)
-            if self.filter_visibility_data:
-                return
-            set_tool = SetTool()
-            set_tool.player_id = self.player_id
-            set_tool.value = self.tool
-            self.protocol.broadcast_contained(set_tool)
+                        self.dig_when_stuck(1, aim_x, aim_y, aim_z)
+
+            if (self.world_object.velocity.z != 0 and
+                    abs(floor(aim_x) - floor(pos.x)) <= 10 and
+                    abs(floor(aim_y) - floor(pos.y)) <= 10) or (
+                    abs(floor(aim_x) - floor(pos.x)) <= 1 and
+                    abs(floor(aim_y) - floor(pos.y)) <= 1):
+                if aim_is_target:
+                    if pos.z > aim_z:
+                        self.state.input |= INPUT_JUMP
+                        if is_stuck:
+                            self.dig_when_stuck(0, aim_x, aim_y, aim_z)
+                    elif (pos.z < aim_z and is_stuck and
+                          abs(floor(aim_x) - floor(pos.x)) <= 1 and
+                          abs(floor(aim_y) - floor(pos.y)) <= 1):
+                        self.dig_when_stuck(2, aim_x, aim_y, aim_z)
+                else:
+                    self.last_aim = None
+
+        def filter_input(self, input):
+            return connection.filter_input(self, self.avoid_crowd(input))
 
-        def left_spade(self):
+        def dig_when_stuck(self, i, aim_x, aim_y, aim_z):
+            if self.protocol.loop_count - self.dig_count < BOT_DIG_INTERVAL:
+                return
+            self.dig_count = self.protocol.loop_count
+            self.state.input |= INPUT_PRIMARY_FIRE
+            if not self.dig_tunnel(aim_x, aim_y, aim_z):
+                self.dig(i)
+
+        def dig_tunnel(self, aim_x, aim_y, aim_z):
+            """
+            Digs the blocks of the next cell on the planned tunnel towards the
+            aim and heads into it. Returns False if there is no plan yet.
+            """
             obj = self.world_object
+            if obj.dead:
+                return True
             pos = obj.position
-            ori = obj.orientation
-            if self.world_object.dead:
-                return
-            if self.protocol.loop_count - self.spade_count < 24:
-                return
+            step = self.protocol.tunnels.get_step(pos.x, pos.y, pos.z, aim_x, aim_y, aim_z,
+                                                  self.protocol.loop_count)
+            if step is None:
+                return False
+            x, y, z = step
+            if not self.protocol.strong:
+                rate = BOT_TUNNEL_RATE
             else:
-                self.spade_count = self.protocol.loop_count
-            for player in self.team.other.get_players():
-                if (player.world_object) and (not player.world_object.dead):
-                    if ((vector_collision(pos, player.world_object.position, 3)) and
-                            (obj.validate_hit(player.world_object, MELEE, 5, 5))):
-                        hit_amount = BOT_ATTACK_DAMAGE
-                        type = MELEE_KILL
-                        self.on_hit(hit_amount, player, type, None)
-                        player.hit(hit_amount, self, type)
-                        # knockback
-                        if not player.local:
-                            player.input = set()
-                            player.input.add("jump")
-                            player.flush_input()
+                rate = BOT_TUNNEL_RATE_STRONG
+            # digging is not saved up for more than one cell
+            self.dig_progress = min(self.dig_progress + rate, 3.0)
+            map = self.protocol.map
+            edit = BlockEdit(self.protocol)
+            for block_z in range(z, z + 3):
+                if self.dig_progress < 1.0:
+                    break
+                if map.get_solid(x, y, block_z):
+                    edit.remove(x, y, block_z)
+                    self.dig_progress -= 1.0
+            self.commit_dig(edit)
+            if x != int(floor(pos.x)) or y != int(floor(pos.y)):
+                self.state.target_orientation.set(x + 0.5 - pos.x, y + 0.5 - pos.y, 0.0)
+                self.state.target_orientation.normalize()
+            elif z < floor(pos.z):
+                self.state.input |= INPUT_JUMP
+            return True
 
         def dig(self, i):
             if not self.protocol.strong:
@@ -556,38 +580,32 @@ def apply_script(protocol, connection, config):
             ix = int(floor(pos.x))
             iy = int(floor(pos.y))
             iz = int(floor(pos.z))
+            edit = BlockEdit(self.protocol)
             for x in range(ix - 1, ix + 2):
                 for y in range(iy - 1, iy + 2):
                     for z in range(iz - 1 + i, iz + 2 + i):
                         rough = random.randint(0, bindo)
                         if rough == 0:
-                            if z > 61 or not destroy_block(self.protocol, x, y, z):
-                                return
-                            if map.get_solid(x, y, z):
-                                map.destroy_point(x, y, z)
-                                map.check_node(x, y, z, True)
-                            self.on_block_removed(x, y, z)
+                            if z > 61 or map.get_solid(x, y, z) is None:
+                                return self.commit_dig(edit)
+                            edit.remove(x, y, z)
                         else:
                             continue
+            self.commit_dig(edit)
+
+        def commit_dig(self, edit):
+            removed, built = edit.commit()
+            for x, y, z in removed:
+                self.on_block_removed(x, y, z)
 
         def on_spawn(self, pos):
             if self.local:
-                self.respawn_time = BOT_RESPAWN_TIME
+                self.respawn_time = BOT_RESPAWN_TIME + self.protocol.governor.respawn_delay
                 self.set_hp(BOT_HP)
-            max_bots = BOTS_MAX
-            min_bots = BOTS_MIN
-            blue_players = self.protocol.blue_team.count()
-            plus_bots = BOTS_PER_PLAYER
-            if blue_players <= 7 and BOTS_PER_PLAYER == 1 and BOTS_MAX == 16:
-                plus_bots = BOTS_PER_PLAYER + 1
-            bot_amount = blue_players + plus_bots
-            if bot_amount > max_bots:
-                bot_amount = max_bots
-            elif bot_amount < min_bots:
-                bot_amount = min_bots
+            bot_amount = self.protocol.governor.limit(self.protocol.get_bot_amount())
             missing_bots = bot_amount - len(self.protocol.bots)
             if not self.local and missing_bots > 0:
-                    addbot(self, missing_bots, self.protocol.green_team.name)
+                    botengine.addbot(self, missing_bots, self.protocol.green_team.name)
             if self.local and missing_bots < 0:
                     self.disconnect()
                     return
@@ -596,43 +614,37 @@ def apply_script(protocol, connection, config):
             self.world_object.set_orientation(1.0, 0.0, 0.0)
             self.set_tool(SPADE_TOOL)
             self.aim_at = None
-            self.spade_count = 0
-            self.jump_count = 0
-            self.sec = 15
-            self.sec2 = 15
-            self.ticks_stumped = 0
-            self.ticks_stumped2 = 0
-            self.ticks_stumped3 = 0
+            self.state.held_input = None
+            self.state.spade_count = 0
+            self.dig_count = 0
+            self.dig_progress = 0.0
+            self.moved_count = self.protocol.loop_count
+            self.state.jump_count = 0
             self.last_pos.set(*pos)
             return connection.on_spawn(self, pos)
 
         def on_spawn_location(self, pos):
             x = -1
             y = -1
+            get_spawn_point = self.protocol.get_spawn_point
             if self.protocol.war:
                 if self.team == self.protocol.blue_team:
-                    x = random.randint(0, 16)
-                    y = random.randint(0, 16)
+                    x, y = get_spawn_point(0, 0, 16, 16)
                 elif self.team == self.protocol.green_team:
-                    x = random.randint(495, 511)
-                    y = random.randint(495, 511)
+                    x, y = get_spawn_point(495, 495, 511, 511)
             else:
                 if self.team == self.protocol.blue_team:
-                    x = random.randint(256 - HUMAN_SPAWN_RANGE, 256 + HUMAN_SPAWN_RANGE)
-                    y = random.randint(256 - HUMAN_SPAWN_RANGE, 256 + HUMAN_SPAWN_RANGE)
+                    x, y = get_spawn_point(256 - HUMAN_SPAWN_RANGE, 256 - HUMAN_SPAWN_RANGE,
+                                           256 + HUMAN_SPAWN_RANGE, 256 + HUMAN_SPAWN_RANGE)
                 elif self.team == self.protocol.green_team:
                     if self.protocol.placeof == 0:
-                        x = random.randint(0, 16)
-                        y = random.randint(0, 16)
+                        x, y = get_spawn_point(0, 0, 16, 16)
                     elif self.protocol.placeof == 1:
-                        x = random.randint(0, 16)
-                        y = random.randint(495, 511)
+                        x, y = get_spawn_point(0, 495, 16, 511)
                     elif self.protocol.placeof == 2:
-                        x = random.randint(495, 511)
-                        y = random.randint(0, 16)
+                        x, y = get_spawn_point(495, 0, 511, 16)
                     elif self.protocol.placeof == 3:
-                        x = random.randint(495, 511)
-                        y = random.randint(495, 511)
+                        x, y = get_spawn_point(495, 495, 511, 511)
             if x >= 0 and y >= 0:
                 z = self.protocol.map.get_z(x, y) - 3
                 return x, y, z
@@ -685,37 +697,30 @@ def apply_script(protocol, connection, config):
                     return hit_amount * BOT_HIT_SPADE
             connection.on_hit(self, hit_amount, hit_player, type, grenade)
 
-        def on_fall(self, damage):
-            if self.local:
-                return False
-            connection.on_fall(self, damage)
-
         def on_block_destroy(self, x, y, z, mode):
             if self.tool != SPADE_TOOL or mode == GRENADE_DESTROY:
                 return False
             return connection.on_block_destroy(self, x, y, z, mode)
 
-        def _send_connection_data(self):
-            if self.local:
-                if self.player_id is None:
-                    self.player_id = self.protocol.player_ids.pop()
-                return
-            connection._send_connection_data(self)
-
-        def send_map(self, data=None):
-            if self.local:
-                self.on_join()
-                return
-            connection.send_map(self, data)
-
-        def timer_received(self, value):
-            if self.local:
-                return
-            connection.timer_received(self, value)
-
-        def send_loader(self, loader, acyk=False, byte=0):
-            if self.local:
-                return
-            return connection.send_loader(self, loader, ack, byte)
+        def on_block_build(self, x, y, z):
+            self.protocol.los_cache.invalidate(x, y, z)
+            self.protocol.tunnels.on_block_built(x, y, z)
+            self.protocol.navigator.on_block_changed(x, y)
+            self.protocol.spawn_index.on_block_changed(x, y)
+            return connection.on_block_build(self, x, y, z)
+
+        def on_line_build(self, points):
+            for x, y, z in points:
+                self.protocol.los_cache.invalidate(x, y, z)
+                self.protocol.tunnels.on_block_built(x, y, z)
+                self.protocol.navigator.on_block_changed(x, y)
+                self.protocol.spawn_index.on_block_changed(x, y)
+            return connection.on_line_build(self, points)
+
+        def on_block_removed(self, x, y, z):
+            self.protocol.los_cache.invalidate(x, y, z)
+            self.protocol.navigator.on_block_changed(x, y)
+            self.protocol.spawn_index.on_block_changed(x, y)
+            return connection.on_block_removed(self, x, y, z)
 
     return SurviveProtocol, SurviveConnection
@@ -10,29 +10,42 @@ Setup:
     Using a bot script with Pyspades/Pysnip requires adding the "local" attribute:
       https://pastebin.com/raw/5qc1eCDf
 
+    Put botengine.py, the engine shared by the bot gamemodes, into the scripts folder
+    next to this gamemode.
+
     Set game_mode in your server config to "adventure" (in the serverlist, the name
     of the gamemode will be shown as "adv") and add the map "The Journey"
     (thejourney.vxl) which is required for this mode to work.
 
+    Bots only think (pick a target, check the line of sight, find their way) once
+    every few world updates, spread evenly over the bots, while turning and moving
+    still happens on every update. Set "bot_think_rate" in your server config to the
+    number of world updates between two thinks of a bot (default 1, every bot
+    thinks on every update).
+
 Commands:
 
     /setlevel <level>
         Manually set your level to jump to later parts of the story.
+    /loscache
+        Show the hit rate and the time saved by the line of sight cache.
+    /aiperf <on|off>
+        Start profiling the bots. While profiling, show the time spent in each step
+        of the bots and the most expensive bots. Use "off" to stop profiling.
 """
 
-from pyspades.server import input_data, weapon_input, set_tool, chat_message, kill_action
+from pyspades.server import chat_message, kill_action
 from pyspades.contained import ChatMessage, KillAction
-from pyspades.common import Vertex3
-from pyspades.collision import vector_collision
 from pyspades.constants import *
 from commands import admin, add, get_team
-from enet import Address
-from math import cos, sin, floor, isnan
+from math import floor, sqrt
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
-import random
 import time
 import textwrap
+import botengine
+from botengine import (INPUT_JUMP, INPUT_LEFT, INPUT_MOVEMENT, INPUT_PRIMARY_FIRE,
+                       INPUT_RIGHT, INPUT_SPRINT, INPUT_UP, get_input_mask)
 
 PUBLIC_MODE_NAME = "adv"
 TEAM_BLUE_COLOR = (160, 125, 80)
@@ -57,6 +70,8 @@ def setlevel(connection, level):
 
 
 add(setlevel)
+add(botengine.loscache)
+add(botengine.aiperf)
 
 
 def get_human_player(protocol):
@@ -69,28 +84,23 @@ def get_human_player(protocol):
 def is_in_region(connection, x1, y1, x2, y2):
     if connection.world_object is not None:
         pos = connection.world_object.position
-        return pos.x >= x1 and pos.y >= y1 and pos.x <= x2 and pos.y <= y2
+        return is_point_in_region(pos.x, pos.y, x1, y1, x2, y2)
     else:
         return False
 
 
+def is_point_in_region(x, y, x1, y1, x2, y2):
+    return x >= x1 and y >= y1 and x <= x2 and y <= y2
+
+
 def mirror_input_from_player(bot, player):
-    if player.world_object.up:
-        bot.input.add("up")
-    if player.world_object.down:
-        bot.input.add("down")
-    if player.world_object.left:
-        bot.input.add("right")
-    if player.world_object.right:
-        bot.input.add("left")
-    if player.world_object.jump:
-        bot.input.add("jump")
-    if player.world_object.crouch:
-        bot.input.add("crouch")
-    if player.world_object.sneak:
-        bot.input.add("sneak")
-    if player.world_object.sprint:
-        bot.input.add("sprint")
+    input = get_input_mask(player.world_object) & INPUT_MOVEMENT
+    # left and right are swapped, the bot faces the player
+    bot.state.input |= input & ~(INPUT_LEFT | INPUT_RIGHT)
+    if input & INPUT_LEFT:
+        bot.state.input |= INPUT_RIGHT
+    if input & INPUT_RIGHT:
+        bot.state.input |= INPUT_LEFT
     if bot.tool != player.tool:
         bot.set_tool(player.tool)
 
@@ -183,36 +193,18 @@ def add_bot(connection, amount=None, team=None):
     return "Added %s bot(s)" % amount
 
 
-class LocalPeer:
-    address = Address("localhost", 0)
-    roundTripTime = 0.0
-
-    def send(self, *arg, **kw):
-        pass
-
-    def reset(self):
-        pass
-
-
 def apply_script(protocol, connection, config):
+    protocol, connection = botengine.apply_script(protocol, connection, config)
+
     class AdventureProtocol(protocol):
         game_mode = CTF_MODE
-        bots = None
         placeof = 3
+        bot_think_rate = max(1, int(config.get("bot_think_rate", 1)))
 
         def __init__(self, *arg, **kw):
             protocol.__init__(self, *arg, **kw)
             self.add_adventure_bots()
 
-        def add_bot(self, team, bot_type=0):
-            if self.bots and len(self.connections) + len(self.bots) >= 32:
-                return None
-            bot = self.connection_class(self, None)
-            bot.bot_type = bot_type
-            bot.join_game(team)
-            self.bots.append(bot)
-            return bot
-
         def add_adventure_bots(self):
             self.add_bot(self.blue_team, 1)
             for x in range(0, AMOUNT_OF_DEMONS):
@@ -226,11 +218,18 @@ def apply_script(protocol, connection, config):
                     self.placeof = 0
                 else:
                     self.placeof += 1
+            # builds the height field after a map change, then the flow fields
+            self.navigator.update(self.loop_count)
             if self.bots:
-                for bot in self.bots:
-                    bot.update()
+                self.update_snapshot()
+                self.update_bots()
             protocol.on_world_update(self)
 
+        def get_profiled_methods(self):
+            targets = protocol.get_profiled_methods(self)
+            targets.append((botengine.FlowFieldNavigator, "update", "flow fields", False))
+            return targets
+
         def on_map_change(self, map):
             self.game_mode_name = PUBLIC_MODE_NAME
             self.blue_team.color = TEAM_BLUE_COLOR
@@ -245,6 +244,10 @@ def apply_script(protocol, connection, config):
             self.fall_damage = False
             self.building = False
             self.bots = []
+            self.snapshot = botengine.WorldSnapshot()
+            self.crowd = botengine.CrowdMap()
+            self.los_cache = botengine.LineOfSightCache()
+            self.navigator = botengine.FlowFieldNavigator(map)
             protocol.on_map_change(self, map)
 
         def on_map_leave(self):
@@ -260,27 +263,14 @@ def apply_script(protocol, connection, config):
             return HIDE_COORD
 
     class AdventureConnection(connection):
-        aim = None
-        last_aim = None
-        aim_at = None
-        input = None
         grenade_call = None
         ticks_stumped = 0
-        ticks_stumped2 = 0
         ticks_stumped3 = 0
-        last_pos = None
-        distance_to_aim = None
-        jump_count = 0
-        spade_count = 0
         sec = 15
         sec2 = 15
         nature = None
-        discar = 0
         knock = 4
 
-        _turn_speed = None
-        _turn_vector = None
-
         spawn_time = 0
         hit_time = 0
 
@@ -302,335 +292,156 @@ def apply_script(protocol, connection, config):
         notice_iterations = 0
         disable_flight = False
 
-        def _get_turn_speed(self):
-            return self._turn_speed
+        def join_game(self, team, bot_type=0):
+            self.bot_type = bot_type
+            if bot_type in (1, 2):
+                team = self.protocol.blue_team
+            elif bot_type in (3, 4):
+                team = self.protocol.green_team
+            connection.join_game(self, team)
 
-        def _set_turn_speed(self, value):
-            self._turn_speed = value
-            self._turn_vector = Vertex3(cos(value), sin(value), 0.0)
-
-        turn_speed = property(_get_turn_speed, _set_turn_speed)
-
-        def __init__(self, protocol, peer):
-            if peer is not None:
-                return connection.__init__(self, protocol, peer)
-            self.local = True
-            self.rapid_hack_detect = False
-            self.speedhack_detect = False
-            connection.__init__(self, protocol, LocalPeer())
-            self.on_connect()
-            self._send_connection_data()
-            self.send_map()
-
-            self.aim = Vertex3()
-            self.target_orientation = Vertex3()
-            self.last_pos = Vertex3()
-            self.turn_speed = 0.15  # rads per tick
-            self.input = set()
-
-        def join_game(self, team):
-            use_weapon = RIFLE_WEAPON
-            # Set bot name by bot_type
+        def get_bot_name(self):
             if self.bot_type == 1:
-                self.name = "The Guide"
-                self.team = self.protocol.blue_team
+                return "The Guide"
             elif self.bot_type == 2:
-                self.name = "You"
-                self.team = self.protocol.blue_team
+                return "You"
             elif self.bot_type == 3:
-                self.name = "Demon" + str(self.player_id)
-                self.team = self.protocol.green_team
+                return "Demon" + str(self.player_id)
             elif self.bot_type == 4:
-                self.name = "Manager"
-                self.team = self.protocol.green_team
-            self.set_weapon(use_weapon, True)
-            self.protocol.players[(self.name, self.player_id)] = self
-            self.on_login(self.name)
-            self.spawn()
-
-        def disconnect(self, data=0):
-            if not self.local:
-                return connection.disconnect(self)
-            if self.disconnected:
-                return
-            self.protocol.bots.remove(self)
-            self.disconnected = True
-            self.on_disconnect()
+                return "Manager"
+            return connection.get_bot_name(self)
 
         def relocate_stuck_bot(self, bot):
             me_x = bot.world_object.position.x
             me_y = bot.world_object.position.y
             bot.set_location_safe((me_x, me_y, self.protocol.map.get_z(me_x, me_y) - 10))
 
-        def update(self):
+        def think(self):
             obj = self.world_object
-            ori = obj.orientation
             pos = obj.position
+            self.state.held_input = None
 
             if self.world_object.dead:
                 return
-            for i in self.protocol.players.values():
-                if ((not i.local) and (i.world_object) and
-                        (not i.world_object.dead) and (not i.god)):
-                    if self.bot_type == 2 and not is_in_region(i, 295, 66, 385, 154):
-                        self.flush_input()
+            snapshot = self.protocol.snapshot
+            for row in range(len(snapshot.players)):
+                if not (snapshot.local[row] or snapshot.dead[row] or snapshot.god[row]):
+                    x, y, z = snapshot.get_position(row)
+                    if self.bot_type == 2 and not is_point_in_region(x, y, 295, 66, 385, 154):
+                        self.state.held_input = 0
                         return
-                    elif self.bot_type == 3 and not is_in_region(i, 19, 101, 249, 213):
-                        self.flush_input()
+                    elif self.bot_type == 3 and not is_point_in_region(x, y, 19, 101, 249, 213):
+                        self.state.held_input = 0
                         return
                     elif self.bot_type == 4:
-                        if is_in_region(i, 295, 159, 385, 247):
+                        if is_point_in_region(x, y, 295, 159, 385, 247):
                             if self.hit_time == 0:
                                 self.hit_time = get_now_in_secs() + 12
                                 return
                         else:
-                            self.flush_input()
+                            self.state.held_input = 0
                             return
 
-                    some = Vertex3()
-                    some.set_vector(i.world_object.position)
-                    some -= pos
-                    distance_to_new_aim = some.normalize()
-                    if distance_to_new_aim < self.distance_to_aim:
-                        self.aim_at = i
+                    distance_to_new_aim = sqrt((x - pos.x) ** 2 + (y - pos.y) ** 2 +
+                                               (z - pos.z) ** 2)
+                    if (self.distance_to_aim is not None and
+                            distance_to_new_aim < self.distance_to_aim):
+                        self.aim_at = snapshot.players[row]
                         self.last_aim = None
                     break
 
-            if self.aim_at and self.aim_at.world_object:
-                real_aim_at_pos = self.aim_at.world_object.position
-                if obj.can_see(self.aim_at.world_object.position.x,
-                               self.aim_at.world_object.position.y,
-                               self.aim_at.world_object.position.z):
-                    aim_at_pos = self.aim_at.world_object.position
-                    self.last_aim = Vertex3()
-                    self.last_aim.set_vector(aim_at_pos)
-                else:
-                    if self.last_aim is None:
-                        aim_at_pos = self.aim_at.world_object.position
-                    else:
-                        aim_at_pos = self.last_aim
-                self.aim.set_vector(aim_at_pos)
-                self.aim -= pos
-                self.distance_to_aim = self.aim.normalize()
+            target_row = snapshot.get_row(self.aim_at)
+            if target_row >= 0:
+                aim_x, aim_y, aim_z = snapshot.get_position(target_row)
+                aim_is_target = True
+                los_cache = self.protocol.los_cache
+                if los_cache.can_see(self, self.aim_at.player_id, aim_x, aim_y, aim_z,
+                                     self.protocol.loop_count):
+                    self.state.last_seen.set(aim_x, aim_y, aim_z)
+                    self.last_aim = self.state.last_seen
+                elif self.last_aim is not None:
+                    aim_x, aim_y, aim_z = self.last_aim.get()
+                    aim_is_target = False
+                self.state.aim.set(aim_x, aim_y, aim_z)
+                self.state.aim -= pos
+                self.distance_to_aim = self.state.aim.normalize()
 
                 is_active_bot = self.bot_type == 3 or (self.bot_type == 4 and
                                                        is_bot_hit_time(self))
 
                 if is_active_bot:
-                    self.input.add("up")
+                    self.state.input |= INPUT_UP
                     if self.bot_type == 3:
-                        self.input.add("sprint")
+                        self.state.input |= INPUT_SPRINT
                 elif self.bot_type == 2:
                     mirror_input_from_player(self, get_human_player(self.protocol))
-                self.last_pos -= pos
-                moved = Vertex3()
-                moved.set_vector(self.last_pos)
-                distance_moved = self.last_pos.length_sqr()
-                self.last_pos.set_vector(pos)
+                moved_x = pos.x - self.last_pos.x
+                moved_y = pos.y - self.last_pos.y
+                self.last_pos.set(pos.x, pos.y, pos.z)
 
                 if is_active_bot and self.distance_to_aim <= 2.0:
-                    self.target_orientation.set_vector(self.aim)
-                    self.input.discard("sprint")
-                    self.input.add("primary_fire")
+                    self.state.target_orientation.set_vector(self.state.aim)
+                    self.state.input &= ~INPUT_SPRINT
+                    self.state.input |= INPUT_PRIMARY_FIRE
                     self.left_spade()
+                elif is_active_bot:
+                    self.steer(aim_x, aim_y)
                 else:
-                    some = Vertex3()
-                    some.x, some.y, some.z = self.aim.x, self.aim.y, 0
-                    self.target_orientation.set_vector(some)
+                    self.state.target_orientation.set(self.state.aim.x, self.state.aim.y, 0.0)
 
                 if is_active_bot:
                     if (self.world_object.velocity.z != 0 and
-                            abs(floor(aim_at_pos.x) - floor(pos.x)) <= 10 and
-                            abs(floor(aim_at_pos.y) - floor(pos.y)) <= 10) or (
-                            abs(floor(aim_at_pos.x) - floor(pos.x)) <= 1 and
-                            abs(floor(aim_at_pos.y) - floor(pos.y)) <= 1):
-                        try:
-                            if aim_at_pos == self.aim_at.world_object.position:
-                                if pos.z > aim_at_pos.z:
-                                    self.input.add("jump")
-                                    self.ticks_stumped3 += 1
-                                    self.sec = 15
-                                    self.ticks_stumped = 0
-                                    self.ticks_stumped2 = 0
-                                    if self.ticks_stumped3 >= self.sec2:
-                                        self.sec2 += 15
-                                        self.relocate_stuck_bot(self)
-                                elif (pos.z < aim_at_pos.z and
-                                      abs(floor(aim_at_pos.x) - floor(pos.x) <= 1) and
-                                      abs(floor(aim_at_pos.y) - floor(pos.y)) <= 1):
-                                    self.ticks_stumped3 += 1
-                                    if self.ticks_stumped3 >= self.sec2:
-                                        self.sec2 += 15
-                            else:
-                                self.last_aim = None
-                        except AttributeError:
+                            abs(floor(aim_x) - floor(pos.x)) <= 10 and
+                            abs(floor(aim_y) - floor(pos.y)) <= 10) or (
+                            abs(floor(aim_x) - floor(pos.x)) <= 1 and
+                            abs(floor(aim_y) - floor(pos.y)) <= 1):
+                        if aim_is_target:
+                            if pos.z > aim_z:
+                                self.state.input |= INPUT_JUMP
+                                self.ticks_stumped3 += 1
+                                self.sec = 15
+                                self.ticks_stumped = 0
+                                if self.ticks_stumped3 >= self.sec2:
+                                    self.sec2 += 15
+                                    self.relocate_stuck_bot(self)
+                            elif (pos.z < aim_z and
+                                  abs(floor(aim_x) - floor(pos.x)) <= 1 and
+                                  abs(floor(aim_y) - floor(pos.y)) <= 1):
+                                self.ticks_stumped3 += 1
+                                if self.ticks_stumped3 >= self.sec2:
+                                    self.sec2 += 15
+                        else:
                             self.last_aim = None
                     else:
                         self.sec2 = 15
                         self.ticks_stumped3 = 0
-                        if (moved.x == 0) or (moved.y == 0):
-                            self.input.discard("sprint")
+                        if moved_x == 0 or moved_y == 0:
+                            self.state.input &= ~INPUT_SPRINT
+                            self.state.input |= INPUT_JUMP
                             self.ticks_stumped += 1
-                            self.input.add("jump")
                             if self.ticks_stumped > 600:
                                 self.relocate_stuck_bot(self)
-
-                            if (self.ticks_stumped >= self.sec):
-                                if self.sec % 30 == 0:
-                                    i = 1
-                                else:
-                                    if floor(aim_at_pos.z) < floor(pos.z):  # up
-                                        i = 0
-                                    elif floor(aim_at_pos.z) > floor(pos.z):  # down
-                                        i = 2
-                                    elif floor(aim_at_pos.z) == floor(pos.z):
-                                        i = 1
+                            if self.ticks_stumped >= self.sec:
                                 self.sec += 15
                                 self.relocate_stuck_bot(self)
                         else:
                             self.sec = 15
                             self.ticks_stumped = 0
-                            self.ticks_stumped2 = 0
+                    # prevent them from getting stuck in blocks:
+                    if self.protocol.map.get_solid(pos.x, pos.y, pos.z):
+                        self.relocate_stuck_bot(self)
             else:
                 self.last_aim = None
                 self.distance_to_aim = float("inf")
+            self.state.held_input = self.state.input
 
-            # orientate towards target
-            diff = ori - self.target_orientation
-            diff.z = 0.0
-            diff = diff.length_sqr()
-            if diff > 0.001:
-                p_dot = ori.perp_dot(self.target_orientation)
-                if p_dot > 0.0:
-                    ori.rotate(self._turn_vector)
-                else:
-                    ori.unrotate(self._turn_vector)
-                new_p_dot = ori.perp_dot(self.target_orientation)
-                if new_p_dot * p_dot < 0.0:
-                    ori.set_vector(self.target_orientation)
-            else:
-                ori.set_vector(self.target_orientation)
-
-            obj.set_orientation(*ori.get())
-            self.flush_input()
-
-        def flush_input(self):
-            input = self.input
-            world_object = self.world_object
-            pos = world_object.position
-            if not self.world_object.dead:
-                if self.local:
-                    for i in self.team.get_players():
-                        if (i.world_object) and (not i.world_object.dead) and (not i == self):
-                            pos2 = i.world_object.position
-                            if floor(pos2.x) == floor(pos.x) and floor(pos2.y) == floor(pos.y):
-                                if self.protocol.loop_count % 30 == 0:
-                                    self.discar = random.randint(-3, 10)
-                                elif self.discar == 3 or self.discar == 4 or self.discar == 5:
-                                    input.add("left")
-                                elif self.discar == 6 or self.discar == 7 or self.discar == 8:
-                                    input.add("right")
-                                elif self.discar == 9:
-                                    input.add("right")
-                                    input.discard("up")
-                                elif self.discar == 10:
-                                    input.add("left")
-                                    input.discard("up")
-                                break
-                    if self.bot_type != 2 and self.protocol.loop_count - self.jump_count < 30:
-                        input.discard("jump")
-                    else:
-                        self.jump_count = self.protocol.loop_count
-
-                input_changed = not (
-                    ("up" in input) == world_object.up and
-                    ("down" in input) == world_object.down and
-                    ("left" in input) == world_object.left and
-                    ("right" in input) == world_object.right and
-                    ("jump" in input) == world_object.jump and
-                    ("crouch" in input) == world_object.crouch and
-                    ("sneak" in input) == world_object.sneak and
-                    ("sprint" in input) == world_object.sprint)
-                if input_changed:
-                    if not self.freeze_animation:
-                        if ("sprint" in input) and ("jump" not in input):
-                            m_x = self.aim.x + pos.x
-                            m_y = self.aim.y + pos.y
-                            m_z = pos.z
-                            if not isnan(m_x) and not isnan(m_y) and not isnan(m_z):
-                                if not self.protocol.map.get_solid(m_x, m_y, m_z):
-                                    self.set_location((m_x, m_y, m_z))
-
-                        world_object.set_walk("up" in input, "down" in input,
-                                              "left" in input, "right" in input)
-                        world_object.set_animation("jump" in input, "crouch" in input,
-                                                   "sneak" in input, "sprint" in input)
-                    if (not self.filter_visibility_data and
-                            not self.filter_animation_data):
-                        input_data.player_id = self.player_id
-                        input_data.up = world_object.up
-                        input_data.down = world_object.down
-                        input_data.left = world_object.left
-                        input_data.right = world_object.right
-                        input_data.jump = world_object.jump
-                        input_data.crouch = world_object.crouch
-                        input_data.sneak = world_object.sneak
-                        input_data.sprint = world_object.sprint
-                        self.protocol.send_contained(input_data)
-                primary = "primary_fire" in input
-                secondary = "secondary_fire" in input
-                shoot_changed = not (primary == world_object.primary_fire and
-                                     secondary == world_object.secondary_fire)
-                if shoot_changed:
-                    if primary != world_object.primary_fire:
-                        if self.tool == WEAPON_TOOL:
-                            self.weapon_object.set_shoot(primary)
-                        if self.tool == WEAPON_TOOL or self.tool == SPADE_TOOL:
-                            self.on_shoot_set(primary)
-                    world_object.primary_fire = primary
-                    world_object.secondary_fire = secondary
-                    if not self.filter_visibility_data:
-                        weapon_input.player_id = self.player_id
-                        weapon_input.primary = primary
-                        weapon_input.secondary = secondary
-                        self.protocol.send_contained(weapon_input)
-                input.clear()
-
-        def set_tool(self, tool):
-            if self.on_tool_set_attempt(tool) is False:
-                return
-            self.tool = tool
-            self.on_tool_changed(self.tool)
-            if self.filter_visibility_data:
-                return
-            set_tool.player_id = self.player_id
-            set_tool.value = self.tool
-            self.protocol.send_contained(set_tool)
-
-        def left_spade(self):
-            obj = self.world_object
-            pos = obj.position
-            ori = obj.orientation
-
-            if self.world_object.dead:
-                return
-            if self.protocol.loop_count - self.spade_count < 24:
-                return
-            else:
-                self.spade_count = self.protocol.loop_count
-            for player in self.team.other.get_players():
-                if (player.world_object) and (not player.world_object.dead):
-                    if ((vector_collision(pos, player.world_object.position, 3)) and
-                            (obj.validate_hit(player.world_object, MELEE, 5))):
-                        hit_amount = 50
-                        type = MELEE_KILL
-                        self.on_hit(hit_amount, player, type, None)
-                        player.hit(hit_amount, self, type)
-                        # knockback
-                        if not player.local:
-                            player.input = set()
-                            player.input.add("jump")
-                            player.flush_input()
+        def filter_input(self, input):
+            input = self.avoid_crowd(input)
+            if self.bot_type == 2:
+                # the mirrored bot jumps along with the player
+                self.state.jump_count = self.protocol.loop_count
+                return input
+            return connection.filter_input(self, input)
 
         def on_spawn(self, pos):
             self.speedhack_detect = False
@@ -647,12 +458,12 @@ def apply_script(protocol, connection, config):
             else:
                 self.set_tool(SPADE_TOOL)
             self.aim_at = None
-            self.spade_count = 0
-            self.jump_count = 0
+            self.state.held_input = None
+            self.state.spade_count = 0
+            self.state.jump_count = 0
             self.sec = 15
             self.sec2 = 15
             self.ticks_stumped = 0
-            self.ticks_stumped2 = 0
             self.ticks_stumped3 = 0
             self.last_pos.set(*pos)
             connection.on_spawn(self, pos)
@@ -717,7 +528,7 @@ def apply_script(protocol, connection, config):
             if not self.local and jump:
                 for i in self.protocol.players.values():
                     if i.local and i.bot_type == 2:
-                        i.input.add("jump")
+                        i.state.input |= INPUT_JUMP
             return connection.on_animation_update(self, jump, crouch, sneak, sprint)
 
         def on_kill(self, killer, type, grenade):
@@ -756,28 +567,21 @@ def apply_script(protocol, connection, config):
                 return False
             return connection.on_block_destroy(self, x, y, z, mode)
 
-        def _send_connection_data(self):
-            if self.local:
-                if self.player_id is None:
-                    self.player_id = self.protocol.player_ids.pop()
-                return
-            connection._send_connection_data(self)
-
-        def send_map(self, data=None):
-            if self.local:
-                self.on_join()
-                return
-            connection.send_map(self, data)
-
-        def timer_received(self, value):
-            if self.local:
-                return
-            connection.timer_received(self, value)
-
-        def send_loader(self, loader, acyk=False, byte=0):
-            if self.local:
-                return
-            return connection.send_loader(self, loader, ack, byte)
+        def on_block_build(self, x, y, z):
+            self.protocol.los_cache.invalidate(x, y, z)
+            self.protocol.navigator.on_block_changed(x, y)
+            return connection.on_block_build(self, x, y, z)
+
+        def on_line_build(self, points):
+            for x, y, z in points:
+                self.protocol.los_cache.invalidate(x, y, z)
+                self.protocol.navigator.on_block_changed(x, y)
+            return connection.on_line_build(self, points)
+
+        def on_block_removed(self, x, y, z):
+            self.protocol.los_cache.invalidate(x, y, z)
+            self.protocol.navigator.on_block_changed(x, y)
+            return connection.on_block_removed(self, x, y, z)
 
         def msg(self, sender, message, echo=0):
             if self.world_object is None:
@@ -0,0 +1,1493 @@
+"""
+botengine.py by IAmYourFriend https://github.com/1AmYF
+
+botengine.py is the shared engine of the bot gamemodes botstc, survive,
+adventure and botspractice. It is not a script or gamemode of its own, put it
+into the scripts folder next to the bot gamemodes, which import it.
+
+The engine joins local bots to the game and moves them: on every world update
+a bot holds the buttons its behaviour picked, turns towards its target
+orientation and sends only the parts of its input that changed. A gamemode
+applies the engine first and then adds its behaviour by overriding these
+callbacks of the connection:
+
+    think()
+        Pick a target and set the buttons to hold (state.input) until the
+        next think. Called by update_bots() once every bot_think_rate world
+        updates.
+    update()
+        Hold the buttons, turn and send the input. Modes that decide on every
+        world update can replace it and call flush_input() themselves.
+    filter_input(input)
+        Change the buttons right before they are sent, e.g. to step aside.
+    get_bot_name(), get_bot_weapon()
+        Name and weapon of a new bot.
+
+The engine state of every bot (and human, for the knockback) lives in a
+BotState with __slots__, so the hot path reads fixed slots instead of the
+attribute dict of the connection. It also owns the vectors a bot reuses on
+every update instead of creating new ones (last_seen for the last visible aim
+point, scratch for temporaries).
+
+Melee hits of bots (left_spade()) are collected and resolved together once per
+world update, in the order of the player ids, against a grid of the players
+near the swings. Knockbacks are sent after all hits.
+
+The engine also holds the parts of the bot AI the gamemodes share: the world
+snapshot, the target grid, the crowd map, the line of sight cache, the flow
+field navigator, the spawn index, the NumPy batch brain, the profiler and the
+population governor, as well as the admin commands that go with them (addbot,
+toggleai, loscache, batchai, aiperf). A gamemode registers the commands it
+supports and creates the parts it uses on every map change.
+"""
+
+from pyspades.server import input_data, weapon_input, set_tool
+from pyspades.common import Vertex3
+from pyspades.collision import vector_collision
+from pyspades.constants import *
+from commands import admin, get_team
+from enet import Address
+from math import cos, sin, floor, sqrt, isnan
+from array import array
+from collections import deque
+from timeit import default_timer
+import random
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+INPUT_UP = 1 << 0  # bits of the buttons a bot holds
+INPUT_DOWN = 1 << 1
+INPUT_LEFT = 1 << 2
+INPUT_RIGHT = 1 << 3
+INPUT_JUMP = 1 << 4
+INPUT_CROUCH = 1 << 5
+INPUT_SNEAK = 1 << 6
+INPUT_SPRINT = 1 << 7
+INPUT_PRIMARY_FIRE = 1 << 8
+INPUT_SECONDARY_FIRE = 1 << 9
+INPUT_MOVEMENT = 0xFF  # sent with InputData
+INPUT_WEAPON = INPUT_PRIMARY_FIRE | INPUT_SECONDARY_FIRE  # sent with WeaponInput
+MAX_CONNECTIONS = 32
+BOT_TURN_SPEED = 0.15  # rads per tick
+JUMP_INTERVAL = 30  # world updates
+SPADE_INTERVAL = 24  # world updates
+SPADE_DISTANCE = 3
+MAP_SIZE = 512
+GRID_CELL_SIZE = 32  # 16x16 cells for the target grid
+MELEE_DISTANCE = 2.0
+AIPERF_SAMPLES = 4096  # latest timings kept per profiled step
+AIPERF_WORST_BOTS = 3
+GOVERNOR_WINDOW = 300  # world updates measured for each decision (5 seconds)
+GOVERNOR_HEADROOM = 0.5  # restore when the slow updates use less than half the budget
+GOVERNOR_QUIET_WINDOWS = 3  # windows in a row with headroom before restoring
+GOVERNOR_BOTS_MIN = 4
+GOVERNOR_BOTS_STEP = 2  # bots removed or restored per decision
+GOVERNOR_RESPAWN_STEP = 2  # seconds
+GOVERNOR_RESPAWN_MAX = 10  # seconds
+LOS_CACHE_TTL = 6  # world updates
+LOS_INVALIDATE_DISTANCE = 1.5  # blocks from the ray
+NAV_CLUSTER_SIZE = 8  # targets in the same 8x8 columns share a flow field
+FLOW_FIELD_RADIUS = 64  # columns searched around a target cluster
+FLOW_FIELD_BUDGET = 2048  # columns expanded per world update
+FLOW_FIELD_TTL = 300  # world updates an unused flow field is kept
+FLOW_STEP_HEIGHT = 1  # blocks a bot can climb by jumping
+FLOW_DROP_HEIGHT = 3  # blocks a bot is willing to drop down
+FLOW_UNREACHED = 0xFFFF
+FLOW_DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1))
+HEIGHT_FIELD_ROWS = 8  # rows of columns read per world update after a map change
+CROWD_RADIUS = 1.0  # teammates closer than this push a bot aside
+CROWD_YIELD = 0.5  # a bot pushed back this hard stops walking forward
+SPAWN_INDEX_BUDGET = 4096  # columns searched per world update
+SPAWN_ANCHOR_RADIUS = 16  # the search also starts from a ring around every anchor
+SPAWN_HEADROOM = 3  # free blocks a player needs above the ground to spawn
+WATER_Z = 63
+
+
+class LocalPeer:
+    address = Address("localhost", 0)
+    roundTripTime = 0.0
+
+    def send(self, *arg, **kw):
+        pass
+
+    def reset(self):
+        pass
+
+
+class BotState(object):
+    __slots__ = ("input", "sent_input", "held_input", "aim", "target_orientation",
+                 "turn_speed", "turn_vector", "jump_count", "spade_count", "last_seen",
+                 "scratch")
+
+    def __init__(self):
+        self.input = 0
+        self.sent_input = 0
+        self.held_input = None
+        self.aim = Vertex3()
+        self.target_orientation = Vertex3()
+        self.last_seen = Vertex3()
+        self.scratch = Vertex3()
+        self.jump_count = 0
+        self.spade_count = 0
+        self.set_turn_speed(BOT_TURN_SPEED)
+
+    def set_turn_speed(self, value):
+        self.turn_speed = value
+        self.turn_vector = Vertex3(cos(value), sin(value), 0.0)
+
+
+class MeleeGrid:
+    """Living players by team and by cells of SPADE_DISTANCE blocks."""
+
+    def __init__(self):
+        self.cells = {}
+
+    def build(self, players):
+        cells = self.cells
+        cells.clear()
+        for player in players:
+            obj = player.world_object
+            if obj is None or obj.dead or player.team is None:
+                continue
+            pos = obj.position
+            key = (player.team.id, int(pos.x // SPADE_DISTANCE), int(pos.y // SPADE_DISTANCE))
+            cells.setdefault(key, []).append(player)
+
+    def get_near(self, team, x, y):
+        cells = self.cells
+        cell_x = int(x // SPADE_DISTANCE)
+        cell_y = int(y // SPADE_DISTANCE)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for player in cells.get((team.id, cell_x + dx, cell_y + dy), ()):
+                    yield player
+
+
+def get_input_mask(world_object):
+    """Returns the buttons a world object holds as INPUT_* bits."""
+    return ((INPUT_UP if world_object.up else 0) |
+            (INPUT_DOWN if world_object.down else 0) |
+            (INPUT_LEFT if world_object.left else 0) |
+            (INPUT_RIGHT if world_object.right else 0) |
+            (INPUT_JUMP if world_object.jump else 0) |
+            (INPUT_CROUCH if world_object.crouch else 0) |
+            (INPUT_SNEAK if world_object.sneak else 0) |
+            (INPUT_SPRINT if world_object.sprint else 0) |
+            (INPUT_PRIMARY_FIRE if world_object.primary_fire else 0) |
+            (INPUT_SECONDARY_FIRE if world_object.secondary_fire else 0))
+
+
+def set_input_mask(world_object, input):
+    world_object.set_walk(bool(input & INPUT_UP), bool(input & INPUT_DOWN),
+                          bool(input & INPUT_LEFT), bool(input & INPUT_RIGHT))
+    world_object.set_animation(bool(input & INPUT_JUMP), bool(input & INPUT_CROUCH),
+                               bool(input & INPUT_SNEAK), bool(input & INPUT_SPRINT))
+
+
+def make_input_data(player_id, input):
+    input_data.player_id = player_id
+    input_data.up = bool(input & INPUT_UP)
+    input_data.down = bool(input & INPUT_DOWN)
+    input_data.left = bool(input & INPUT_LEFT)
+    input_data.right = bool(input & INPUT_RIGHT)
+    input_data.jump = bool(input & INPUT_JUMP)
+    input_data.crouch = bool(input & INPUT_CROUCH)
+    input_data.sneak = bool(input & INPUT_SNEAK)
+    input_data.sprint = bool(input & INPUT_SPRINT)
+    return input_data
+
+
+@admin
+def addbot(connection, amount=None, team=None):
+    protocol = connection.protocol
+    if team:
+        bot_team = get_team(connection, team)
+    blue, green = protocol.blue_team, protocol.green_team
+    amount = int(amount or 1)
+    for i in xrange(amount):
+        if not team:
+            bot_team = blue if blue.count() < green.count() else green
+        bot = protocol.add_bot(bot_team)
+        if not bot:
+            return "Added %s bot(s)" % i
+    return "Added %s bot(s)" % amount
+
+
+@admin
+def toggleai(connection):
+    protocol = connection.protocol
+    protocol.ai_enabled = not protocol.ai_enabled
+    if not protocol.ai_enabled:
+        for bot in protocol.bots:
+            bot.state.held_input = None
+            bot.flush_input()
+    state = "enabled" if protocol.ai_enabled else "disabled"
+    protocol.send_chat("AI %s!" % state)
+    protocol.irc_say("* %s %s AI" % (connection.name, state))
+
+
+@admin
+def loscache(connection):
+    return connection.protocol.los_cache.get_stats()
+
+
+@admin
+def batchai(connection):
+    protocol = connection.protocol
+    if np is None:
+        return "NumPy is not installed, the batch brain is not available."
+    if protocol.batch_brain is None:
+        protocol.batch_brain = BatchBrain()
+    else:
+        protocol.batch_brain = None
+    brain = "batch" if protocol.batch_brain is not None else "per-bot"
+    protocol.irc_say("* %s switched the bots to the %s brain" % (connection.name, brain))
+    return "Bots now use the %s brain." % brain
+
+
+@admin
+def aiperf(connection, value=None):
+    protocol = connection.protocol
+    if protocol.ai_profiler is None:
+        protocol.ai_profiler = AIProfiler(protocol.get_profiled_methods())
+    profiler = protocol.ai_profiler
+    if value == "off":
+        profiler.stop()
+        return "AI profiling stopped."
+    if not profiler.is_running():
+        profiler.start()
+        return "AI profiling started, use /aiperf again to see the results."
+    for line in profiler.get_report():
+        connection.send_chat(line)
+
+
+class WorldSnapshot:
+    """
+    Compact table of the players in the world, built once at the start of
+    every world update. Bots read the position and state of other players
+    from these columns instead of going through connection and world objects.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.players = []
+        self.player_ids = array("B")
+        self.teams = array("b")
+        self.xs = array("d")
+        self.ys = array("d")
+        self.zs = array("d")
+        self.dead = array("B")
+        self.god = array("B")
+        self.local = array("B")
+        self.at_spawn = array("B")
+
+    def clear(self):
+        self.rows.clear()
+        del self.players[:]
+        for column in (self.player_ids, self.teams, self.xs, self.ys, self.zs,
+                       self.dead, self.god, self.local, self.at_spawn):
+            del column[:]
+
+    def add(self, player, at_spawn=False):
+        obj = player.world_object
+        x, y, z = obj.position.get()
+        self.rows[player.player_id] = len(self.players)
+        self.players.append(player)
+        self.player_ids.append(player.player_id)
+        self.teams.append(player.team.id)
+        self.xs.append(x)
+        self.ys.append(y)
+        self.zs.append(z)
+        self.dead.append(bool(obj.dead))
+        self.god.append(bool(player.god))
+        self.local.append(bool(player.local))
+        self.at_spawn.append(bool(at_spawn))
+
+    def get_row(self, player):
+        if player is None:
+            return -1
+        return self.rows.get(player.player_id, -1)
+
+    def get_position(self, row):
+        return self.xs[row], self.ys[row], self.zs[row]
+
+    def is_targetable(self, row):
+        return not (self.dead[row] or self.god[row] or self.at_spawn[row])
+
+
+def get_ring_cells(cx, cy, ring):
+    if ring == 0:
+        return [(cx, cy)]
+    cells = []
+    for gx in range(cx - ring, cx + ring + 1):
+        cells.append((gx, cy - ring))
+        cells.append((gx, cy + ring))
+    for gy in range(cy - ring + 1, cy + ring):
+        cells.append((cx - ring, gy))
+        cells.append((cx + ring, gy))
+    return cells
+
+
+class TargetGrid:
+    """
+    Uniform grid over the map holding the players bots are allowed to attack.
+    It is rebuilt once per world update, so a bot looking for the closest
+    enemy only has to check the cells around it instead of every player.
+    """
+
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells_per_row = MAP_SIZE // cell_size
+        self.cells = {}
+
+    def clear(self):
+        self.cells.clear()
+
+    def get_cell(self, x, y):
+        last = self.cells_per_row - 1
+        return (min(max(int(x) // self.cell_size, 0), last),
+                min(max(int(y) // self.cell_size, 0), last))
+
+    def add(self, player, x, y, z):
+        cell = self.get_cell(x, y)
+        entries = self.cells.get(cell)
+        if entries is None:
+            entries = self.cells[cell] = []
+        entries.append((player, x, y, z))
+
+    def nearest(self, x, y, z, max_distance):
+        """
+        Return the closest player and its distance, only considering players
+        closer than max_distance. Rings of cells are checked from the inside
+        out until no unchecked cell can contain anything closer.
+        """
+        best = None
+        best_distance = max_distance
+        if not self.cells:
+            return best, best_distance
+        cells = self.cells
+        cx, cy = self.get_cell(x, y)
+        for ring in range(self.cells_per_row):
+            if (ring - 1) * self.cell_size >= best_distance:
+                break
+            for cell in get_ring_cells(cx, cy, ring):
+                entries = cells.get(cell)
+                if entries is None:
+                    continue
+                for player, px, py, pz in entries:
+                    distance = sqrt((px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2)
+                    if distance < best_distance:
+                        best = player
+                        best_distance = distance
+        return best, best_distance
+
+
+class CrowdMap:
+    """
+    Living players per floor cell and team, filled from the world snapshot
+    once every world update. Bots ask it how hard their close teammates push
+    them away instead of comparing their position with every teammate.
+    """
+
+    def __init__(self):
+        self.cells = {}
+
+    def build(self, snapshot):
+        cells = self.cells
+        cells.clear()
+        for row in range(len(snapshot.players)):
+            if snapshot.dead[row]:
+                continue
+            key = (snapshot.teams[row], int(floor(snapshot.xs[row])),
+                   int(floor(snapshot.ys[row])))
+            rows = cells.get(key)
+            if rows is None:
+                cells[key] = [row]
+            else:
+                rows.append(row)
+
+    def get_push(self, snapshot, row):
+        """Sum of the pushes of all teammates closer than CROWD_RADIUS."""
+        team = snapshot.teams[row]
+        x, y, z = snapshot.get_position(row)
+        cx = int(floor(x))
+        cy = int(floor(y))
+        push_x = push_y = 0.0
+        for gx in (cx - 1, cx, cx + 1):
+            for gy in (cy - 1, cy, cy + 1):
+                rows = self.cells.get((team, gx, gy))
+                if rows is None:
+                    continue
+                for other in rows:
+                    if other == row or abs(snapshot.zs[other] - z) > 2:
+                        continue
+                    dx = x - snapshot.xs[other]
+                    dy = y - snapshot.ys[other]
+                    distance = sqrt(dx * dx + dy * dy)
+                    if distance >= CROWD_RADIUS:
+                        continue
+                    if distance < 0.001:
+                        # exactly on top of each other, split in opposite directions
+                        # picked from the lower player id
+                        own_id = snapshot.player_ids[row]
+                        other_id = snapshot.player_ids[other]
+                        angle = min(own_id, other_id) * 2.4
+                        if own_id > other_id:
+                            angle += 3.14159
+                        dx, dy, distance = cos(angle), sin(angle), 1.0
+                        weight = 1.0
+                    else:
+                        weight = (CROWD_RADIUS - distance) / (CROWD_RADIUS * distance)
+                    push_x += dx * weight
+                    push_y += dy * weight
+        return push_x, push_y
+
+
+def get_segment_distance_sqr(px, py, pz, ax, ay, az, bx, by, bz):
+    dx, dy, dz = bx - ax, by - ay, bz - az
+    length_sqr = dx * dx + dy * dy + dz * dz
+    t = 0.0
+    if length_sqr > 0:
+        t = ((px - ax) * dx + (py - ay) * dy + (pz - az) * dz) / length_sqr
+        t = min(max(t, 0.0), 1.0)
+    ex, ey, ez = ax + t * dx - px, ay + t * dy - py, az + t * dz - pz
+    return ex * ex + ey * ey + ez * ez
+
+
+class LineOfSightCache:
+    """
+    Remembers the raycast results of bots for a few world updates. A result
+    stays valid while both ends of the ray remain in the same blocks, and is
+    dropped as soon as a block close to the ray gets built or removed.
+    """
+
+    def __init__(self, ttl=LOS_CACHE_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.raycast_time = 0.0
+
+    def can_see(self, bot, target_id, x, y, z, loop_count):
+        obj = bot.world_object
+        bx, by, bz = obj.position.get()
+        key = (bot.player_id, target_id)
+        cells = (int(bx), int(by), int(bz), int(x), int(y), int(z))
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == cells and entry[2] > loop_count:
+            self.hits += 1
+            return entry[1]
+        start = default_timer()
+        result = obj.can_see(x, y, z)
+        self.raycast_time += default_timer() - start
+        self.misses += 1
+        self.entries[key] = (cells, result, loop_count + self.ttl, (bx, by, bz, x, y, z))
+        return result
+
+    def invalidate(self, x, y, z):
+        max_distance_sqr = LOS_INVALIDATE_DISTANCE ** 2
+        for key, entry in list(self.entries.items()):
+            if get_segment_distance_sqr(x + 0.5, y + 0.5, z + 0.5,
+                                        *entry[3]) <= max_distance_sqr:
+                del self.entries[key]
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return "LOS cache: no lookups yet"
+        raycast_avg = self.raycast_time / self.misses if self.misses else 0.0
+        return ("LOS cache: %.1f%% hits (%d of %d), %.1f us per raycast, "
+                "about %.1f ms saved" % (100.0 * self.hits / lookups, self.hits, lookups,
+                                         raycast_avg * 1000000, self.hits * raycast_avg * 1000))
+
+
+class HeightField:
+    """
+    Walkable surface of the map, the height a bot stands on for every column.
+    Reading all columns at once stalls the map change, so build() reads a few
+    rows per world update, the flow fields and the spawn index wait until the
+    field is complete. Columns are refreshed one at a time as blocks get built
+    or removed.
+    """
+
+    def __init__(self, map):
+        self.map = map
+        self.heights = array('B', [0]) * (MAP_SIZE * MAP_SIZE)
+        self.next_row = 0
+
+    def is_complete(self):
+        return self.next_row >= MAP_SIZE
+
+    def build(self, rows=HEIGHT_FIELD_ROWS):
+        get_z = self.map.get_z
+        heights = self.heights
+        end = min(MAP_SIZE, self.next_row + rows)
+        for y in xrange(self.next_row, end):
+            row = y * MAP_SIZE
+            for x in xrange(MAP_SIZE):
+                heights[row + x] = get_z(x, y)
+        self.next_row = end
+
+    def get_height(self, x, y):
+        return self.heights[x + y * MAP_SIZE]
+
+    def update_column(self, x, y):
+        if x < 0 or y < 0 or x >= MAP_SIZE or y >= MAP_SIZE:
+            return False
+        if y >= self.next_row:
+            return False  # the row is not read yet, build() reads the new height
+        height = self.map.get_z(x, y)
+        if self.heights[x + y * MAP_SIZE] == height:
+            return False
+        self.heights[x + y * MAP_SIZE] = height
+        return True
+
+
+def can_walk(from_height, to_height):
+    # z grows downwards, so a smaller height is a higher block
+    return (from_height - to_height <= FLOW_STEP_HEIGHT and
+            to_height - from_height <= FLOW_DROP_HEIGHT)
+
+
+class FlowField:
+    """
+    Walking distances towards one target cluster, limited to a square window
+    around it. The breadth-first search is spread over several world updates
+    and starts over when the surface inside the window changes, while bots
+    keep following the last complete search until the new one is done.
+    """
+
+    def __init__(self, heightfield, cluster_x, cluster_y, radius=FLOW_FIELD_RADIUS):
+        self.heightfield = heightfield
+        self.seed_x1 = cluster_x * NAV_CLUSTER_SIZE
+        self.seed_y1 = cluster_y * NAV_CLUSTER_SIZE
+        self.x1 = max(0, self.seed_x1 - radius)
+        self.y1 = max(0, self.seed_y1 - radius)
+        self.x2 = min(MAP_SIZE, self.seed_x1 + NAV_CLUSTER_SIZE + radius)
+        self.y2 = min(MAP_SIZE, self.seed_y1 + NAV_CLUSTER_SIZE + radius)
+        self.width = self.x2 - self.x1
+        self.last_used = 0
+        self.ready = None
+        self.reset()
+
+    def reset(self):
+        self.distances = array('H', [FLOW_UNREACHED]) * (self.width * (self.y2 - self.y1))
+        self.frontier = deque()
+        for y in range(self.seed_y1, self.seed_y1 + NAV_CLUSTER_SIZE):
+            for x in range(self.seed_x1, self.seed_x1 + NAV_CLUSTER_SIZE):
+                index = (x - self.x1) + (y - self.y1) * self.width
+                self.distances[index] = 0
+                self.frontier.append((x, y))
+
+    def contains(self, x, y):
+        return self.x1 <= x < self.x2 and self.y1 <= y < self.y2
+
+    def is_complete(self):
+        return not self.frontier
+
+    def expand(self, budget):
+        distances = self.distances
+        frontier = self.frontier
+        get_height = self.heightfield.get_height
+        x1, y1, x2, y2, width = self.x1, self.y1, self.x2, self.y2, self.width
+        expanded = 0
+        while frontier and expanded < budget:
+            x, y = frontier.popleft()
+            expanded += 1
+            height = get_height(x, y)
+            distance = distances[(x - x1) + (y - y1) * width] + 1
+            for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+                if nx < x1 or ny < y1 or nx >= x2 or ny >= y2:
+                    continue
+                index = (nx - x1) + (ny - y1) * width
+                if distances[index] != FLOW_UNREACHED:
+                    continue
+                # the search runs backwards, from the target to the bots
+                if can_walk(get_height(nx, ny), height):
+                    distances[index] = distance
+                    frontier.append((nx, ny))
+        if not frontier:
+            self.ready = distances
+        return expanded
+
+    def get_step(self, x, y):
+        """
+        Returns the direction towards the neighbouring column that is closest
+        to the cluster, and whether the bot has to jump to get there.
+        Returns None when the column has not been reached by the search.
+        """
+        distances = self.ready
+        if distances is None or not self.contains(x, y):
+            return None
+        best = distances[(x - self.x1) + (y - self.y1) * self.width]
+        if best == FLOW_UNREACHED or best == 0:
+            return None
+        get_height = self.heightfield.get_height
+        height = get_height(x, y)
+        step = None
+        for dx, dy in FLOW_DIRECTIONS:
+            nx, ny = x + dx, y + dy
+            if not self.contains(nx, ny):
+                continue
+            distance = distances[(nx - self.x1) + (ny - self.y1) * self.width]
+            if distance >= best or not can_walk(height, get_height(nx, ny)):
+                continue
+            if dx and dy and (not can_walk(height, get_height(nx, y)) or
+                              not can_walk(height, get_height(x, ny))):
+                continue  # don't cut corners
+            best = distance
+            step = (dx, dy, get_height(nx, ny) < height)
+        return step
+
+
+class FlowFieldNavigator:
+    """
+    Keeps one flow field per target cluster and shares the search budget
+    between them. Fields nobody asked for in a while are dropped. Until the
+    height field is complete, update() builds it instead.
+    """
+
+    def __init__(self, map):
+        self.heightfield = HeightField(map)
+        self.fields = {}
+
+    def get_field(self, x, y, loop_count):
+        key = (int(x) // NAV_CLUSTER_SIZE, int(y) // NAV_CLUSTER_SIZE)
+        field = self.fields.get(key)
+        if field is None:
+            field = self.fields[key] = FlowField(self.heightfield, key[0], key[1])
+        field.last_used = loop_count
+        return field
+
+    def get_step(self, x, y, target_x, target_y, loop_count):
+        field = self.get_field(target_x, target_y, loop_count)
+        return field.get_step(int(x), int(y))
+
+    def update(self, loop_count):
+        if not self.heightfield.is_complete():
+            self.heightfield.build()
+            return
+        budget = FLOW_FIELD_BUDGET
+        for key, field in list(self.fields.items()):
+            if loop_count - field.last_used > FLOW_FIELD_TTL:
+                del self.fields[key]
+            elif budget > 0 and not field.is_complete():
+                budget -= field.expand(budget)
+
+    def on_block_changed(self, x, y):
+        if not self.heightfield.update_column(x, y):
+            return
+        for field in self.fields.values():
+            if field.contains(x, y):
+                field.reset()
+
+
+class SpawnArea:
+    def __init__(self, x1, y1, x2, y2):
+        self.x1 = max(0, x1)
+        self.y1 = max(0, y1)
+        self.x2 = min(MAP_SIZE - 1, x2)
+        self.y2 = min(MAP_SIZE - 1, y2)
+        self.width = self.x2 - self.x1 + 1
+        self.candidates = array("I")
+        self.listed = bytearray(self.width * (self.y2 - self.y1 + 1))
+        self.next_row = self.y1
+        self.complete = False
+
+    def add(self, x, y):
+        """Adds the column to the candidates, unless it is listed or its row is not collected yet."""
+        if x < self.x1 or x > self.x2 or y < self.y1 or y >= self.next_row:
+            return
+        slot = x - self.x1 + (y - self.y1) * self.width
+        if not self.listed[slot]:
+            self.listed[slot] = 1
+            self.candidates.append(x + y * MAP_SIZE)
+
+    def remove(self, i):
+        candidates = self.candidates
+        index = candidates[i]
+        self.listed[index % MAP_SIZE - self.x1 + (index // MAP_SIZE - self.y1) * self.width] = 0
+        candidates[i] = candidates[-1]
+        candidates.pop()
+
+
+class SpawnIndex:
+    """
+    Columns worth spawning on: not water, and a bot can walk from there to one
+    of the anchors (spawn centers and bases). Anchors are often on top of or
+    inside buildings, so the search starts from a ring of columns around each
+    anchor as well. It is started once the height field is complete and runs
+    over several world updates, after it the candidates of every spawn area are collected, until
+    then spawns fall back to random columns. A changed column is checked again
+    against its neighbours, and when it can be walked on now the search goes on
+    from there, adding the columns it reaches to the candidates. A candidate
+    also needs room for a player above the ground, which is checked when it
+    gets picked, candidates that turned bad are dropped then.
+    """
+
+    def __init__(self, heightfield):
+        self.heightfield = heightfield
+        self.reached = bytearray(MAP_SIZE * MAP_SIZE)
+        self.frontier = None
+        self.searched = False
+        self.areas = {}
+        self.pending = deque()
+
+    def is_started(self):
+        return self.frontier is not None
+
+    def start(self, anchors, radius=SPAWN_ANCHOR_RADIUS):
+        self.frontier = deque()
+        for x, y in anchors:
+            x, y = int(x), int(y)
+            self.add_seed(x, y)
+            for i in xrange(-radius, radius):
+                self.add_seed(x + i, y - radius)
+                self.add_seed(x + radius, y + i)
+                self.add_seed(x - i, y + radius)
+                self.add_seed(x - radius, y - i)
+
+    def add_seed(self, x, y):
+        if x < 0 or y < 0 or x >= MAP_SIZE or y >= MAP_SIZE:
+            return
+        index = x + y * MAP_SIZE
+        if self.heightfield.heights[index] < WATER_Z and not self.reached[index]:
+            self.reached[index] = 1
+            self.frontier.append(index)
+
+    def update(self, budget=SPAWN_INDEX_BUDGET):
+        if self.frontier is None:
+            return
+        budget -= self.expand(budget)
+        if self.frontier:
+            return
+        self.searched = True
+        while budget > 0 and self.pending:
+            budget -= self.collect(self.pending[0], budget)
+
+    def expand(self, budget):
+        heights = self.heightfield.heights
+        reached = self.reached
+        frontier = self.frontier
+        searched = self.searched
+        expanded = 0
+        while frontier and expanded < budget:
+            index = frontier.popleft()
+            expanded += 1
+            height = heights[index]
+            x, y = index % MAP_SIZE, index // MAP_SIZE
+            for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+                if nx < 0 or ny < 0 or nx >= MAP_SIZE or ny >= MAP_SIZE:
+                    continue
+                neighbour = nx + ny * MAP_SIZE
+                if reached[neighbour] or heights[neighbour] >= WATER_Z:
+                    continue
+                # the search runs backwards, from the anchors to the spawns
+                if can_walk(heights[neighbour], height):
+                    reached[neighbour] = 1
+                    frontier.append(neighbour)
+                    if searched:
+                        # continued after a block change, the areas are collected
+                        self.add_candidate(nx, ny)
+        return expanded
+
+    def collect(self, area, budget):
+        reached = self.reached
+        listed = area.listed
+        collected = 0
+        while collected < budget and area.next_row <= area.y2:
+            row = area.next_row * MAP_SIZE
+            slot = (area.next_row - area.y1) * area.width - area.x1 - row
+            for index in xrange(row + area.x1, row + area.x2 + 1):
+                if reached[index]:
+                    listed[slot + index] = 1
+                    area.candidates.append(index)
+            collected += area.width
+            area.next_row += 1
+        if area.next_row > area.y2:
+            area.complete = True
+            self.pending.popleft()
+        return collected
+
+    def add_candidate(self, x, y):
+        for area in self.areas.values():
+            area.add(x, y)
+
+    def has_room(self, x, y):
+        """
+        Whether a player spawned on the column finds SPAWN_HEADROOM free blocks
+        above its ground, in all four columns around the spawn point (a spawn
+        point is the corner of its column).
+        """
+        height = self.heightfield.heights[x + y * MAP_SIZE]
+        if height < SPAWN_HEADROOM:
+            return False
+        get_solid = self.heightfield.map.get_solid
+        for cx in (x - 1, x):
+            for cy in (y - 1, y):
+                if cx < 0 or cy < 0:
+                    continue
+                for z in xrange(height - SPAWN_HEADROOM, height):
+                    if get_solid(cx, cy, z):
+                        return False
+        return True
+
+    def sample(self, x1, y1, x2, y2):
+        """
+        Returns a random candidate (x, y) inside the area, corners included, or
+        None while the area is not indexed yet or has no candidates left. The
+        candidates are not weighted, every walkable column of the area is as
+        likely to be picked.
+        """
+        key = (x1, y1, x2, y2)
+        area = self.areas.get(key)
+        if area is None:
+            area = self.areas[key] = SpawnArea(x1, y1, x2, y2)
+            self.pending.append(area)
+        if not area.complete:
+            return None
+        heights = self.heightfield.heights
+        candidates = area.candidates
+        while candidates:
+            i = random.randrange(len(candidates))
+            index = candidates[i]
+            x, y = index % MAP_SIZE, index // MAP_SIZE
+            if self.reached[index] and heights[index] < WATER_Z and self.has_room(x, y):
+                return x, y
+            area.remove(i)
+        return None
+
+    def on_block_changed(self, x, y):
+        if not self.searched:
+            return  # the running search reads the new height by itself
+        heights = self.heightfield.heights
+        index = x + y * MAP_SIZE
+        height = heights[index]
+        reached = 0
+        if height < WATER_Z:
+            for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+                if nx < 0 or ny < 0 or nx >= MAP_SIZE or ny >= MAP_SIZE:
+                    continue
+                neighbour = nx + ny * MAP_SIZE
+                if self.reached[neighbour] and can_walk(height, heights[neighbour]):
+                    reached = 1
+                    break
+        self.reached[index] = reached
+        if reached:
+            # the neighbours may be walkable from here now
+            self.frontier.append(index)
+        # the block can also take or give room to the spawns on the columns
+        # whose spawn point is next to it
+        for cx in (x, x + 1):
+            for cy in (y, y + 1):
+                if cx < MAP_SIZE and cy < MAP_SIZE and self.reached[cx + cy * MAP_SIZE]:
+                    self.add_candidate(cx, cy)
+
+
+class BatchBrain:
+    """
+    NumPy version of the think and turn steps of the bots. Target choice, aim
+    vectors, the melee range test and turning are worked out for all bots in
+    one pass; only the line of sight and the flow field are asked per bot.
+    """
+
+    def think(self, snapshot, bots):
+        for bot in bots:
+            bot.state.held_input = None
+        bots = [bot for bot in bots if bot.can_think()]
+        if not bots:
+            return
+        positions = np.array([bot.world_object.position.get() for bot in bots])
+
+        if snapshot.players:
+            targets = np.column_stack((np.array(snapshot.xs, dtype=np.float64),
+                                       np.array(snapshot.ys, dtype=np.float64),
+                                       np.array(snapshot.zs, dtype=np.float64)))
+            targetable = ~(np.array(snapshot.dead, dtype=bool) |
+                           np.array(snapshot.god, dtype=bool) |
+                           np.array(snapshot.at_spawn, dtype=bool))
+            teams = np.array(snapshot.teams, dtype=np.int16)
+            enemy_teams = np.array([bot.team.other.id for bot in bots], dtype=np.int16)
+            deltas = targets[np.newaxis, :, :] - positions[:, np.newaxis, :]
+            distances = np.sqrt((deltas * deltas).sum(axis=2))
+            distances[~((teams[np.newaxis, :] == enemy_teams[:, np.newaxis]) &
+                        targetable[np.newaxis, :])] = np.inf
+            nearest = distances.argmin(axis=1)
+            nearest_distances = distances[np.arange(len(bots)), nearest]
+            for i, bot in enumerate(bots):
+                if (bot.distance_to_aim is not None and
+                        nearest_distances[i] < bot.distance_to_aim):
+                    bot.aim_at = snapshot.players[nearest[i]]
+                    bot.last_aim = None
+
+        aims = [bot.get_aim_point() for bot in bots]
+        aiming = [i for i, aim in enumerate(aims) if aim is not None]
+        if aiming:
+            vectors = np.array([aims[i][:3] for i in aiming]) - positions[aiming]
+            lengths = np.sqrt((vectors * vectors).sum(axis=1))
+            vectors /= np.where(lengths > 0.0, lengths, 1.0)[:, np.newaxis]
+            in_reach = lengths <= MELEE_DISTANCE
+            for j, i in enumerate(aiming):
+                bot = bots[i]
+                bot.state.aim.set(*vectors[j])
+                bot.distance_to_aim = float(lengths[j])
+                bot.act(*aims[i], in_reach=bool(in_reach[j]))
+        for i, bot in enumerate(bots):
+            if aims[i] is None:
+                bot.last_aim = None
+                bot.distance_to_aim = float("inf")
+            bot.state.held_input = bot.state.input
+
+    def update(self, bots):
+        bots = [bot for bot in bots
+                if not bot.world_object.dead and bot.state.held_input is not None]
+        if not bots:
+            return
+        orientations = np.array([bot.world_object.orientation.get() for bot in bots])
+        targets = np.array([bot.state.target_orientation.get() for bot in bots])
+        turns = np.array([(bot.state.turn_vector.x, bot.state.turn_vector.y) for bot in bots])
+        ox, oy = orientations[:, 0], orientations[:, 1]
+        tx, ty = targets[:, 0], targets[:, 1]
+        diff = (ox - tx) ** 2 + (oy - ty) ** 2
+        p_dot = ox * ty - oy * tx
+        # rotating the other way is the same as rotating by the mirrored vector
+        cos_turn = turns[:, 0]
+        sin_turn = np.where(p_dot > 0.0, turns[:, 1], -turns[:, 1])
+        rotated_x = ox * cos_turn - oy * sin_turn
+        rotated_y = ox * sin_turn + oy * cos_turn
+        new_p_dot = rotated_x * ty - rotated_y * tx
+        snap = (diff <= 0.001) | (new_p_dot * p_dot < 0.0)
+        rotated = np.column_stack((rotated_x, rotated_y, orientations[:, 2]))
+        orientations = np.where(snap[:, np.newaxis], targets, rotated)
+        for bot, orientation in zip(bots, orientations.tolist()):
+            bot.state.input |= bot.state.held_input
+            bot.world_object.set_orientation(*orientation)
+            bot.flush_input()
+
+
+class TimingRing:
+    """Fixed size ring buffer of the latest durations, in seconds."""
+
+    def __init__(self, size=AIPERF_SAMPLES):
+        self.samples = array("d", [0.0]) * size
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def get_percentiles(self, fractions):
+        values = sorted(self.samples[:min(self.count, len(self.samples))])
+        if not values:
+            return None
+        return [values[min(len(values) - 1, int(f * len(values)))] for f in fractions]
+
+
+class AIProfiler:
+    """
+    Times the expensive steps of the bots while it is running. The methods are
+    only wrapped with the timing code while profiling, so a stopped profiler
+    costs nothing. Targets are (class, method name, label, per bot) tuples.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.rings = {}
+        self.bot_times = {}
+        self.originals = []
+
+    def is_running(self):
+        return len(self.originals) > 0
+
+    def start(self):
+        self.rings = {}
+        self.bot_times = {}
+        for cls, name, label, per_bot in self.targets:
+            self.rings[label] = TimingRing()
+            self.originals.append((cls, name, cls.__dict__.get(name)))
+            setattr(cls, name, self.wrap(getattr(cls, name), self.rings[label], per_bot))
+
+    def stop(self):
+        for cls, name, original in reversed(self.originals):
+            if original is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, original)
+        del self.originals[:]
+
+    def wrap(self, method, ring, per_bot):
+        bot_times = self.bot_times
+
+        def timed(self, *arg, **kw):
+            start = default_timer()
+            try:
+                return method(self, *arg, **kw)
+            finally:
+                elapsed = default_timer() - start
+                ring.add(elapsed)
+                if per_bot:
+                    bot_times[self.name] = bot_times.get(self.name, 0.0) + elapsed
+        return timed
+
+    def get_report(self, worst=AIPERF_WORST_BOTS):
+        lines = []
+        for cls, name, label, per_bot in self.targets:
+            ring = self.rings[label]
+            percentiles = ring.get_percentiles((0.5, 0.95, 0.99))
+            if percentiles is not None:
+                lines.append("%s: p50 %.3f p95 %.3f p99 %.3f ms (%d calls)" % (
+                    label, percentiles[0] * 1000, percentiles[1] * 1000,
+                    percentiles[2] * 1000, ring.count))
+        worst_bots = sorted(self.bot_times.items(), key=lambda item: item[1],
+                            reverse=True)[:worst]
+        if worst_bots:
+            lines.append("Worst bots: " + ", ".join("%s %.1f ms" % (name, total * 1000)
+                                                    for name, total in worst_bots))
+        if not lines:
+            lines.append("No bot activity measured yet.")
+        return lines
+
+
+class PopulationGovernor:
+    """
+    Keeps the bots within a time budget per world update. The gamemode passes
+    the time its bots took, without the map work it does in the same update.
+    When the slowest updates (95th percentile over a window) take longer than
+    the budget, bots are removed and the bots that are left respawn slower. Once
+    there is headroom for a while, both are restored step by step. A budget of 0
+    disables the governor.
+    """
+
+    def __init__(self, budget_ms):
+        self.budget = budget_ms / 1000.0
+        self.times = TimingRing(GOVERNOR_WINDOW)
+        self.bot_limit = None
+        self.respawn_delay = 0
+        self.quiet_windows = 0
+
+    def limit(self, bot_amount):
+        if self.bot_limit is None:
+            return bot_amount
+        return min(bot_amount, self.bot_limit)
+
+    def update(self, elapsed, bot_count, wanted_bots):
+        """Returns a message for the admins when the bot population changed."""
+        if not self.budget:
+            return None
+        self.times.add(elapsed)
+        if self.times.count < GOVERNOR_WINDOW:
+            return None
+        slow = self.times.get_percentiles((0.95,))[0]
+        self.times.clear()
+        if slow < self.budget * GOVERNOR_HEADROOM:
+            self.quiet_windows += 1
+        else:
+            self.quiet_windows = 0
+        if slow > self.budget:
+            if bot_count <= GOVERNOR_BOTS_MIN and self.respawn_delay >= GOVERNOR_RESPAWN_MAX:
+                return None
+            if bot_count > GOVERNOR_BOTS_MIN:
+                self.bot_limit = max(GOVERNOR_BOTS_MIN, bot_count - GOVERNOR_BOTS_STEP)
+            self.respawn_delay = min(GOVERNOR_RESPAWN_MAX,
+                                     self.respawn_delay + GOVERNOR_RESPAWN_STEP)
+            return ("Server busy (%.1f of %.1f ms per update), bots reduced to %s, "
+                    "respawn time +%s s" % (slow * 1000, self.budget * 1000,
+                                            self.limit(bot_count), self.respawn_delay))
+        if self.quiet_windows >= GOVERNOR_QUIET_WINDOWS:
+            if self.bot_limit is None and not self.respawn_delay:
+                return None
+            self.quiet_windows = 0
+            if self.bot_limit is not None:
+                self.bot_limit += GOVERNOR_BOTS_STEP
+                if self.bot_limit >= wanted_bots:
+                    self.bot_limit = None
+            self.respawn_delay = max(0, self.respawn_delay - GOVERNOR_RESPAWN_STEP)
+            if self.bot_limit is None and not self.respawn_delay:
+                return "Server load is back to normal, bots fully restored"
+            return "Server load dropped, bots restored to %s, respawn time +%s s" % (
+                self.limit(wanted_bots), self.respawn_delay)
+        return None
+
+
+def notify_admins(protocol, message):
+    for player in protocol.players.values():
+        if player.admin:
+            player.send_chat(message)
+    protocol.irc_say("* %s" % message)
+
+
+def apply_script(protocol, connection, config):
+    class BotEngineProtocol(protocol):
+        bots = None
+        bot_think_rate = 1
+        melee_swings = None
+        melee_grid = None
+        ai_enabled = True
+        ai_profiler = None
+        batch_brain = None
+        governor = None
+        snapshot = None
+        crowd = None
+        los_cache = None
+        navigator = None
+        spawn_index = None
+        target_grids = None
+
+        def __init__(self, *arg, **kw):
+            protocol.__init__(self, *arg, **kw)
+            self.melee_swings = []
+            self.melee_grid = MeleeGrid()
+
+        def add_bot(self, team, *arg):
+            if len(self.connections) + len(self.bots) >= MAX_CONNECTIONS:
+                return None
+            bot = self.connection_class(self, None)
+            bot.join_game(team, *arg)
+            self.bots.append(bot)
+            return bot
+
+        def update_bots(self):
+            think_rate = self.bot_think_rate
+            for i, bot in enumerate(self.bots):
+                if (self.loop_count + i) % think_rate == 0:
+                    bot.think()
+                bot.update()
+
+        def on_world_update(self):
+            if self.melee_swings:
+                self.resolve_melee()
+            protocol.on_world_update(self)
+
+        def resolve_melee(self):
+            swings = self.melee_swings
+            swings.sort(key=lambda bot: bot.player_id)
+            grid = self.melee_grid
+            grid.build(self.players.values())
+            knocked = []
+            for bot in swings:
+                obj = bot.world_object
+                if obj is None or obj.dead or bot.team is None:
+                    continue
+                pos = obj.position
+                for player in grid.get_near(bot.team.other, pos.x, pos.y):
+                    if player.world_object.dead:
+                        continue
+                    if ((vector_collision(pos, player.world_object.position, SPADE_DISTANCE)) and
+                            (obj.validate_hit(player.world_object, MELEE, 5))):
+                        hit_amount = bot.melee_damage
+                        type = MELEE_KILL
+                        bot.on_hit(hit_amount, player, type, None)
+                        player.hit(hit_amount, bot, type)
+                        if not player.local and player not in knocked:
+                            knocked.append(player)
+            del swings[:]
+            for player in knocked:
+                if not player.world_object.dead:
+                    player.state.input = INPUT_JUMP
+                    player.flush_input()
+
+        def update_snapshot(self):
+            snapshot = self.snapshot
+            snapshot.clear()
+            for player in self.players.values():
+                if player.world_object is not None and player.team is not None:
+                    snapshot.add(player)
+            self.crowd.build(snapshot)
+
+        def update_target_grids(self):
+            snapshot = self.snapshot
+            for grid in self.target_grids.values():
+                grid.clear()
+            for row in range(len(snapshot.players)):
+                grid = self.target_grids.get(snapshot.teams[row])
+                if grid is not None and snapshot.is_targetable(row):
+                    grid.add(snapshot.players[row], *snapshot.get_position(row))
+
+        def get_spawn_point(self, x1, y1, x2, y2):
+            spawn = self.spawn_index.sample(x1, y1, x2, y2)
+            if spawn is None:
+                spawn = random.randint(x1, x2), random.randint(y1, y2)
+            return spawn
+
+        def update_governor(self, elapsed):
+            message = self.governor.update(elapsed, len(self.bots),
+                                           self.get_bot_amount())
+            if message is None:
+                return
+            self.fit_bot_amount()
+            notify_admins(self, message)
+
+        def get_profiled_methods(self):
+            """(class, method name, label, per bot) of the steps /aiperf times."""
+            connection_class = self.connection_class
+            targets = [(type(self), "on_world_update", "on_world_update", False),
+                       (type(self), "resolve_melee", "melee", False)]
+            for name in ("think", "update", "flush_input", "left_spade"):
+                targets.append((connection_class, name, name, name in ("think", "update")))
+            return targets
+
+    class BotEngineConnection(connection):
+        state = None
+        melee_damage = 50
+        aim_at = None
+        last_aim = None
+        last_pos = None
+        distance_to_aim = None
+
+        def __init__(self, protocol, peer):
+            self.state = BotState()
+            self.last_pos = Vertex3()
+            if peer is not None:
+                return connection.__init__(self, protocol, peer)
+            self.local = True
+            self.rapid_hack_detect = False
+            self.speedhack_detect = False
+            connection.__init__(self, protocol, LocalPeer())
+            self.on_connect()
+            self._send_connection_data()
+            self.send_map()
+
+        def get_bot_name(self):
+            return "Bot" + str(self.player_id)
+
+        def get_bot_weapon(self):
+            return RIFLE_WEAPON
+
+        def join_game(self, team):
+            self.name = self.get_bot_name()
+            self.team = team
+            self.set_weapon(self.get_bot_weapon(), True)
+            self.protocol.players[(self.name, self.player_id)] = self
+            self.on_login(self.name)
+            self.spawn()
+
+        def disconnect(self, data=0):
+            if not self.local:
+                return connection.disconnect(self)
+            if self.disconnected:
+                return
+            self.protocol.bots.remove(self)
+            self.disconnected = True
+            self.on_disconnect()
+
+        def think(self):
+            pass
+
+        def update(self):
+            state = self.state
+            if self.world_object.dead or state.held_input is None:
+                return
+            state.input |= state.held_input
+            self.turn()
+            self.flush_input()
+
+        def turn(self):
+            obj = self.world_object
+            ori = obj.orientation
+            target_orientation = self.state.target_orientation
+            # orientate towards target
+            diff = self.state.scratch
+            diff.set(ori.x - target_orientation.x, ori.y - target_orientation.y, 0.0)
+            if diff.length_sqr() > 0.001:
+                p_dot = ori.perp_dot(target_orientation)
+                if p_dot > 0.0:
+                    ori.rotate(self.state.turn_vector)
+                else:
+                    ori.unrotate(self.state.turn_vector)
+                new_p_dot = ori.perp_dot(target_orientation)
+                if new_p_dot * p_dot < 0.0:
+                    ori.set_vector(target_orientation)
+            else:
+                ori.set_vector(target_orientation)
+
+            obj.set_orientation(ori.x, ori.y, ori.z)
+
+        def filter_input(self, input):
+            state = self.state
+            if self.protocol.loop_count - state.jump_count < JUMP_INTERVAL:
+                input &= ~INPUT_JUMP
+            else:
+                state.jump_count = self.protocol.loop_count
+            return input
+
+        def flush_input(self):
+            state = self.state
+            input = state.input
+            world_object = self.world_object
+            pos = world_object.position
+            if not self.world_object.dead:
+                if self.local:
+                    input = self.filter_input(input)
+                else:
+                    # knockback of a human, whose buttons come from the client
+                    state.sent_input = get_input_mask(world_object)
+
+                changed = input ^ state.sent_input
+                if changed & INPUT_MOVEMENT:
+                    if self.freeze_animation:
+                        movement = state.sent_input & INPUT_MOVEMENT
+                    else:
+                        if input & INPUT_SPRINT and not input & INPUT_JUMP:
+                            m_x = state.aim.x + pos.x
+                            m_y = state.aim.y + pos.y
+                            m_z = pos.z
+                            if not isnan(m_x) and not isnan(m_y) and not isnan(m_z):
+                                if not self.protocol.map.get_solid(m_x, m_y, m_z):
+                                    self.set_location((m_x, m_y, m_z))
+
+                        set_input_mask(world_object, input)
+                        movement = input & INPUT_MOVEMENT
+                    if (not self.filter_visibility_data and
+                            not self.filter_animation_data):
+                        input_data = make_input_data(self.player_id, movement)
+                        self.protocol.send_contained(input_data)
+                    # the world update uses up the jump
+                    state.sent_input = (state.sent_input & INPUT_WEAPON) | (movement & ~INPUT_JUMP)
+                if changed & INPUT_WEAPON:
+                    primary = bool(input & INPUT_PRIMARY_FIRE)
+                    secondary = bool(input & INPUT_SECONDARY_FIRE)
+                    if changed & INPUT_PRIMARY_FIRE:
+                        if self.tool == WEAPON_TOOL:
+                            self.weapon_object.set_shoot(primary)
+                        if self.tool == WEAPON_TOOL or self.tool == SPADE_TOOL:
+                            self.on_shoot_set(primary)
+                    world_object.primary_fire = primary
+                    world_object.secondary_fire = secondary
+                    if not self.filter_visibility_data:
+                        weapon_input.player_id = self.player_id
+                        weapon_input.primary = primary
+                        weapon_input.secondary = secondary
+                        self.protocol.send_contained(weapon_input)
+                    state.sent_input = (state.sent_input & INPUT_MOVEMENT) | (input & INPUT_WEAPON)
+                state.input = 0
+
+        def choose_target(self):
+            if self.distance_to_aim is None:
+                return
+            pos = self.world_object.position
+            grid = self.protocol.target_grids[self.team.other.id]
+            nearest, distance_to_new_aim = grid.nearest(pos.x, pos.y, pos.z,
+                                                        self.distance_to_aim)
+            if nearest is not None:
+                self.aim_at = nearest
+                self.last_aim = None
+
+        def get_aim_point(self):
+            snapshot = self.protocol.snapshot
+            target_row = snapshot.get_row(self.aim_at)
+            if target_row < 0:
+                return None
+            aim_x, aim_y, aim_z = snapshot.get_position(target_row)
+            aim_is_target = True
+            los_cache = self.protocol.los_cache
+            if los_cache.can_see(self, self.aim_at.player_id, aim_x, aim_y, aim_z,
+                                 self.protocol.loop_count):
+                self.state.last_seen.set(aim_x, aim_y, aim_z)
+                self.last_aim = self.state.last_seen
+            elif self.last_aim is not None:
+                aim_x, aim_y, aim_z = self.last_aim.get()
+                aim_is_target = False
+            return aim_x, aim_y, aim_z, aim_is_target
+
+        def steer(self, aim_x, aim_y):
+            pos = self.world_object.position
+            step = self.protocol.navigator.get_step(pos.x, pos.y, aim_x, aim_y,
+                                                    self.protocol.loop_count)
+            if step is None:
+                self.state.target_orientation.set(self.state.aim.x, self.state.aim.y, 0.0)
+                return False
+            dx, dy, climb = step
+            # head for the centre of the next column on the way
+            self.state.target_orientation.set(floor(pos.x) + dx + 0.5 - pos.x,
+                                              floor(pos.y) + dy + 0.5 - pos.y, 0.0)
+            self.state.target_orientation.normalize()
+            if climb:
+                self.state.input |= INPUT_JUMP
+            return True
+
+        def avoid_crowd(self, input):
+            snapshot = self.protocol.snapshot
+            row = snapshot.get_row(self)
+            if row < 0:
+                return input
+            push_x, push_y = self.protocol.crowd.get_push(snapshot, row)
+            if push_x == 0.0 and push_y == 0.0:
+                return input
+            orientation = self.world_object.orientation
+            forward = push_x * orientation.x + push_y * orientation.y
+            side = push_y * orientation.x - push_x * orientation.y
+            if side > 0:
+                input &= ~INPUT_LEFT
+                input |= INPUT_RIGHT
+            elif side < 0:
+                input &= ~INPUT_RIGHT
+                input |= INPUT_LEFT
+            if forward < -CROWD_YIELD:
+                input &= ~INPUT_UP
+            return input
+
+        def set_tool(self, tool):
+            if self.on_tool_set_attempt(tool) is False:
+                return
+            self.tool = tool
+            if self.tool == WEAPON_TOOL:
+                self.on_shoot_set(self.world_object.primary_fire)
+                self.weapon_object.set_shoot(self.world_object.primary_fire)
+            self.on_tool_changed(self.tool)
+            if self.filter_visibility_data:
+                return
+            set_tool.player_id = self.player_id
+            set_tool.value = self.tool
+            self.protocol.send_contained(set_tool)
+
+        def left_spade(self):
+            obj = self.world_object
+            if obj.dead:
+                return
+            state = self.state
+            if self.protocol.loop_count - state.spade_count < SPADE_INTERVAL:
+                return
+            else:
+                state.spade_count = self.protocol.loop_count
+            self.protocol.melee_swings.append(self)
+
+        def on_spawn(self, pos):
+            # spawning resets the buttons of the world object
+            self.state.sent_input = 0
+            return connection.on_spawn(self, pos)
+
+        def on_fall(self, damage):
+            if self.local:
+                return False
+            return connection.on_fall(self, damage)
+
+        def _send_connection_data(self):
+            if self.local:
+                if self.player_id is None:
+                    self.player_id = self.protocol.player_ids.pop()
+                return
+            connection._send_connection_data(self)
+
+        def send_map(self, data=None):
+            if self.local:
+                self.on_join()
+                return
+            connection.send_map(self, data)
+
+        def timer_received(self, value):
+            if self.local:
+                return
+            connection.timer_received(self, value)
+
+        def send_loader(self, loader, ack=False, byte=0):
+            if self.local:
+                return
+            return connection.send_loader(self, loader, ack, byte)
+
+    return BotEngineProtocol, BotEngineConnection
@@ -17,6 +17,8 @@ Setup:
         "block_refills" : 1,
         "ammo_refills" : 1
 
+    Put blockedit.py into the scripts folder next to this script.
+
 Commands:
 
     /builder
@@ -28,11 +30,10 @@ Commands:
 """
 
 from pyspades.constants import *
-from pyspades.contained import BlockAction, SetColor
-from pyspades.server import block_action, weapon_reload
-from pyspades.common import make_color
+from pyspades.server import weapon_reload
 from commands import add, alias
 from random import choice
+from blockedit import BlockEdit
 
 BUILDER_HEAL_RATE = 5
 SAPPER_HIT_AMOUNT = 0.6
@@ -74,22 +75,6 @@ def is_invalid_coord(x, y, z):
     return x < 0 or y < 0 or z < 0 or x > 511 or y > 511 or z > 61
 
 
-def build_block(connection, x, y, z, color):
-    if is_invalid_coord(x, y, z):
-        return
-    set_color = SetColor()
-    set_color.value = make_color(*color)
-    set_color.player_id = 32
-    connection.protocol.send_contained(set_color)
-    block_action.player_id = 32
-    block_action.x = x
-    block_action.y = y
-    block_action.z = z
-    block_action.value = BUILD_BLOCK
-    connection.protocol.map.set_point(x, y, z, color)
-    connection.protocol.send_contained(block_action, save=True)
-
-
 def build_grenade_structure(connection, position):
     x = int(position.x)
     y = int(position.y)
@@ -99,9 +84,13 @@ def build_grenade_structure(connection, position):
                  (x, y - 1, z - 1), (x, y, z - 2), (x + 1, y, z - 2), (x - 1, y, z - 2),
                  (x, y + 1, z - 2), (x, y - 1, z - 2), (x, y, z - 3), (x + 1, y, z - 3),
                  (x - 1, y, z - 3), (x, y + 1, z - 3), (x, y - 1, z - 3)]
+    edit = BlockEdit(connection.protocol)
     for pos in structure:
+        if is_invalid_coord(*pos):
+            continue
         if connection.on_block_build_attempt(pos[0], pos[1], pos[2]) is not False:
-            build_block(connection, pos[0], pos[1], pos[2], connection.color)
+            edit.build(pos[0], pos[1], pos[2], connection.color)
+    edit.commit()
 
 
 def apply_script(protocol, connection, config):
@@ -0,0 +1,273 @@
+"""
+mapcache.py by IAmYourFriend https://github.com/1AmYF
+
+Keeps the parsed maps in memory, so a map that comes up again in the rotation
+is copied instead of parsed from its .vxl file again. For big maps like the
+push maps, parsing takes about 200 ms in which the whole server stands still,
+copying a parsed map takes about 25 ms. The maps are kept by the hash of their
+.vxl file, so a changed file is parsed again. Parsing holds the interpreter
+lock, so parsing the maps into the cache with /prewarmmaps stalls the server
+for every map just the same, better do it while the server is empty (or set
+PREWARM).
+
+A parsed map takes about 15 MB of memory. When more than MAX_MAPS maps are
+cached, the map that was loaded the longest time ago is dropped.
+
+The next map of the rotation is also loaded ahead on a worker thread, once the
+current map has less than PREFETCH_TIME left and as soon as the rotation
+advances (e.g. after a successful /next vote of votenext.py, during the 10
+seconds until the map changes), if it is cached. The map change then only
+swaps in the loaded map. A map that is not cached is not parsed ahead, that
+would move the stall into the current map. If the next map is not cached,
+loading ahead failed, is not done yet or the next map was changed (e.g. with
+/setmap), the map is loaded the usual way. tools/mapcachebench.py measures
+how long the server stands still for parsing and copying a map on a worker
+thread.
+
+Commands:
+
+    /prewarmmaps
+        Parse the maps of the rotation into the cache on a worker thread, one
+        map per second, as many as the cache keeps.
+    /mapcache
+        Show the cached maps and how long the last map loads took.
+"""
+
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict, deque
+from timeit import default_timer
+from twisted.internet import reactor, threads
+from twisted.internet.reactor import callLater
+from pyspades.vxl import VXLData
+from commands import add, admin
+from map import Map, MapNotFound
+
+# Maps kept in memory
+MAX_MAPS = 8
+
+# Parse all maps of the rotation into the cache after the server started
+PREWARM = False
+
+# Seconds left on the current map when the next map is loaded ahead
+PREFETCH_TIME = 120
+
+PREWARM_INTERVAL = 1.0  # seconds between two maps parsed by /prewarmmaps
+RECENT_LOADS = 5
+
+
+@admin
+def prewarmmaps(connection):
+    return start_prewarm(connection.protocol)
+
+
+@admin
+def mapcache(connection):
+    return connection.protocol.map_cache.get_report()
+
+
+add(prewarmmaps)
+add(mapcache)
+
+
+def start_prewarm(protocol):
+    """Starts parsing the maps of the rotation, returns a message about it."""
+    count, skipped = protocol.prewarm_maps()
+    message = "Parsing %s maps into the cache." % count
+    if skipped:
+        message += " %s maps skipped, the cache keeps %s maps (MAX_MAPS)." % (
+            skipped, protocol.map_cache.max_maps)
+    return message
+
+
+def get_map_dir():
+    return os.path.join(os.getcwd(), "maps")
+
+
+class MapCache:
+    """
+    Parsed maps by the hash of their .vxl file, the most recently loaded last.
+    The cached maps are never changed, loading returns a copy. Maps can be
+    loaded from any thread.
+    """
+
+    def __init__(self, max_maps):
+        self.max_maps = max_maps
+        self.maps = OrderedDict()
+        self.names = {}
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=RECENT_LOADS)
+
+    def load(self, path):
+        """Returns a new VXLData of the .vxl file at path."""
+        start = default_timer()
+        with open(path, "rb") as fp:
+            data = fp.read()
+        key = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            parsed = self.maps.pop(key, None)
+            if parsed is not None:
+                self.maps[key] = parsed
+        hit = parsed is not None
+        if not hit:
+            parsed = VXLData(io.BytesIO(data))
+            self.store(key, os.path.basename(path), parsed)
+        vxl = parsed.copy()
+        self.recent.append((os.path.basename(path), hit, default_timer() - start))
+        return vxl
+
+    def store(self, key, name, parsed):
+        with self.lock:
+            self.maps[key] = parsed
+            self.names[key] = name
+            while len(self.maps) > self.max_maps:
+                old_key = next(iter(self.maps))
+                del self.maps[old_key]
+                del self.names[old_key]
+
+    def is_cached(self, path):
+        with open(path, "rb") as fp:
+            key = hashlib.sha1(fp.read()).hexdigest()
+        with self.lock:
+            return key in self.maps
+
+    def prewarm(self, path):
+        """Parses the .vxl file at path into the cache, unless it is cached."""
+        with open(path, "rb") as fp:
+            data = fp.read()
+        key = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            if key in self.maps:
+                return
+        self.store(key, os.path.basename(path), VXLData(io.BytesIO(data)))
+
+    def get_report(self):
+        with self.lock:
+            names = [self.names[key] for key in self.maps]
+        if not names:
+            return "No maps cached."
+        message = "Cached: %s." % ", ".join(names)
+        if self.recent:
+            message += " Last loads: %s." % ", ".join(
+                "%s %.0f ms (%s)" % (name, seconds * 1000, "cached" if hit else "parsed")
+                for name, hit, seconds in self.recent)
+        return message
+
+
+class CachedMap(Map):
+    """A map of the rotation that takes its map data from a MapCache."""
+
+    def __init__(self, rot_info, load_dir, cache):
+        self.cache = cache
+        Map.__init__(self, rot_info, load_dir)
+
+    def load_vxl(self, rot_info):
+        path = rot_info.get_map_filename(self.load_dir)
+        if not os.path.isfile(path):
+            raise MapNotFound(rot_info.name)
+        self.data = self.cache.load(path)
+
+
+def load_cached_map(rot_info, cache):
+    """
+    Returns the map of rot_info if its .vxl file is cached, otherwise None. A
+    map that is not cached is left to the map change, parsing it ahead would
+    stall the game just the same, only in the middle of the current map.
+    """
+    path = rot_info.get_map_filename(get_map_dir())
+    if not os.path.isfile(path) or not cache.is_cached(path):
+        return None
+    return CachedMap(rot_info, get_map_dir(), cache)
+
+
+def apply_script(protocol, connection, config):
+    class MapCacheProtocol(protocol):
+        map_cache = None
+        prefetch = None  # [rotation info, the map loaded ahead or None]
+        prefetch_call = None
+
+        def __init__(self, *arg, **kwargs):
+            # the first map is loaded while the protocol is set up
+            self.map_cache = MapCache(MAX_MAPS)
+            protocol.__init__(self, *arg, **kwargs)
+            if PREWARM:
+                callLater(PREWARM_INTERVAL, self.print_prewarm)
+
+        def get_map(self, rot_info):
+            prefetch, self.prefetch = self.prefetch, None
+            if prefetch is not None and prefetch[0] is rot_info and prefetch[1] is not None:
+                return prefetch[1]
+            return CachedMap(rot_info, get_map_dir(), self.map_cache)
+
+        def on_advance(self, rot_info):
+            self.prefetch_map(rot_info)
+            protocol.on_advance(self, rot_info)
+
+        def set_time_limit(self, *arg, **kw):
+            time_limit = protocol.set_time_limit(self, *arg, **kw)
+            if self.prefetch_call is not None and self.prefetch_call.active():
+                self.prefetch_call.cancel()
+            self.prefetch_call = None
+            if self.advance_call is not None and PREFETCH_TIME > 0:
+                time_left = self.advance_call.getTime() - reactor.seconds()
+                self.prefetch_call = callLater(max(0, time_left - PREFETCH_TIME),
+                                               self.prefetch_next_map)
+            return time_limit
+
+        def prefetch_next_map(self):
+            self.prefetch_call = None
+            # settle the next map now, so the rotation advances to the map loaded ahead
+            if self.planned_map is None:
+                self.planned_map = next(self.map_rotator)
+            self.prefetch_map(self.planned_map)
+
+        def prefetch_map(self, rot_info):
+            if self.prefetch is not None and self.prefetch[0] is rot_info:
+                return
+            prefetch = [rot_info, None]
+            self.prefetch = prefetch
+            deferred = threads.deferToThread(load_cached_map, rot_info, self.map_cache)
+            deferred.addCallback(prefetch.__setitem__, 1)
+            deferred.addErrback(self.on_prefetch_failed, rot_info)
+
+        def on_prefetch_failed(self, failure, rot_info):
+            print "Loading map '%s' ahead failed: %s" % (rot_info.full_name,
+                                                         failure.getErrorMessage())
+
+        def prewarm_maps(self):
+            """
+            Parses the maps of the rotation into the cache on a worker thread,
+            one after another. Returns the amount of maps to parse and the
+            amount of maps skipped because the cache does not keep them.
+            """
+            paths = []
+            for rot_info in self.maps:
+                path = rot_info.get_map_filename(get_map_dir())
+                if os.path.isfile(path) and path not in paths:
+                    paths.append(path)
+            # only as many as the cache keeps, the first ones come up first
+            skipped = max(0, len(paths) - self.map_cache.max_maps)
+            paths = deque(paths[:self.map_cache.max_maps])
+            count = len(paths)
+            self.prewarm_next_map(paths)
+            return count, skipped
+
+        def prewarm_next_map(self, paths):
+            if not paths:
+                return
+            path = paths.popleft()
+            deferred = threads.deferToThread(self.map_cache.prewarm, path)
+            deferred.addErrback(self.on_prewarm_failed, path)
+            deferred.addCallback(lambda _: callLater(PREWARM_INTERVAL, self.prewarm_next_map,
+                                                     paths))
+
+        def on_prewarm_failed(self, failure, path):
+            print "Parsing map '%s' into the cache failed: %s" % (path,
+                                                                  failure.getErrorMessage())
+
+        def print_prewarm(self):
+            print start_prewarm(self)
+
+    return MapCacheProtocol, connection
@@ -25,6 +25,10 @@ Usage example:
     You can toggle /mbreg or /mb all the time if you want to pause
     the feature and build normal again.
 
+Setup:
+
+    Put blockedit.py into the scripts folder next to this script.
+
 Commands:
 
     /mbreg
@@ -51,13 +55,10 @@ Commands:
         List all multibuild commands.
 """
 
-from pyspades.constants import *
-from pyspades.contained import BlockAction, SetColor
-from pyspades.server import block_action
-from pyspades.common import make_color
 from commands import add, admin
 from math import atan2, pi, sqrt
 from twisted.internet.reactor import callLater
+from blockedit import BlockEdit
 
 
 BUILD_DELAY = 0.04
@@ -194,34 +195,6 @@ def is_invalid_coord(x, y, z):
     return x < 0 or y < 0 or z < 0 or x > 511 or y > 511 or z > 62
 
 
-def build_block(connection, x, y, z, color):
-    set_color = SetColor()
-    set_color.value = make_color(*color)
-    set_color.player_id = 32
-    connection.protocol.send_contained(set_color)
-    block_action.player_id = 32
-    block_action.x = x
-    block_action.y = y
-    block_action.z = z
-    block_action.value = BUILD_BLOCK
-    connection.protocol.map.set_point(x, y, z, color)
-    connection.protocol.send_contained(block_action, save=True)
-
-
-def destroy_block(connection, x, y, z):
-    if connection.protocol.map.get_solid(x, y, z):
-        block_action.player_id = connection.player_id
-        block_action.x = x
-        block_action.y = y
-        block_action.z = z
-        block_action.value = DESTROY_BLOCK
-        if z == 62:
-            connection.protocol.map.remove_point(x, y, z)
-        else:
-            connection.protocol.map.destroy_point(x, y, z)
-        connection.protocol.send_contained(block_action, save=True)
-
-
 def get_direction(self):
     return int(round(atan2(self.world_object.orientation.y,
                            self.world_object.orientation.x) / pi * 2) % 4)
@@ -261,7 +234,7 @@ def get_multiblock_diff(self, regblock, xyz_new):
 
 
 def rollout_multiblocks(self, coord, destroy=False):
-    delay = 0
+    edit = BlockEdit(self.protocol, self.player_id if destroy else 32)
     first = True
     for regblock in reversed(self.regblocks):
         if first:
@@ -275,11 +248,10 @@ def rollout_multiblocks(self, coord, destroy=False):
             continue
         is_solid = self.protocol.map.get_solid(mb_x, mb_y, mb_z)
         if destroy and is_solid:
-            callLater(delay, destroy_block, self, mb_x, mb_y, mb_z)
-            delay += BUILD_DELAY
+            edit.remove(mb_x, mb_y, mb_z)
         elif not destroy and not is_solid:
-            callLater(delay, build_block, self, mb_x, mb_y, mb_z, self.color)
-            delay += BUILD_DELAY
+            edit.build(mb_x, mb_y, mb_z, self.color)
+    edit.commit()
 
 
 def apply_script(protocol, connection, config):
@@ -0,0 +1,370 @@
+"""
+botbench.py runs one of the bot gamemodes (botstc.py, survive.py or
+botspractice.py from scripts/piqueserver) headlessly and measures how expensive
+it is per world update, without a live server or real clients.
+
+The pyspades server classes do the actual game simulation (world physics,
+spawning, hits and kills), only the network parts are replaced by stand-ins.
+Human players are fake connections on a counting version of the LocalPeer the
+bot modes use for their bots; they wander around the map in random directions.
+
+Requirements:
+
+    A Python 3 environment with piqueserver installed (the scripts import
+    pyspades and piqueserver modules). numpy is needed for --set batch_ai=1.
+
+Usage:
+
+    python tools/botbench.py botstc --map bots-tc/level1 --humans 4 --bots 26
+    python tools/botbench.py survive --map survive/borderpatrol --ticks 7200
+    python tools/botbench.py survive --set bot_think_rate=1
+
+    Options given with --set are passed to the gamemode like options in the
+    server config. batch_ai=1 switches botstc/survive to the NumPy batch brain.
+
+The report shows the distribution of the time spent in on_world_update (the
+cost of the gamemode itself) and in the world physics, the packets broadcast
+per world update and the messages the gamemode sent to the admins (e.g. when it
+reduced the bots, use --set bot_tick_budget=0 to keep the bot amount fixed).
+
+    python tools/botbench.py survive --humans 1 --warmup 0 --check-governor
+
+    --check-governor fails when the governor reduced the bots or delayed their
+    respawns during the run. With a single human the bots have little to do, so
+    right after the map change (--warmup 0) the map work the mode spreads over
+    the first world updates must not cut the bots.
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+from collections import Counter
+from timeit import default_timer
+
+from pyspades.constants import (RIFLE_WEAPON, UPDATE_FREQUENCY, UPDATE_FPS,
+                                NETWORK_FPS)
+from pyspades.player import ServerConnection
+from pyspades.server import ServerProtocol
+from pyspades.types import IDPool
+from pyspades.vxl import VXLData
+from pyspades import world
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(ROOT_DIR, "scripts", "piqueserver")
+MAPS_DIR = os.path.join(ROOT_DIR, "maps")
+
+DEFAULT_MAPS = {
+    "botstc": "bots-tc/level1",
+    "survive": "survive/borderpatrol",
+    "botspractice": "ctf-modes/whatever",
+}
+WANDER_TICKS = (60, 240)  # world updates a human keeps walking one way
+NETWORK_INTERVAL = int(UPDATE_FPS / NETWORK_FPS)
+
+
+class MapInfo:
+    """The parts of piqueserver's map info the bot modes read."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rot_info = self
+        self.extensions = {}
+        namespace = {}
+        with open(os.path.join(MAPS_DIR, name + ".txt")) as f:
+            exec(f.read(), namespace)
+        self.extensions = namespace.get("extensions", {})
+        self.data = VXLData(open(os.path.join(MAPS_DIR, name + ".vxl"), "rb"))
+
+
+class PacketCounter:
+    def __init__(self):
+        self.broadcasts = Counter()
+        self.broadcast_bytes = 0
+        self.sent = 0
+
+    def reset(self):
+        self.broadcasts.clear()
+        self.broadcast_bytes = 0
+        self.sent = 0
+
+
+class HeadlessProtocol(ServerProtocol):
+    """ServerProtocol without the enet host, master server and IRC."""
+
+    master_hosts = []
+    max_connections_per_ip = 0
+
+    def __init__(self):
+        self.connections = {}
+        self.clients = {}
+        self.entities = []
+        self.players = {}
+        self.player_ids = IDPool()
+        self._create_teams()
+        self.world = world.World()
+        self.pos_table = [(0, 0, 0)]
+        self.loop_count = 0
+        self.packets = PacketCounter()
+        self.irc_messages = []
+
+    def irc_say(self, msg, me=False):
+        self.irc_messages.append((self.loop_count, msg))
+
+    def broadcast_contained(self, contained, *arg, **kw):
+        self.packets.broadcasts[type(contained).__name__] += 1
+        return ServerProtocol.broadcast_contained(self, contained, *arg, **kw)
+
+    def update_master(self):
+        pass
+
+    def on_map_leave(self):
+        pass
+
+
+class HeadlessConnection(ServerConnection):
+    """The attributes the bot modes expect from piqueserver's connection."""
+
+    god = False
+    deaf = False
+    admin = False
+
+    def on_join(self):
+        pass
+
+
+def load_mode(name):
+    # the bot modes load botengine.py like a script, which is also looked up on
+    # sys.path when it is not in the scripts folder of the server config
+    if SCRIPTS_DIR not in sys.path:
+        sys.path.append(SCRIPTS_DIR)
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(SCRIPTS_DIR, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def set_bot_amount(mode_name, mode, protocol, amount):
+    # the modes add and remove bots on their own whenever somebody spawns,
+    # pin their limits so they settle on the requested amount
+    if mode_name == "botstc":
+        mode.BOTS_MAX = amount
+        difficulty = protocol.bots_difficulty
+        protocol.bots_difficulty = (difficulty[0], amount, 0) + tuple(difficulty[3:])
+    elif mode_name == "survive":
+        mode.BOTS_MIN = mode.BOTS_MAX = amount
+        mode.BOTS_PER_PLAYER = 0
+    elif mode_name == "botspractice":
+        mode.BOT_AMOUNT = amount
+
+
+def make_peer_class(mode):
+    class CountingPeer(mode.botengine.LocalPeer):
+        counter = None
+
+        def send(self, *arg, **kw):
+            self.counter.sent += 1
+
+        def disconnect_later(self, data=0):
+            pass
+
+    return CountingPeer
+
+
+def parse_options(values):
+    options = {}
+    for value in values:
+        key, _, option = value.partition("=")
+        try:
+            option = int(option)
+        except ValueError:
+            pass
+        options[key] = option
+    return options
+
+
+class Benchmark:
+    def __init__(self, mode_name, map_name, humans, bots, options, seed):
+        random.seed(seed)
+        self.mode_name = mode_name
+        self.mode = load_mode(mode_name)
+        if hasattr(self.mode, "get_now_in_secs"):
+            # run the mode on game time, the benchmark is faster than real time
+            self.start_secs = int(time.time())
+            self.mode.get_now_in_secs = self.get_now_in_secs
+        protocol_class, connection_class = self.mode.apply_script(
+            HeadlessProtocol, HeadlessConnection, options)
+        protocol_class.connection_class = connection_class
+        self.connection_class = connection_class
+        self.peer_class = make_peer_class(self.mode)
+
+        protocol = self.protocol = protocol_class()
+        set_bot_amount(mode_name, self.mode, protocol, bots)
+        protocol.map_info = MapInfo(map_name)
+        protocol.set_map(protocol.map_info.data)
+        if options.get("batch_ai") and mode_name in ("botstc", "survive"):
+            protocol.batch_brain = self.mode.botengine.BatchBrain()
+
+        self.humans = [self.add_human(i) for i in range(humans)]
+        self.wander = {}
+        self.respawns = {}
+
+    def get_now_in_secs(self):
+        return self.start_secs + int(self.protocol.loop_count / UPDATE_FPS)
+
+    def add_human(self, number):
+        protocol = self.protocol
+        peer = self.peer_class()
+        peer.counter = protocol.packets
+        human = self.connection_class(protocol, peer)
+        protocol.connections[peer] = human
+        human.player_id = protocol.player_ids.pop()
+        human.name = "Human%s" % number
+        human.team = protocol.blue_team
+        human.set_weapon(RIFLE_WEAPON, True)
+        protocol.players[human.player_id] = human
+        human.on_team_join(human.team)
+        human.on_login(human.name)
+        human.spawn()
+        if self.mode_name == "botstc":
+            # bots leave players on the spawn floor alone, send them out
+            x, y = protocol.spawn_center
+            spread = protocol.bots_spawn_range // 2
+            x = min(max(x + random.randint(-spread, spread), 0), 511)
+            y = min(max(y + random.randint(-spread, spread), 0), 511)
+            human.set_location_safe((x, y, protocol.map.get_z(x, y) - 2))
+        return human
+
+    def move_humans(self):
+        loop_count = self.protocol.loop_count
+        for human in self.humans:
+            obj = human.world_object
+            if obj is None or obj.dead:
+                continue
+            if self.wander.get(human, 0) <= loop_count:
+                self.wander[human] = loop_count + random.randint(*WANDER_TICKS)
+                x, y = random.uniform(-1.0, 1.0), random.uniform(-1.0, 1.0)
+                obj.set_orientation(x, y, 0.0)
+                obj.set_walk(True, False, False, False)
+            obj.set_animation(random.random() < 0.01, False, False, False)
+
+    def respawn_players(self):
+        # the respawn timers of pyspades run on the reactor, which is not
+        # running here, so dead players are respawned by counting updates
+        loop_count = self.protocol.loop_count
+        players = self.humans + (self.protocol.bots or [])
+        for player in players:
+            if player.spawn_call is None:
+                continue
+            due = self.respawns.get(player)
+            if due is None:
+                self.respawns[player] = loop_count + int(
+                    player.get_respawn_time() * UPDATE_FPS)
+            elif due <= loop_count:
+                del self.respawns[player]
+                player.spawn_call.cancel()
+                player.spawn()
+
+    def run(self, ticks):
+        protocol = self.protocol
+        world_times = []
+        mode_times = []
+        broadcasts = []
+        sent = []
+        bot_counts = []
+        limited = []
+        packet_types = Counter()
+        for i in range(ticks):
+            protocol.packets.reset()
+            self.move_humans()
+            protocol.loop_count += 1
+            start = default_timer()
+            protocol.world.update(UPDATE_FREQUENCY)
+            world_done = default_timer()
+            protocol.on_world_update()
+            mode_done = default_timer()
+            if protocol.loop_count % NETWORK_INTERVAL == 0:
+                protocol.update_network()
+            self.respawn_players()
+            world_times.append((world_done - start) * 1000)
+            mode_times.append((mode_done - world_done) * 1000)
+            broadcasts.append(sum(protocol.packets.broadcasts.values()))
+            sent.append(protocol.packets.sent)
+            bot_counts.append(len(protocol.bots or []))
+            governor = protocol.governor
+            limited.append(governor is not None and (governor.bot_limit is not None or
+                                                     governor.respawn_delay > 0))
+            packet_types.update(protocol.packets.broadcasts)
+        return {
+            "world": world_times,
+            "mode": mode_times,
+            "broadcasts": broadcasts,
+            "sent": sent,
+            "bots": bot_counts,
+            "limited": limited,
+            "packet_types": packet_types,
+        }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def format_distribution(label, values, unit):
+    return ("%-18s mean %7.3f  p50 %7.3f  p95 %7.3f  p99 %7.3f  max %7.3f %s" % (
+        label, sum(values) / len(values), percentile(values, 0.5),
+        percentile(values, 0.95), percentile(values, 0.99), max(values), unit))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Headless benchmark of the bot gamemodes.")
+    parser.add_argument("mode", choices=sorted(DEFAULT_MAPS))
+    parser.add_argument("--map", help="map below maps/ without extension, e.g. survive/pyramidtown")
+    parser.add_argument("--humans", type=int, default=4)
+    parser.add_argument("--bots", type=int, default=16)
+    parser.add_argument("--ticks", type=int, default=3600,
+                        help="world updates to simulate (%d per second)" % UPDATE_FPS)
+    parser.add_argument("--warmup", type=int, default=120,
+                        help="world updates to run before measuring")
+    parser.add_argument("--set", action="append", default=[], metavar="OPTION=VALUE",
+                        help="gamemode option, like in the server config")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check-governor", action="store_true",
+                        help="fail if the governor reduced the bots during the run")
+    args = parser.parse_args(args)
+    if args.humans + args.bots > 32:
+        parser.error("there is only room for 32 players")
+
+    map_name = args.map or DEFAULT_MAPS[args.mode]
+    benchmark = Benchmark(args.mode, map_name, args.humans, args.bots,
+                          parse_options(args.set), args.seed)
+    benchmark.run(args.warmup)
+    result = benchmark.run(args.ticks)
+
+    ticks = float(args.ticks)
+    print("%s on %s: %d humans, %.1f bots on average, %d world updates (%.1f s)" % (
+        args.mode, map_name, args.humans, sum(result["bots"]) / ticks, args.ticks,
+        args.ticks / float(UPDATE_FPS)))
+    print(format_distribution("on_world_update", result["mode"], "ms"))
+    print(format_distribution("world physics", result["world"], "ms"))
+    print(format_distribution("broadcasts", result["broadcasts"], "per update"))
+    print(format_distribution("packets to humans", result["sent"], "per update"))
+    print("broadcast packet types per update:")
+    for name, count in result["packet_types"].most_common():
+        print("    %-18s %7.3f" % (name, count / ticks))
+    if benchmark.protocol.irc_messages:
+        print("messages to admins:")
+        for loop_count, message in benchmark.protocol.irc_messages:
+            print("    %6d %s" % (loop_count, message))
+    if args.check_governor and any(result["limited"]):
+        print("governor check failed: the bots were reduced after %d world updates" % (
+            args.warmup + result["limited"].index(True) + 1))
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
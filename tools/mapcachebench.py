@@ -0,0 +1,118 @@
+"""
+mapcachebench.py compares how long loading a map takes without and with the
+map cache of mapcache.py (scripts/piqueserver): cold is a load into an empty
+cache (reading and parsing the .vxl file), warm is a load of a cached map
+(reading and hashing the .vxl file and copying the parsed map).
+
+The hitch columns show how long the game stands still when the cache works on
+a worker thread: the longest gap of a loop on the main thread, while a worker
+thread parses the map (prewarm) or loads it from the cache (loading the next
+map ahead). Parsing and copying hold the interpreter lock, so a worker thread
+does not keep them from stalling the game.
+
+Requirements:
+
+    A Python 3 environment with piqueserver installed, like for botbench.py.
+
+Usage:
+
+    python tools/mapcachebench.py
+    python tools/mapcachebench.py survive bots-tc/level1 --repeat 10
+
+    Maps are given below maps/, a folder or a map without extension. Without
+    maps, all maps below maps/ are measured.
+"""
+
+import argparse
+import os
+import threading
+import time
+from timeit import default_timer
+
+from botbench import MAPS_DIR, load_mode, percentile
+
+HITCH_TICK = 0.001  # seconds the loop on the main thread sleeps between two iterations
+
+
+def find_maps(names):
+    paths = []
+    for name in names or [""]:
+        path = os.path.join(MAPS_DIR, name)
+        if os.path.isfile(path + ".vxl"):
+            paths.append(path + ".vxl")
+            continue
+        for folder, _, files in sorted(os.walk(path)):
+            paths.extend(os.path.join(folder, f) for f in sorted(files) if f.endswith(".vxl"))
+    return paths
+
+
+def time_load(cache, path):
+    start = default_timer()
+    cache.load(path)
+    return (default_timer() - start) * 1000
+
+
+def time_hitch(function, *args):
+    """
+    Runs function on a worker thread, returns the longest gap in ms between two
+    iterations of a loop on this thread meanwhile.
+    """
+    done = threading.Event()
+
+    def run():
+        try:
+            function(*args)
+        finally:
+            done.set()
+
+    thread = threading.Thread(target=run)
+    longest = 0.0
+    last = default_timer()
+    thread.start()
+    while not done.is_set():
+        time.sleep(HITCH_TICK)
+        now = default_timer()
+        longest = max(longest, now - last)
+        last = now
+    thread.join()
+    return longest * 1000
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Load times of maps without and with the map cache.")
+    parser.add_argument("maps", nargs="*", help="folder or map below maps/, e.g. survive")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(args)
+    paths = find_maps(args.maps)
+    if not paths:
+        parser.error("no maps found")
+
+    mapcache = load_mode("mapcache")
+    total_cold = total_warm = 0.0
+    worst_parse = worst_copy = 0.0
+    for path in paths:
+        cold = [time_load(mapcache.MapCache(1), path) for _ in range(args.repeat)]
+        cache = mapcache.MapCache(1)
+        cache.prewarm(path)
+        warm = [time_load(cache, path) for _ in range(args.repeat)]
+        parse_hitch = [time_hitch(mapcache.MapCache(1).prewarm, path)
+                       for _ in range(args.repeat)]
+        copy_hitch = [time_hitch(cache.load, path) for _ in range(args.repeat)]
+        cold_median = percentile(cold, 0.5)
+        warm_median = percentile(warm, 0.5)
+        total_cold += cold_median
+        total_warm += warm_median
+        worst_parse = max(worst_parse, percentile(parse_hitch, 0.5))
+        worst_copy = max(worst_copy, percentile(copy_hitch, 0.5))
+        print("%-32s cold %7.1f ms  warm %6.1f ms  %5.1fx  hitch parse %6.1f ms  copy %5.1f ms" % (
+            os.path.relpath(path, MAPS_DIR)[:-4], cold_median, warm_median,
+            cold_median / warm_median, percentile(parse_hitch, 0.5),
+            percentile(copy_hitch, 0.5)))
+    print("%-32s cold %7.1f ms  warm %6.1f ms  %5.1fx  hitch parse %6.1f ms  copy %5.1f ms" % (
+        "%d maps (hitch: worst)" % len(paths), total_cold, total_warm,
+        total_cold / total_warm, worst_parse, worst_copy))
+
+
+if __name__ == "__main__":
+    main()
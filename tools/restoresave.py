@@ -0,0 +1,64 @@
+"""
+restoresave.py turns a save of autosave.py (scripts/piqueserver) back into a
+map. A delta save (mapname.date.delta) is rebuilt from the full save it builds
+on and all delta saves up to it, which have to be in the same folder. A chunk
+save (mapname.date.manifest) is rebuilt from the chunks folder next to it.
+
+Requirements:
+
+    A Python 3 environment with piqueserver installed, like for botbench.py.
+
+Usage:
+
+    python tools/restoresave.py maps/mymap_BAK/mymap.20240101-1200.delta mymap.vxl
+    python tools/restoresave.py --list maps/mymap_BAK
+
+    --list shows the saves of a folder by the full save they build on.
+"""
+
+import argparse
+import fnmatch
+import os
+
+from botbench import load_mode
+
+
+def list_saves(autosave, folder):
+    chains = {}
+    for f in sorted(os.listdir(folder)):
+        if fnmatch.fnmatch(f, "*.vxl") or fnmatch.fnmatch(f, "*" + autosave.MANIFEST_EXTENSION):
+            chains.setdefault(f, [])
+        elif fnmatch.fnmatch(f, "*" + autosave.DELTA_EXTENSION):
+            base, number = autosave.read_delta_header(os.path.join(folder, f))
+            chains.setdefault(base, []).append((number, f))
+    for base in sorted(chains):
+        deltas = sorted(chains[base])
+        missing = set(range(1, len(deltas) + 1)) != set(number for number, _ in deltas)
+        print("%s%s" % (base, "" if os.path.isfile(os.path.join(folder, base)) else " (missing)"))
+        for number, f in deltas:
+            print("    %3d %s" % (number, f))
+        if missing:
+            print("    delta saves are missing, later ones can not be restored")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Rebuild a map from the saves of autosave.py.")
+    parser.add_argument("save", help="full or delta save, or a folder of saves with --list")
+    parser.add_argument("output", nargs="?", help="map file to write")
+    parser.add_argument("--list", action="store_true")
+    args = parser.parse_args(args)
+
+    autosave = load_mode("autosave")
+    if args.list:
+        list_saves(autosave, args.save)
+        return
+    if args.output is None:
+        parser.error("the map file to write is missing")
+    data = autosave.restore_save(args.save)
+    with open(args.output, "wb") as f:
+        f.write(data)
+    print("%s written (%d bytes)" % (args.output, len(data)))
+
+
+if __name__ == "__main__":
+    main()
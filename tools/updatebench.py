@@ -0,0 +1,120 @@
+"""
+updatebench.py measures the calls the bots of one bot gamemode make on every
+world update (think(), update() and the turn() and flush_input() of the bot
+engine): the time per call and the memory the call holds for temporaries (the
+peak above what was allocated before the call, traced with tracemalloc).
+It runs the gamemode on the headless server of botbench.py.
+
+Requirements:
+
+    The same as for botbench.py.
+
+Usage:
+
+    python tools/updatebench.py survive --bots 26 --ticks 1200
+    python tools/updatebench.py botstc --set bot_think_rate=1
+
+The time and the memory are measured in two separate runs with the same seed,
+since tracing the memory slows every call down.
+"""
+
+import argparse
+import tracemalloc
+from timeit import default_timer
+
+from botbench import Benchmark, DEFAULT_MAPS, parse_options, percentile
+
+MEASURED_METHODS = ("think", "update", "turn", "flush_input")
+
+
+class CallRecorder:
+    """Replaces methods of a class by wrappers that record every call."""
+
+    def __init__(self, cls, names, trace_memory):
+        self.cls = cls
+        self.originals = {}
+        self.times = {}
+        self.sizes = {}
+        self.trace_memory = trace_memory
+        for name in names:
+            self.originals[name] = getattr(cls, name)
+            self.times[name] = []
+            self.sizes[name] = []
+            setattr(cls, name, self.wrap(name, self.originals[name]))
+
+    def wrap(self, name, method):
+        times = self.times[name]
+        sizes = self.sizes[name]
+        if self.trace_memory:
+            def wrapper(*arg, **kw):
+                tracemalloc.reset_peak()
+                start = tracemalloc.get_traced_memory()[0]
+                result = method(*arg, **kw)
+                sizes.append(tracemalloc.get_traced_memory()[1] - start)
+                return result
+        else:
+            def wrapper(*arg, **kw):
+                start = default_timer()
+                result = method(*arg, **kw)
+                times.append((default_timer() - start) * 1000000)
+                return result
+        return wrapper
+
+    def restore(self):
+        for name, method in self.originals.items():
+            setattr(self.cls, name, method)
+
+
+def measure(args, trace_memory):
+    map_name = args.map or DEFAULT_MAPS[args.mode]
+    benchmark = Benchmark(args.mode, map_name, args.humans, args.bots,
+                          parse_options(args.set), args.seed)
+    benchmark.run(args.warmup)
+    recorder = CallRecorder(benchmark.connection_class, MEASURED_METHODS, trace_memory)
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        benchmark.run(args.ticks)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        recorder.restore()
+    return recorder
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Time and memory of the calls of the bots per world update.")
+    parser.add_argument("mode", choices=sorted(DEFAULT_MAPS))
+    parser.add_argument("--map", help="map below maps/ without extension, e.g. survive/pyramidtown")
+    parser.add_argument("--humans", type=int, default=4)
+    parser.add_argument("--bots", type=int, default=16)
+    parser.add_argument("--ticks", type=int, default=1200)
+    parser.add_argument("--warmup", type=int, default=120)
+    parser.add_argument("--set", action="append", default=[], metavar="OPTION=VALUE",
+                        help="gamemode option, like in the server config")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(args)
+    if args.humans + args.bots > 32:
+        parser.error("there is only room for 32 players")
+
+    timed = measure(args, False)
+    traced = measure(args, True)
+    print("%s: %d humans, %d bots, %d world updates" % (
+        args.mode, args.humans, args.bots, args.ticks))
+    for name in MEASURED_METHODS:
+        times = timed.times[name]
+        sizes = traced.sizes[name]
+        if not times or not sizes:
+            print("%-11s not called" % name)
+            continue
+        allocating = sum(1 for size in sizes if size > 0)
+        print("%-11s %7d calls  mean %6.2f  p95 %6.2f us  temporaries mean %6.1f  "
+              "max %6d bytes, in %3.0f%% of the calls" % (
+                  name, len(times), sum(times) / len(times), percentile(times, 0.95),
+                  sum(sizes) / float(len(sizes)), max(sizes),
+                  100.0 * allocating / len(sizes)))
+
+
+if __name__ == "__main__":
+    main()